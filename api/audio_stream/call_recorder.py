@@ -0,0 +1,270 @@
+import asyncio
+import audioop
+import logging
+import os
+import threading
+import time
+import wave
+from collections import deque
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import override
+
+from api.audio_stream.stream_operator import StreamOperator
+from api.utils.metrics import REGISTRY
+from api.utils.mongodb import MongoDB, RecordingSegment
+
+# Audio on the phone path is mu-law at 8kHz, one byte per sample.
+SAMPLE_RATE = 8000
+# Gaps longer than this (e.g. while the agent is silent) are filled with silence,
+# so that the tracks of a call line up.
+_MAX_GAP_SAMPLES = SAMPLE_RATE // 5
+
+_dropped_frames = REGISTRY.counter(
+    "call_recorder_dropped_frames_total",
+    "Audio frames not recorded because the writer fell behind.",
+)
+_written_bytes = REGISTRY.counter(
+    "call_recorder_written_bytes_total", "Recorded audio written to disk."
+)
+
+
+class AudioRingBuffer:
+    """
+    A fixed-size byte ring for audio frames, with one producer (the event loop)
+    and one consumer (the writer thread). Frames that don't fit are dropped rather
+    than waited on, so the producer never blocks.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._view = memoryview(bytearray(capacity))
+        # Total bytes ever written and consumed. Their difference is the fill.
+        self._head = 0
+        self._tail = 0
+        # (track, timestamp, length) of each frame between tail and head.
+        self._frames: deque[tuple[str, float, int]] = deque()
+        self._lock = threading.Lock()
+        self.has_data = threading.Event()
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+
+    def put(self, track: str, timestamp: float, data: bytes) -> bool:
+        size = len(data)
+        with self._lock:
+            free = self._capacity - (self._head - self._tail)
+        if size > free:
+            self.dropped_frames += 1
+            self.dropped_bytes += size
+            return False
+
+        # Only the producer moves head, so the copy can happen outside the lock.
+        start = self._head % self._capacity
+        first = min(size, self._capacity - start)
+        source = memoryview(data)
+        self._view[start : start + first] = source[:first]
+        if first < size:
+            self._view[: size - first] = source[first:]
+        with self._lock:
+            self._head += size
+            self._frames.append((track, timestamp, size))
+        self.has_data.set()
+        return True
+
+    def drain(self) -> list[tuple[str, float, bytes]]:
+        """Takes all buffered frames, freeing their space."""
+        with self._lock:
+            frames = list(self._frames)
+            self._frames.clear()
+            tail = self._tail
+
+        drained = []
+        for track, timestamp, size in frames:
+            start = tail % self._capacity
+            first = min(size, self._capacity - start)
+            data = bytes(self._view[start : start + first])
+            if first < size:
+                data += bytes(self._view[: size - first])
+            drained.append((track, timestamp, data))
+            tail += size
+
+        with self._lock:
+            self._tail = tail
+        return drained
+
+
+@dataclass
+class _Track:
+    name: str
+    segment: wave.Wave_write | None = None
+    segment_path: str = ""
+    segment_start: int = 0
+    segment_samples: int = 0
+    # Samples written across all segments, including silence.
+    samples: int = 0
+
+
+class _RecordingWriter(threading.Thread):
+    """Converts buffered frames to 16-bit PCM and writes them as WAV segments."""
+
+    def __init__(
+        self,
+        ring: AudioRingBuffer,
+        directory: str,
+        task_id: str,
+        segment_samples: int,
+    ):
+        super().__init__(name=f"recorder-{task_id}", daemon=True)
+        self.ring = ring
+        self.directory = directory
+        self.task_id = task_id
+        self.segment_samples = segment_samples
+        self.segments: list[RecordingSegment] = []
+        self._tracks: dict[str, _Track] = {}
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        self.ring.has_data.set()
+
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                self.ring.has_data.wait()
+                self.ring.has_data.clear()
+                self._write(self.ring.drain())
+            self._write(self.ring.drain())
+        except Exception:
+            logging.exception(f"Recording for task {self.task_id} failed")
+        finally:
+            for track in self._tracks.values():
+                self._close_segment(track)
+
+    def _write(self, frames: list[tuple[str, float, bytes]]):
+        for name, timestamp, data in frames:
+            track = self._tracks.setdefault(name, _Track(name))
+            gap = int(timestamp * SAMPLE_RATE) - track.samples
+            if gap > _MAX_GAP_SAMPLES:
+                self._append(track, bytes(gap * 2))
+            self._append(track, audioop.ulaw2lin(data, 2))
+
+    def _append(self, track: _Track, pcm: bytes):
+        view = memoryview(pcm)
+        while view:
+            if track.segment is None:
+                self._open_segment(track)
+            room = (self.segment_samples - track.segment_samples) * 2
+            chunk = view[:room]
+            track.segment.writeframesraw(chunk)
+            _written_bytes.inc(len(chunk))
+            track.segment_samples += len(chunk) // 2
+            track.samples += len(chunk) // 2
+            view = view[room:]
+            if track.segment_samples >= self.segment_samples:
+                self._close_segment(track)
+
+    def _open_segment(self, track: _Track):
+        index = sum(1 for s in self.segments if s.track == track.name)
+        track.segment_path = os.path.join(
+            self.directory, f"{self.task_id}-{track.name}-{index:03d}.wav"
+        )
+        track.segment = wave.open(track.segment_path, "wb")
+        track.segment.setnchannels(1)
+        track.segment.setsampwidth(2)
+        track.segment.setframerate(SAMPLE_RATE)
+        track.segment_start = track.samples
+        track.segment_samples = 0
+
+    def _close_segment(self, track: _Track):
+        if track.segment is None:
+            return
+        track.segment.close()
+        track.segment = None
+        self.segments.append(
+            RecordingSegment(
+                track=track.name,
+                path=track.segment_path,
+                offset_seconds=track.segment_start / SAMPLE_RATE,
+                duration_seconds=track.segment_samples / SAMPLE_RATE,
+            )
+        )
+
+
+class CallRecorder(StreamOperator):
+    """
+    `Send` records the audio of every other operator (i.e. both sides of the call)
+    to its own track.
+    `Receive` is a noop.
+
+    Frames are copied into a preallocated ring buffer, and written to disk by a
+    background thread as 16-bit PCM WAV segments of at most `segment_duration`.
+    If the disk falls behind for longer than the buffer holds (`buffer_duration`
+    of audio per track), frames are dropped and counted instead of delaying the
+    call. When the call ends, the segments are linked from the task.
+    """
+
+    def __init__(
+        self,
+        task_id: str,
+        mongodb_client: MongoDB,
+        directory: str,
+        *,
+        segment_duration: timedelta = timedelta(minutes=5),
+        buffer_duration: timedelta = timedelta(seconds=30),
+        tracks: int = 2,
+    ):
+        super().__init__("call_recorder")
+        self.task_id = task_id
+        self.mongodb_client = mongodb_client
+        self.directory = directory
+        self.ring = AudioRingBuffer(
+            int(buffer_duration.total_seconds() * SAMPLE_RATE * tracks)
+        )
+        self._writer = _RecordingWriter(
+            self.ring,
+            directory,
+            task_id,
+            int(segment_duration.total_seconds() * SAMPLE_RATE),
+        )
+        self._started_at = 0.0
+
+    @override
+    async def initialize(self):
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        self._started_at = time.monotonic()
+        self._writer.start()
+
+    @override
+    async def send_task(self):
+        while not self.stop_event.is_set():
+            stream_data = await self.get_from_send_queue()
+            if stream_data is None or stream_data.blob is None:
+                continue
+            recorded = self.ring.put(
+                stream_data.originator,
+                time.monotonic() - self._started_at,
+                stream_data.blob.data,
+            )
+            if not recorded:
+                _dropped_frames.inc()
+
+    @override
+    async def receive_task(self):
+        pass
+
+    @override
+    async def close(self):
+        if not self._writer.is_alive():
+            return
+        self._writer.stop()
+        await asyncio.to_thread(self._writer.join)
+        if self.ring.dropped_frames:
+            logging.warning(
+                f"Recording for task {self.task_id} dropped "
+                f"{self.ring.dropped_frames} frames ({self.ring.dropped_bytes} bytes)"
+            )
+        await self.mongodb_client.add_recordings(
+            self.task_id,
+            self._writer.segments,
+            dropped_frames=self.ring.dropped_frames,
+        )
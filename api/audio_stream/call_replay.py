@@ -0,0 +1,272 @@
+"""
+Replays a call trace (see CALL_TRACES_DIR) through the call's operators, with
+local stand-ins for the Twilio and ElevenLabs websockets, and reports how long
+audio took to cross the bridge, how much of it was dropped, and the CPU used.
+
+    python -m api.audio_stream.call_replay call_traces/<task_id>.jsonl.gz --speed 4
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import time
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+from fastapi.websockets import WebSocketState
+from websockets.exceptions import ConnectionClosedOK
+
+from api.audio_stream.call_trace import INBOUND, OUTBOUND, TraceEvent, read_trace
+from api.audio_stream.elevenlabs_conversation import ElevenLabsConversation
+from api.audio_stream.stream_mediator import StreamMediator
+from api.audio_stream.twilio_call import FRAME_BYTES, TwilioCall
+
+# How long to keep the call up after the last traced message, so that audio
+# still in flight is delivered rather than counted as dropped.
+_SETTLE_SECONDS = 0.5
+
+
+def _audio_key(raw_msg: str) -> bytes | None:
+    """
+    The first frame of audio in a Twilio or ElevenLabs message, if there is any.
+    Audio is passed through unchanged, but may be split into frames on the way,
+    so this is what identifies the same audio on both sides.
+    """
+    message = json.loads(raw_msg)
+    if message.get("event") == "media":
+        payload = message["media"]["payload"]
+    elif "user_audio_chunk" in message:
+        payload = message["user_audio_chunk"]
+    elif message.get("type") == "audio":
+        payload = message["audio_event"]["audio_base_64"]
+    else:
+        return None
+    return base64.b64decode(payload)[:FRAME_BYTES]
+
+
+class _Pacer:
+    """Maps trace time onto the wall clock. A speed of 0 doesn't wait at all."""
+
+    def __init__(self, speed: float):
+        self.speed = speed
+        self.started_at = time.monotonic()
+
+    async def until(self, t: float):
+        if self.speed <= 0:
+            # Still yield, so that the operators get to run between messages.
+            await asyncio.sleep(0)
+            return
+        await asyncio.sleep(self.started_at + t / self.speed - time.monotonic())
+
+
+class _LatencyProbe:
+    """
+    Matches audio entering the bridge on one side with (the first frame of) it
+    leaving on the other. Only audio that the traced call forwarded is expected to
+    be forwarded again.
+    """
+
+    def __init__(self, expected: Counter[bytes]):
+        self._expected = expected
+        self._in_flight: dict[bytes, deque[tuple[str, float]]] = defaultdict(deque)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+
+    def injected(self, side: str, key: bytes):
+        if self._expected[key] > 0:
+            self._expected[key] -= 1
+            self._in_flight[key].append((side, time.perf_counter()))
+
+    def forwarded(self, side: str, key: bytes):
+        in_flight = self._in_flight.get(key)
+        if not in_flight:
+            return
+        source, injected_at = in_flight.popleft()
+        if not in_flight:
+            del self._in_flight[key]
+        self.latencies[f"{source} -> {side}"].append(time.perf_counter() - injected_at)
+
+    def dropped(self) -> int:
+        return sum(len(in_flight) for in_flight in self._in_flight.values())
+
+
+class FakeTwilioWebSocket:
+    """Stands in for the FastAPI websocket Twilio streams the call over."""
+
+    def __init__(
+        self,
+        side: str,
+        events: list[TraceEvent],
+        ends_at: float,
+        pacer: _Pacer,
+        probe: _LatencyProbe,
+    ):
+        self.side = side
+        self._events = deque(events)
+        self._ends_at = ends_at
+        self._pacer = pacer
+        self._probe = probe
+        self.client_state = WebSocketState.CONNECTED
+
+    async def receive_text(self) -> str:
+        if not self._events:
+            # Twilio hangs up once the rest of the call has been replayed.
+            await self._pacer.until(self._ends_at)
+            await asyncio.sleep(_SETTLE_SECONDS)
+            self.client_state = WebSocketState.DISCONNECTED
+            raise ConnectionClosedOK(None, None)
+        event = self._events.popleft()
+        await self._pacer.until(event.t)
+        if key := _audio_key(event.message):
+            self._probe.injected(self.side, key)
+        return event.message
+
+    async def iter_text(self) -> AsyncIterator[str]:
+        while True:
+            try:
+                yield await self.receive_text()
+            except ConnectionClosedOK:
+                return
+
+    async def send_json(self, message: dict):
+        if key := _audio_key(json.dumps(message)):
+            self._probe.forwarded(self.side, key)
+
+    async def close(self):
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+class FakeElevenLabsSession:
+    """Stands in for the ElevenLabs conversation websocket."""
+
+    def __init__(
+        self, side: str, events: list[TraceEvent], pacer: _Pacer, probe: _LatencyProbe
+    ):
+        self.side = side
+        self._events = deque(events)
+        self._pacer = pacer
+        self._probe = probe
+        self._closed = asyncio.Event()
+
+    async def send(self, raw_msg: str):
+        if key := _audio_key(raw_msg):
+            self._probe.forwarded(self.side, key)
+
+    async def recv(self) -> str:
+        if not self._events:
+            await self._closed.wait()
+            raise ConnectionClosedOK(None, None)
+        event = self._events.popleft()
+        await self._pacer.until(event.t)
+        if key := _audio_key(event.message):
+            self._probe.injected(self.side, key)
+        return event.message
+
+    async def close(self):
+        self._closed.set()
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class ReplayReport:
+    task_id: str
+    speed: float
+    trace_seconds: float
+    wall_seconds: float
+    # Process CPU time over wall time, so 1.0 is one core fully busy.
+    cpu_utilization: float
+    dropped: int
+    # Latencies in seconds, by direction, e.g. "twilio_call -> elevenlabs_conversation".
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+
+    def format(self) -> str:
+        lines = [
+            f"Task {self.task_id}: replayed {self.trace_seconds:.1f}s of call in "
+            f"{self.wall_seconds:.1f}s (speed {self.speed:g})",
+            f"  CPU: {self.cpu_utilization:.1%} of a core",
+            f"  Dropped audio frames: {self.dropped}",
+        ]
+        for direction, values in sorted(self.latencies.items()):
+            lines.append(
+                f"  {direction}: {len(values)} frames, "
+                f"p50 {_percentile(values, 0.5) * 1000:.2f}ms, "
+                f"p99 {_percentile(values, 0.99) * 1000:.2f}ms, "
+                f"max {max(values) * 1000:.2f}ms"
+            )
+        return "\n".join(lines)
+
+
+async def replay(path: str, speed: float = 1.0) -> ReplayReport:
+    """
+    Feeds the messages the call received back into a Twilio <-> ElevenLabs bridge,
+    at `speed` times real time (0 for as fast as possible). Audio to Twilio is
+    still paced in real time, so at higher speeds it queues up.
+    """
+    header, events = read_trace(path)
+    events = list(events)
+    twilio_side, elevenlabs_side = "twilio_call", "elevenlabs_conversation"
+    inbound = {twilio_side: [], elevenlabs_side: []}
+    expected: Counter[bytes] = Counter()
+    for event in events:
+        if event.direction == INBOUND and event.side in inbound:
+            inbound[event.side].append(event)
+        elif event.direction == OUTBOUND:
+            if key := _audio_key(event.message):
+                expected[key] += 1
+    trace_seconds = events[-1].t if events else 0.0
+
+    probe = _LatencyProbe(expected)
+    pacer = _Pacer(speed)
+    twilio_ws = FakeTwilioWebSocket(
+        twilio_side, inbound[twilio_side], trace_seconds, pacer, probe
+    )
+    elevenlabs_session = FakeElevenLabsSession(
+        elevenlabs_side, inbound[elevenlabs_side], pacer, probe
+    )
+
+    async def connect():
+        return elevenlabs_session
+
+    started_at = time.monotonic()
+    cpu_started_at = time.process_time()
+    await StreamMediator(
+        [TwilioCall(twilio_ws), ElevenLabsConversation(connect=connect)]
+    ).run()
+    wall_seconds = time.monotonic() - started_at
+
+    return ReplayReport(
+        task_id=header["task_id"],
+        speed=speed,
+        trace_seconds=trace_seconds,
+        wall_seconds=wall_seconds,
+        cpu_utilization=(time.process_time() - cpu_started_at) / wall_seconds,
+        dropped=probe.dropped(),
+        latencies=dict(probe.latencies),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", help="A .jsonl.gz trace written by CallTrace.")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Multiple of real time to replay at. 0 replays as fast as possible.",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    report = asyncio.run(replay(args.trace, args.speed))
+    print(report.format())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import gzip
+import json
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator
+
+# Directions, relative to us.
+INBOUND = "in"
+OUTBOUND = "out"
+
+_TRACE_VERSION = 1
+
+
+@dataclass
+class TraceEvent:
+    # Seconds since the trace started.
+    t: float
+    # The operator that owns the websocket, e.g. "twilio_call".
+    side: str
+    direction: str
+    message: str
+
+
+class CallTrace:
+    """
+    Captures the raw websocket messages of a call, as gzipped JSON lines.
+
+    The first line is a header, every other line is `[t, side, direction, message]`.
+    `record` only timestamps the message and queues it; compression and disk
+    writes happen on a background thread so that tracing doesn't add jitter to
+    the call.
+    """
+
+    def __init__(self, path: str, task_id: str):
+        self.path = path
+        self.task_id = task_id
+        self._started_at = time.monotonic()
+        self._queue: queue.SimpleQueue[list | None] = queue.SimpleQueue()
+        self._writer = threading.Thread(
+            target=self._write, name=f"trace-{task_id}", daemon=True
+        )
+        self._writer.start()
+
+    def record(self, side: str, direction: str, message: str):
+        self._queue.put([time.monotonic() - self._started_at, side, direction, message])
+
+    def _write(self):
+        try:
+            with gzip.open(self.path, "wt", encoding="utf-8") as f:
+                header = {
+                    "version": _TRACE_VERSION,
+                    "task_id": self.task_id,
+                    "started_at": datetime.now().isoformat(),
+                }
+                f.write(json.dumps(header) + "\n")
+                while (event := self._queue.get()) is not None:
+                    f.write(json.dumps(event, separators=(",", ":")) + "\n")
+        except Exception:
+            logging.exception(f"Writing call trace {self.path} failed")
+
+    def close(self):
+        """Flushes the trace. Blocks until everything recorded is written."""
+        self._queue.put(None)
+        self._writer.join()
+
+
+def read_trace(path: str) -> tuple[dict, Iterator[TraceEvent]]:
+    """Returns the header and the events of a trace written by `CallTrace`."""
+    f = gzip.open(path, "rt", encoding="utf-8")
+    header = json.loads(f.readline())
+    if header.get("version") != _TRACE_VERSION:
+        f.close()
+        raise ValueError(f"Unsupported trace version: {header.get('version')}")
+
+    def events() -> Iterator[TraceEvent]:
+        with f:
+            for line in f:
+                yield TraceEvent(*json.loads(line))
+
+    return header, events()
@@ -2,16 +2,44 @@ import asyncio
 import base64
 import json
 import logging
-from typing import override
+import math
+import time
+from collections import deque
+from contextlib import suppress
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, override
 
 import websockets
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 from elevenlabs import ElevenLabs
 from elevenlabs.conversational_ai.conversation import ConversationInitiationData
 from google.genai.types import Blob
 
+from api.audio_stream.call_trace import INBOUND, OUTBOUND, CallTrace
 from api.audio_stream.stream_data import StreamData, TranscriptCorrection
 from api.audio_stream.stream_operator import StreamOperator
-from api.utils.settings import get_setting
+from api.utils.metrics import REGISTRY
+from api.utils.settings import get_settings
+from api.utils.usage import UsageKind, UsageRecord
+
+# Audio is mu-law at 8kHz, i.e. 8000 bytes per second.
+_AUDIO_BYTES_PER_SECOND = 8000
+# The dynamic variable that carries the conversation so far into a conversation
+# started after reconnecting.
+PREVIOUS_TRANSCRIPT_VARIABLE = "previous_transcript"
+
+_reconnects = REGISTRY.counter(
+    "elevenlabs_reconnects_total",
+    "Reconnects after the ElevenLabs websocket dropped, by outcome.",
+)
+_reconnect_seconds = REGISTRY.counter(
+    "elevenlabs_reconnect_seconds_total",
+    "Time spent reconnecting to ElevenLabs, from the drop until audio flows again.",
+)
+_buffered_audio_dropped = REGISTRY.counter(
+    "elevenlabs_reconnect_dropped_audio_bytes_total",
+    "Caller audio dropped because it did not fit the buffer while reconnecting.",
+)
 
 
 class ElevenLabsConversation(StreamOperator):
@@ -23,47 +51,164 @@ class ElevenLabsConversation(StreamOperator):
 
     This operator does not own the lifetime of the `client`.
     This class assumes that it sends & receives audio/mulaw 8000Hz.
+
+    `connect` opens the conversation websocket; by default it connects to the
+    agent through a (fresh) signed URL, or to ELEVENLABS_CONVERSATION_URL if set.
+    If `trace` is set, every message sent and received is recorded to it.
+
+    If the websocket drops (anything but a normal close), a new one is opened, up to
+    `max_reconnect_attempts` times in a row. Caller audio is buffered meanwhile,
+    keeping the latest `max_buffered_audio`. ElevenLabs can't resume a conversation
+    on a new websocket, so a new conversation is started, and the transcript so far
+    is passed in the `previous_transcript` dynamic variable. The agent only picks up
+    where it left off if its prompt uses that variable.
     See https://elevenlabs.io/docs/conversational-ai/phone-numbers/twilio-integration/custom-server#set-input-format
     """
 
+    # Transcripts are whole utterances.
+    transcript_separator = " "
+
     def __init__(
         self,
         conversation_config: ConversationInitiationData = ConversationInitiationData(),
+        *,
+        connect: Callable[[], Awaitable[Any]] | None = None,
+        trace: CallTrace | None = None,
+        max_reconnect_attempts: int = 3,
+        max_buffered_audio: timedelta = timedelta(seconds=2),
     ):
         super().__init__(
             "elevenlabs_conversation",
         )
-        self.client = ElevenLabs(api_key=get_setting("ELEVENLABS_API_KEY"))
-        self.agent_id = get_setting("ELEVENLABS_AGENT_ID")
+        self.client: ElevenLabs | None = None
+        self.connect = connect or self._connect_signed_url
+        self.trace = trace
         self.session = None
         self.conversation_config = conversation_config
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self.max_buffered_bytes = int(
+            max_buffered_audio.total_seconds() * _AUDIO_BYTES_PER_SECOND
+        )
         self._conversation_id = None
         self._last_interrupt_id = 0
+        # When each conversation (one per websocket) started.
+        self._conversations_started_at: list[float] = []
+        self._closed_at: float | None = None
+        # Cleared while reconnecting, when audio is buffered instead of sent.
+        self._connected = asyncio.Event()
+        self._buffered: deque[bytes] = deque()
+        self._buffered_bytes = 0
+        # (speaker, text) of the conversation so far, across reconnects.
+        self._transcript: list[tuple[str, str]] = []
+        self.reconnect_durations: list[float] = []
+        # When the agent's first audio arrived.
+        self.first_audio_at: float | None = None
 
     @override
     async def initialize(self):
-        self.session = await websockets.connect(
-            self._get_signed_url(), max_size=16 * 1024 * 1024
-        )
+        await self._open()
 
-        # Send initial configuration
-        await self.session.send(
-            json.dumps(
-                {
-                    "type": "conversation_initiation_client_data",
-                    "custom_llm_extra_body": self.conversation_config.extra_body,
-                    "conversation_config_override": self.conversation_config.conversation_config_override,
-                    "dynamic_variables": self.conversation_config.dynamic_variables,
-                }
+    async def _open(self):
+        self.session = await self.connect()
+        self._conversation_id = None
+        self._last_interrupt_id = 0
+
+        dynamic_variables = dict(self.conversation_config.dynamic_variables)
+        if self._transcript:
+            dynamic_variables[PREVIOUS_TRANSCRIPT_VARIABLE] = "\n".join(
+                f"{speaker}: {text}" for speaker, text in self._transcript
             )
+        # Send initial configuration
+        await self._send(
+            {
+                "type": "conversation_initiation_client_data",
+                "custom_llm_extra_body": self.conversation_config.extra_body,
+                "conversation_config_override": self.conversation_config.conversation_config_override,
+                "dynamic_variables": dynamic_variables,
+            }
         )
+        self._conversations_started_at.append(time.monotonic())
+        await self._flush()
+        self._connected.set()
+
+    async def _reconnect(self, error: Exception) -> bool:
+        """Replaces a dropped websocket. Returns False if the call should end."""
+        self._connected.clear()
+        started_at = time.monotonic()
+        logging.warning(f"ElevenLabs websocket dropped ({error!r}), reconnecting")
+        with suppress(Exception):
+            await self.session.close()
+
+        for attempt in range(self.max_reconnect_attempts):
+            if self.stop_event.is_set():
+                return False
+            try:
+                await self._open()
+            except ConnectionClosedOK:
+                raise
+            except Exception:
+                logging.exception(f"Reconnect attempt {attempt + 1} failed")
+                if self.session is not None:
+                    with suppress(Exception):
+                        await self.session.close()
+                await asyncio.sleep(0.1 * 2**attempt)
+                continue
+            duration = time.monotonic() - started_at
+            self.reconnect_durations.append(duration)
+            _reconnects.inc(outcome="ok")
+            _reconnect_seconds.inc(duration)
+            logging.info(f"Reconnected to ElevenLabs in {duration * 1000:.0f}ms")
+            return True
+
+        _reconnects.inc(outcome="failed")
+        _reconnect_seconds.inc(time.monotonic() - started_at)
+        return False
+
+    def _buffer(self, audio: bytes):
+        """Queues caller audio to send, dropping the oldest if the buffer is full."""
+        self._buffered.append(audio)
+        self._buffered_bytes += len(audio)
+        while self._buffered_bytes > self.max_buffered_bytes:
+            dropped = self._buffered.popleft()
+            self._buffered_bytes -= len(dropped)
+            _buffered_audio_dropped.inc(len(dropped))
+
+    async def _flush(self):
+        """Sends the buffered audio. What can't be sent stays buffered."""
+        while self._buffered:
+            audio = self._buffered.popleft()
+            self._buffered_bytes -= len(audio)
+            try:
+                await self._send_audio(audio)
+            except BaseException:
+                self._buffered.appendleft(audio)
+                self._buffered_bytes += len(audio)
+                raise
+
+    async def _connect_signed_url(self):
+        url = get_settings().elevenlabs_conversation_url
+        if not url:
+            # Getting the URL is a blocking HTTP request.
+            url = await asyncio.to_thread(self._get_signed_url)
+        return await websockets.connect(url, max_size=16 * 1024 * 1024)
 
     def _get_signed_url(self):
+        if self.client is None:
+            self.client = ElevenLabs(api_key=get_settings().elevenlabs_api_key)
         response = self.client.conversational_ai.conversations.get_signed_url(
-            agent_id=self.agent_id
+            agent_id=get_settings().elevenlabs_agent_id
         )
         return response.signed_url
 
+    async def _send(self, message: dict):
+        raw_msg = json.dumps(message)
+        if self.trace:
+            self.trace.record(self.name, OUTBOUND, raw_msg)
+        await self.session.send(raw_msg)
+
+    async def _send_audio(self, audio: bytes):
+        await self._send({"user_audio_chunk": base64.b64encode(audio).decode()})
+
     @override
     async def send_task(self):
         try:
@@ -71,16 +216,20 @@ class ElevenLabsConversation(StreamOperator):
                 stream_data = await self.get_from_send_queue()
                 if stream_data is None or stream_data.blob is None:
                     continue
-                await self.session.send(
-                    json.dumps(
-                        {
-                            "user_audio_chunk": base64.b64encode(
-                                stream_data.blob.data
-                            ).decode()
-                        }
-                    )
-                )
-        except websockets.exceptions.ConnectionClosedOK:
+                # Normally sent straight away. While reconnecting, it stays
+                # buffered until the new websocket is open.
+                self._buffer(stream_data.blob.data)
+                if not self._connected.is_set():
+                    continue
+                session = self.session
+                try:
+                    await self._flush()
+                except (ConnectionClosedError, OSError):
+                    # Reconnecting is left to `receive_task`, which sees the same
+                    # error. Unless it already has.
+                    if self.session is session:
+                        self._connected.clear()
+        except ConnectionClosedOK:
             if not self.stop_event.is_set():
                 await self.receive_queue.put(
                     StreamData(
@@ -97,10 +246,21 @@ class ElevenLabsConversation(StreamOperator):
                 await self.wait_respecting_shutdown(t)
                 if not t.done():
                     continue
-                raw_msg = t.result()
+                try:
+                    raw_msg = t.result()
+                except (ConnectionClosedError, OSError) as e:
+                    if await self._reconnect(e):
+                        continue
+                    if not self.stop_event.is_set():
+                        await self.receive_queue.put(
+                            StreamData(originator=self.name, force_end_call=True)
+                        )
+                    return
+                if self.trace:
+                    self.trace.record(self.name, INBOUND, raw_msg)
                 msg = json.loads(raw_msg)
                 await self._handle_message(msg)
-        except websockets.exceptions.ConnectionClosedOK:
+        except ConnectionClosedOK:
             if not self.stop_event.is_set():
                 await self.receive_queue.put(
                     StreamData(
@@ -122,6 +282,8 @@ class ElevenLabsConversation(StreamOperator):
             event = message["audio_event"]
             if int(event["event_id"]) <= self._last_interrupt_id:
                 return
+            if self.first_audio_at is None:
+                self.first_audio_at = time.monotonic()
             audio = base64.b64decode(event["audio_base_64"])
             stream_data = StreamData(
                 originator=self.name,
@@ -131,6 +293,7 @@ class ElevenLabsConversation(StreamOperator):
 
         elif msg_type == "agent_response":
             event = message["agent_response_event"]
+            self._transcript.append(("agent", event["agent_response"].strip()))
             stream_data = StreamData(
                 originator=self.name,
                 blob=None,
@@ -140,6 +303,10 @@ class ElevenLabsConversation(StreamOperator):
 
         elif msg_type == "agent_response_correction":
             event = message["agent_response_correction_event"]
+            self._correct_transcript(
+                event["original_agent_response"].strip(),
+                event["corrected_agent_response"].strip(),
+            )
             stream_data = StreamData(
                 originator=self.name,
                 output_transcription_correction=TranscriptCorrection(
@@ -151,6 +318,7 @@ class ElevenLabsConversation(StreamOperator):
 
         elif msg_type == "user_transcript":
             event = message["user_transcription_event"]
+            self._transcript.append(("user", event["user_transcript"].strip()))
             stream_data = StreamData(
                 originator=self.name,
                 input_transcription=event["user_transcript"].strip(),
@@ -163,18 +331,20 @@ class ElevenLabsConversation(StreamOperator):
             # For interruptions to work, we need to stop playback.
             # So empty out the audio queue because it may have loaded
             # much more audio than has played yet.
-            while not self.receive_queue.empty() and not self.call_ended:
+            while not self.receive_queue.empty() and not self.stop_event.is_set():
                 self.receive_queue.get_nowait()
+            # And so that audio already forwarded is dropped too.
+            await self.receive_queue.put(
+                StreamData(originator=self.name, interrupt=True)
+            )
 
         elif msg_type == "ping":
             event = message["ping_event"]
-            await self.session.send(
-                json.dumps(
-                    {
-                        "type": "pong",
-                        "event_id": event["event_id"],
-                    }
-                )
+            await self._send(
+                {
+                    "type": "pong",
+                    "event_id": event["event_id"],
+                }
             )
 
         elif msg_type == "client_tool_call":
@@ -199,8 +369,34 @@ class ElevenLabsConversation(StreamOperator):
         else:
             logging.error(f"Unknown message type: {msg_type}")
 
+    def _correct_transcript(self, original: str, corrected: str):
+        for i in range(len(self._transcript) - 1, -1, -1):
+            if self._transcript[i] == ("agent", original):
+                self._transcript[i] = ("agent", corrected)
+                return
+
+    def usage_record(self) -> UsageRecord:
+        """
+        How long the conversations were connected. ElevenLabs bills each
+        conversation per minute, and every reconnect starts a new one.
+        """
+        ends = self._conversations_started_at[1:] + [
+            self._closed_at or time.monotonic()
+        ]
+        durations = [
+            end - start for start, end in zip(self._conversations_started_at, ends)
+        ]
+        return UsageRecord(
+            kind=UsageKind.ELEVENLABS,
+            name="conversation",
+            duration_ms=sum(durations) * 1000,
+            billable_units=sum(math.ceil(d / 60) for d in durations),
+            unit="minutes",
+        )
+
     @override
     async def close(self):
         logging.info("Closing elevenlabs conversation")
+        self._closed_at = time.monotonic()
         await self.session.close()
         self.session = None
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pyaudio
+
+_SAMPLE_WIDTH = 2
+
+
+class FakeStream:
+    """
+    A PyAudio stream in callback mode, without an audio device. Like PortAudio, a
+    thread calls `stream_callback` once per buffer, at the pace the audio plays.
+    """
+
+    def __init__(
+        self,
+        pya: "FakePyAudio",
+        *,
+        rate: int,
+        channels: int = 1,
+        format: int = pyaudio.paInt16,
+        input: bool = False,
+        output: bool = False,
+        frames_per_buffer: int = 1024,
+        stream_callback=None,
+        input_device_index: int | None = None,
+    ):
+        assert format == pyaudio.paInt16, "Only 16-bit audio is supported"
+        assert stream_callback is not None, "Only callback mode is supported"
+        self.pya = pya
+        self.rate = rate
+        self.channels = channels
+        self.is_input = input
+        self.is_output = output
+        self.frames_per_buffer = frames_per_buffer
+        self.callback = stream_callback
+        # Callbacks that ran later than scheduled, as a real device would glitch.
+        self.late_callbacks = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buffer_bytes = self.frames_per_buffer * self.channels * _SAMPLE_WIDTH
+        interval = self.frames_per_buffer / self.rate
+        next_at = time.monotonic()
+        while not self._stopping.is_set():
+            in_data = self.pya.read_mic(buffer_bytes) if self.is_input else None
+            out_data, flag = self.callback(in_data, self.frames_per_buffer, {}, 0)
+            if self.is_output and out_data:
+                self.pya.play(out_data)
+            if flag != pyaudio.paContinue:
+                return
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay < 0:
+                self.late_callbacks += 1
+                next_at = time.monotonic()
+            self._stopping.wait(max(delay, 0))
+
+    def is_active(self) -> bool:
+        return self._thread.is_alive()
+
+    def stop_stream(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def close(self):
+        self.stop_stream()
+
+
+class FakePyAudio:
+    """
+    Stands in for `pyaudio.PyAudio`, e.g. to run local calls without audio devices.
+    Mic streams record `mic_audio` (16-bit PCM), then silence. What speaker
+    streams play is collected in `played`.
+    """
+
+    def __init__(self, mic_audio: bytes = b""):
+        self.played = bytearray()
+        self._mic_audio = memoryview(mic_audio)
+        self._lock = threading.Lock()
+
+    def get_default_input_device_info(self) -> dict:
+        return {"index": 0, "name": "fake mic"}
+
+    def open(self, **kwargs) -> FakeStream:
+        return FakeStream(self, **kwargs)
+
+    def read_mic(self, size: int) -> bytes:
+        with self._lock:
+            data = bytes(self._mic_audio[:size])
+            self._mic_audio = self._mic_audio[size:]
+        return data + bytes(size - len(data))
+
+    def play(self, data: bytes):
+        with self._lock:
+            self.played += data
+
+    def terminate(self):
+        pass
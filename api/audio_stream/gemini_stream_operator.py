@@ -1,10 +1,38 @@
+import asyncio
+import audioop
+import logging
+import time
 from typing import override
 
 from google import genai
-from google.genai.types import Blob, LiveServerMessage
+from google.genai.types import (
+    Blob,
+    FunctionDeclaration,
+    FunctionResponse,
+    LiveServerMessage,
+    LiveServerToolCall,
+)
 
 from api.audio_stream.stream_data import StreamData
 from api.audio_stream.stream_operator import StreamOperator
+from api.utils.usage import UsageKind, UsageRecord
+
+# The other operators exchange mu-law at 8kHz (see TwilioCall). Gemini Live takes
+# 16-bit PCM at 16kHz, and answers with 16-bit PCM at 24kHz.
+# https://ai.google.dev/gemini-api/docs/live#audio-formats
+_WIRE_RATE = 8000
+_INPUT_RATE = 16000
+_OUTPUT_RATE = 24000
+_SAMPLE_WIDTH = 2
+
+# Ends the call, like the ElevenLabs agent's client tool of the same name.
+TASK_COMPLETE = FunctionDeclaration(
+    name="task_complete",
+    description=(
+        "Ends the call. Call it once the task is done, or once it is clear that it "
+        "can't be done, after saying goodbye."
+    ),
+)
 
 
 def _get_data(resp: LiveServerMessage) -> bytes | None:
@@ -45,56 +73,166 @@ class GeminiStreamOperator(StreamOperator):
     `Send` sends audio to the Gemini model.
     `Receive` receives audio from the Gemini model. It also populates the
     `input_transcription` and `output_transcription` fields if those are returned
-    by the Gemini model.
+    by the Gemini model. These are fragments, as Gemini sends them, see
+    TranscriptSegmenter.
 
     This operator does not own the lifetime of the `session`.
+    This class assumes that it sends & receives audio/mulaw 8000Hz, and converts
+    to and from the PCM rates Gemini uses. If the session was configured with the
+    `TASK_COMPLETE` tool, calling it ends the call.
     """
 
-    def __init__(self, session: genai.live.AsyncSession):
+    def __init__(self, session: genai.live.AsyncSession, model: str | None = None):
         super().__init__("gemini_stream")
         self.session = session
+        self.model = model
+        # audioop.ratecv state, so that chunks are resampled seamlessly.
+        self._input_resample_state = None
+        self._output_resample_state = None
+        self._started_at = time.monotonic()
+        self._closed_at: float | None = None
+        # When the model's first audio arrived.
+        self.first_audio_at: float | None = None
+        self._prompt_tokens = 0
+        self._completion_tokens = 0
 
     @override
     async def send_task(self):
         while not self.stop_event.is_set():
-            stream_data = await self.send_queue.get()
-            if stream_data.blob is None:
+            stream_data = await self.get_from_send_queue()
+            if stream_data is None or stream_data.blob is None:
                 continue
-            await self.session.send_realtime_input(audio=stream_data.blob)
+            pcm = audioop.ulaw2lin(stream_data.blob.data, _SAMPLE_WIDTH)
+            pcm, self._input_resample_state = audioop.ratecv(
+                pcm,
+                _SAMPLE_WIDTH,
+                1,
+                _WIRE_RATE,
+                _INPUT_RATE,
+                self._input_resample_state,
+            )
+            await self.session.send_realtime_input(
+                audio=Blob(data=pcm, mime_type=f"audio/pcm;rate={_INPUT_RATE}")
+            )
 
     @override
     async def receive_task(self):
+        # Each turn is received separately, so the iterator is replaced when
+        # a turn ends.
+        turn = None
         while not self.stop_event.is_set():
-            turn = self.session.receive()
-            async for response in turn:
-                blob: Blob | None = None
-                input_transcription: str | None = None
-                output_transcription: str | None = None
-                thought: str | None = None
-                if response.server_content.input_transcription:
-                    input_transcription = (
-                        response.server_content.input_transcription.text
-                    )
-                if response.server_content.output_transcription:
-                    output_transcription = (
-                        response.server_content.output_transcription.text
-                    )
-                if data := response.data:
-                    blob = Blob(data=data, mime_type="audio/pcm")
-                thought = _get_thought(response)
-
-                stream_data = StreamData(
-                    originator=self.name,
-                    blob=blob,
-                    input_transcription=input_transcription,
-                    output_transcription=output_transcription,
-                    thought=thought,
-                )
-                await self.receive_queue.put(stream_data)
-
-            # If you interrupt the model, it sends a turn_complete.
+            if turn is None:
+                turn = aiter(self.session.receive())
+            t = asyncio.create_task(anext(turn, None))
+            await self.wait_respecting_shutdown(t)
+            if not t.done():
+                continue
+            response = t.result()
+            if response is None:
+                turn = None
+                continue
+            await self._handle_message(response)
+
+    async def _handle_message(self, response: LiveServerMessage):
+        if response.usage_metadata:
+            self._prompt_tokens += response.usage_metadata.prompt_token_count or 0
+            self._completion_tokens += response.usage_metadata.response_token_count or 0
+        if response.tool_call:
+            await self._handle_tool_call(response.tool_call)
+        content = response.server_content
+        if content is None:
+            return
+
+        if content.interrupted:
             # For interruptions to work, we need to stop playback.
             # So empty out the audio queue because it may have loaded
             # much more audio than has played yet.
             while not self.receive_queue.empty() and not self.stop_event.is_set():
                 self.receive_queue.get_nowait()
+            # And so that audio already forwarded is dropped too.
+            await self.receive_queue.put(
+                StreamData(originator=self.name, interrupt=True)
+            )
+        if content.input_transcription and content.input_transcription.text:
+            await self.receive_queue.put(
+                StreamData(
+                    originator=self.name,
+                    input_transcription=content.input_transcription.text,
+                )
+            )
+        if content.output_transcription and content.output_transcription.text:
+            await self.receive_queue.put(
+                StreamData(
+                    originator=self.name,
+                    output_transcription=content.output_transcription.text,
+                )
+            )
+        if data := _get_data(response):
+            if self.first_audio_at is None:
+                self.first_audio_at = time.monotonic()
+            pcm, self._output_resample_state = audioop.ratecv(
+                data,
+                _SAMPLE_WIDTH,
+                1,
+                _OUTPUT_RATE,
+                _WIRE_RATE,
+                self._output_resample_state,
+            )
+            await self.receive_queue.put(
+                StreamData(
+                    originator=self.name,
+                    blob=Blob(
+                        data=audioop.lin2ulaw(pcm, _SAMPLE_WIDTH),
+                        mime_type="audio/pcm",
+                    ),
+                )
+            )
+        if thought := _get_thought(response):
+            await self.receive_queue.put(
+                StreamData(originator=self.name, thought=thought)
+            )
+
+    async def _handle_tool_call(self, tool_call: LiveServerToolCall):
+        responses = []
+        end_call = False
+        for call in tool_call.function_calls or []:
+            if call.name == TASK_COMPLETE.name:
+                end_call = True
+                responses.append(
+                    FunctionResponse(id=call.id, name=call.name, response={})
+                )
+            else:
+                logging.error(f"Unknown Tool call: {call.name} with args: {call.args}")
+                responses.append(
+                    FunctionResponse(
+                        id=call.id,
+                        name=call.name,
+                        response={"error": f"Unknown tool {call.name}"},
+                    )
+                )
+        if responses:
+            await self.session.send_tool_response(function_responses=responses)
+        if end_call:
+            await self.receive_queue.put(
+                StreamData(
+                    originator=self.name,
+                    force_end_call=True,
+                )
+            )
+
+    def usage_record(self) -> UsageRecord:
+        """Tokens used, and how long the session was connected."""
+        return UsageRecord(
+            kind=UsageKind.GEMINI,
+            name="call",
+            model=self.model,
+            prompt_tokens=self._prompt_tokens,
+            completion_tokens=self._completion_tokens,
+            duration_ms=((self._closed_at or time.monotonic()) - self._started_at)
+            * 1000,
+        )
+
+    @override
+    async def close(self):
+        logging.info("Closing gemini stream")
+        self._closed_at = time.monotonic()
@@ -0,0 +1,559 @@
+"""
+Load-tests the Twilio media stream endpoint (/task-stream/{task_id}) with
+simulated calls, to find how many calls an instance can bridge. Starts the API in
+a subprocess, with an in-memory task store and its ElevenLabs websockets pointed at
+a local stand-in agent, and reports audio latency, dropped frames and CPU at each
+concurrency level.
+
+    python -m api.audio_stream.load_test --calls 1,10,25,50 --duration 20
+"""
+
+import argparse
+import asyncio
+import base64
+import importlib
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import count
+
+import httpx
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+from api.audio_stream.twilio_call import FRAME_BYTES, FRAME_DURATION
+from api.utils.task import Task, TaskStatus
+from api.utils.usage import UsageRecord
+
+CALLER_TO_AGENT = "caller -> agent"
+AGENT_TO_CALLER = "agent -> caller"
+
+# Frames are tagged with the call, direction and a sequence number, which is how
+# they are recognized on the other side. The rest is mu-law silence.
+_TAG = struct.Struct(">4sIBI")
+_SILENCE = b"\xff"
+_FRAME_SECONDS = FRAME_DURATION.total_seconds()
+# Audio still in flight when a call ends is not counted as dropped.
+_SETTLE_SECONDS = 0.5
+# The agent's side of each turn.
+_AGENT_CHUNK_FRAMES = 10
+_AGENT_CHUNKS_PER_TURN = 5
+_PAUSE_SECONDS = 0.5
+# Every this many turns, the agent is interrupted halfway through.
+_INTERRUPT_EVERY = 3
+# Settings the API requires, which the load test doesn't use.
+_REQUIRED_SETTINGS = [
+    "GEMINI_API_KEY",
+    "GOOGLE_MAPS_API_KEY",
+    "ELEVENLABS_API_KEY",
+    "ELEVENLABS_AGENT_ID",
+    "TWILIO_ACCOUNT_SID",
+    "TWILIO_AUTH_TOKEN",
+    "MONGODB_URI",
+    "FASTAPI_RAW_DOMAIN",
+]
+
+
+class InMemoryTaskStore:
+    """
+    Stands in for MongoDB on the call path. Every task id is a task, so that
+    simulated calls can make up their own.
+    """
+
+    def __init__(self):
+        self.tasks: dict[str, dict] = {}
+
+    def _task(self, task_id: str) -> dict:
+        return self.tasks.setdefault(
+            task_id,
+            {
+                "task": Task(
+                    business_name="Load Test",
+                    business_phone_number="+10000000000",
+                    task=f"Load test call {task_id}",
+                ),
+                "status": TaskStatus.CREATED,
+                "updates": [],
+                "usage": [],
+            },
+        )
+
+    async def get_task(self, task_id: str) -> Task | None:
+        return self._task(task_id)["task"]
+
+    async def update_task_progress(
+        self,
+        task_id: str,
+        *,
+        message: dict[str, str] = {},
+        task_status: TaskStatus | None = None,
+    ):
+        task = self._task(task_id)
+        if message:
+            task["updates"].append({"message": message, "timestamp": datetime.now()})
+        if task_status:
+            task["status"] = task_status
+
+    async def update_transcript_segment(self, task_id: str, segment: str, text: str):
+        for update in self._task(task_id)["updates"]:
+            if update["message"].get("segment") == segment:
+                update["message"]["value"] = text
+
+    async def add_usage(self, task_id: str, records: list[UsageRecord]):
+        self._task(task_id)["usage"].extend(records)
+
+
+def _frame(call: int, direction: int, seq: int) -> bytes:
+    tag = _TAG.pack(b"LOAD", call, direction, seq)
+    return tag + _SILENCE * (FRAME_BYTES - len(tag))
+
+
+def _frame_key(audio: bytes) -> bytes | None:
+    key = audio[: _TAG.size]
+    return key if key.startswith(b"LOAD") else None
+
+
+class _Probe:
+    """Times tagged frames from when they are sent until they arrive."""
+
+    def __init__(self):
+        # By key: direction, call and when it was sent.
+        self._in_flight: dict[bytes, tuple[str, int, float]] = {}
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self._ended_at: dict[int, float] = {}
+
+    def sent(self, direction: str, call: int, key: bytes):
+        self._in_flight[key] = (direction, call, time.perf_counter())
+
+    def received(self, key: bytes | None):
+        if key is None or (sent := self._in_flight.pop(key, None)) is None:
+            return
+        direction, _, sent_at = sent
+        self.latencies[direction].append(time.perf_counter() - sent_at)
+
+    def forget(self, keys: list[bytes]):
+        """Frames that are allowed not to arrive, e.g. cut off by interruptions."""
+        for key in keys:
+            self._in_flight.pop(key, None)
+
+    def call_ended(self, call: int):
+        self._ended_at.setdefault(call, time.perf_counter())
+
+    def dropped(self) -> dict[str, int]:
+        dropped = {CALLER_TO_AGENT: 0, AGENT_TO_CALLER: 0}
+        for direction, call, sent_at in self._in_flight.values():
+            ended_at = self._ended_at.get(call, time.perf_counter())
+            if sent_at < ended_at - _SETTLE_SECONDS:
+                dropped[direction] += 1
+        return dropped
+
+
+class FakeElevenLabsAgent:
+    """
+    A local stand-in for the ElevenLabs conversation websocket. For each call, the
+    agent takes turns talking (in real time) and listening for `duration`, with
+    transcripts, pings and the odd interruption, then ends the call with the
+    `task_complete` client tool. Set `probe` before each load level.
+    """
+
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.probe = _Probe()
+        self._calls = count()
+        self._server = None
+
+    async def start(self, port: int):
+        self._server = await websockets.serve(self._converse, "127.0.0.1", port)
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _converse(self, ws):
+        call = next(self._calls)
+        probe = self.probe
+        # conversation_initiation_client_data
+        await ws.recv()
+        await _send(
+            ws,
+            "conversation_initiation_metadata",
+            {"conversation_id": f"load-test-{call}"},
+        )
+        listening = asyncio.create_task(self._listen(ws, probe))
+        try:
+            await self._talk(ws, call, probe)
+            await listening
+        except ConnectionClosed:
+            pass
+        finally:
+            listening.cancel()
+
+    async def _listen(self, ws, probe: _Probe):
+        async for raw_msg in ws:
+            message = json.loads(raw_msg)
+            if "user_audio_chunk" in message:
+                audio = base64.b64decode(message["user_audio_chunk"])
+                probe.received(_frame_key(audio))
+
+    async def _talk(self, ws, call: int, probe: _Probe):
+        event_ids = count(1)
+        seq = count()
+        ends_at = time.monotonic() + self.duration
+        for turn in count(1):
+            if time.monotonic() >= ends_at:
+                break
+            await _send(
+                ws,
+                "user_transcript",
+                {"user_transcript": f"Caller turn {turn}."},
+                "user_transcription_event",
+            )
+            interrupted = turn % _INTERRUPT_EVERY == 0
+            chunks = (
+                _AGENT_CHUNKS_PER_TURN // 2 if interrupted else _AGENT_CHUNKS_PER_TURN
+            )
+            keys = []
+            next_at = time.monotonic()
+            for _ in range(chunks):
+                first = _frame(call, 1, next(seq))
+                keys.append(_frame_key(first))
+                probe.sent(AGENT_TO_CALLER, call, keys[-1])
+                audio = first + _SILENCE * FRAME_BYTES * (_AGENT_CHUNK_FRAMES - 1)
+                await _send(
+                    ws,
+                    "audio",
+                    {
+                        "audio_base_64": base64.b64encode(audio).decode(),
+                        "event_id": next(event_ids),
+                    },
+                )
+                # Audio is generated about as fast as it plays.
+                next_at += _AGENT_CHUNK_FRAMES * _FRAME_SECONDS
+                await asyncio.sleep(next_at - time.monotonic())
+            if interrupted:
+                # What hasn't played yet is cleared.
+                probe.forget(keys)
+                await _send(ws, "interruption", {"event_id": next(event_ids)})
+            else:
+                await _send(ws, "agent_response", {"agent_response": f"Turn {turn}."})
+            await _send(ws, "ping", {"event_id": next(event_ids), "ping_ms": 0})
+            await asyncio.sleep(_PAUSE_SECONDS)
+        await _send(
+            ws,
+            "client_tool_call",
+            {
+                "tool_name": "task_complete",
+                "tool_call_id": f"load-test-{call}",
+                "parameters": {},
+            },
+            "client_tool_call",
+        )
+
+
+async def _send(ws, msg_type: str, event: dict, event_key: str | None = None):
+    """Sends an ElevenLabs message, whose event is under `<type>_event` by default."""
+    await ws.send(
+        json.dumps({"type": msg_type, event_key or f"{msg_type}_event": event})
+    )
+
+
+class SimulatedTwilioCall:
+    """
+    A Twilio media stream client: streams caller audio in real time, plays the
+    audio it receives at its real rate, and echoes marks once they have played,
+    like Twilio does.
+    """
+
+    def __init__(self, url: str, call: int, probe: _Probe):
+        self.url = url
+        self.call = call
+        self.probe = probe
+        self.stream_sid = f"MZload{call}"
+        self._playout_end = 0.0
+        self._marks: list[tuple[float, str]] = []
+
+    async def run(self):
+        async with websockets.connect(self.url) as ws:
+            await ws.send(json.dumps({"event": "connected", "protocol": "Call"}))
+            await ws.send(
+                json.dumps(
+                    {
+                        "event": "start",
+                        "streamSid": self.stream_sid,
+                        "start": {"streamSid": self.stream_sid},
+                    }
+                )
+            )
+            receiving = asyncio.create_task(self._receive(ws))
+            streaming = asyncio.create_task(self._stream(ws))
+            try:
+                await receiving
+            finally:
+                self.probe.call_ended(self.call)
+                streaming.cancel()
+
+    async def _stream(self, ws):
+        next_at = time.monotonic()
+        for seq in count():
+            frame = _frame(self.call, 0, seq)
+            self.probe.sent(CALLER_TO_AGENT, self.call, _frame_key(frame))
+            await ws.send(
+                json.dumps(
+                    {
+                        "event": "media",
+                        "streamSid": self.stream_sid,
+                        "media": {"payload": base64.b64encode(frame).decode()},
+                    }
+                )
+            )
+            self._echo_played_marks(ws)
+            next_at += _FRAME_SECONDS
+            await asyncio.sleep(next_at - time.monotonic())
+
+    async def _receive(self, ws):
+        try:
+            async for raw_msg in ws:
+                message = json.loads(raw_msg)
+                if message["event"] == "media":
+                    audio = base64.b64decode(message["media"]["payload"])
+                    self.probe.received(_frame_key(audio))
+                    self._playout_end = (
+                        max(self._playout_end, time.monotonic())
+                        + len(audio) / FRAME_BYTES * _FRAME_SECONDS
+                    )
+                elif message["event"] == "mark":
+                    self._marks.append((self._playout_end, message["mark"]["name"]))
+                elif message["event"] == "clear":
+                    # Pending marks are echoed right away.
+                    self._playout_end = 0.0
+                    self._marks = [(0.0, name) for _, name in self._marks]
+                    self._echo_played_marks(ws)
+        except ConnectionClosed:
+            pass
+
+    def _echo_played_marks(self, ws):
+        now = time.monotonic()
+        while self._marks and self._marks[0][0] <= now:
+            _, name = self._marks.pop(0)
+            asyncio.create_task(
+                ws.send(
+                    json.dumps(
+                        {
+                            "event": "mark",
+                            "streamSid": self.stream_sid,
+                            "mark": {"name": name},
+                        }
+                    )
+                )
+            )
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class LoadLevel:
+    calls: int
+    wall_seconds: float
+    # Server process CPU time over wall time, so 1.0 is one core fully busy.
+    server_cpu_utilization: float
+    client_cpu_utilization: float
+    dropped: dict[str, int] = field(default_factory=dict)
+    # Latencies in seconds, by direction.
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    failed_calls: int = 0
+
+    def format(self) -> str:
+        lines = [
+            f"{self.calls} calls: {self.wall_seconds:.1f}s, server CPU "
+            f"{self.server_cpu_utilization:.1%} of a core "
+            f"({self.server_cpu_utilization / self.calls:.2%} per call), "
+            f"load generator CPU {self.client_cpu_utilization:.1%}, "
+            f"{self.failed_calls} failed calls"
+        ]
+        for direction in (CALLER_TO_AGENT, AGENT_TO_CALLER):
+            values = self.latencies.get(direction, [])
+            latency = (
+                f"p50 {_percentile(values, 0.5) * 1000:.1f}ms, "
+                f"p99 {_percentile(values, 0.99) * 1000:.1f}ms"
+                if values
+                else "no frames"
+            )
+            lines.append(
+                f"  {direction}: {len(values)} frames, {latency}, "
+                f"{self.dropped.get(direction, 0)} dropped"
+            )
+        return "\n".join(lines)
+
+
+async def _server_cpu_seconds(http: httpx.AsyncClient) -> float:
+    response = await http.get("/metrics")
+    for line in response.text.splitlines():
+        if line.startswith("process_cpu_seconds_total "):
+            return float(line.split()[1])
+    raise RuntimeError("The API does not report process_cpu_seconds_total")
+
+
+async def run_level(
+    api_url: str, http: httpx.AsyncClient, agent: FakeElevenLabsAgent, calls: int
+) -> LoadLevel:
+    """Runs `calls` simulated calls at once against the API at `api_url`."""
+    probe = agent.probe = _Probe()
+    server_cpu_started_at = await _server_cpu_seconds(http)
+    cpu_started_at = time.process_time()
+    started_at = time.monotonic()
+    results = await asyncio.gather(
+        *(
+            SimulatedTwilioCall(
+                f"{api_url}/task-stream/{_task_id(call)}", call, probe
+            ).run()
+            for call in range(calls)
+        ),
+        return_exceptions=True,
+    )
+    wall_seconds = time.monotonic() - started_at
+    cpu_seconds = time.process_time() - cpu_started_at
+    server_cpu_seconds = await _server_cpu_seconds(http) - server_cpu_started_at
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.error(f"Simulated call failed: {result!r}")
+    return LoadLevel(
+        calls=calls,
+        wall_seconds=wall_seconds,
+        server_cpu_utilization=server_cpu_seconds / wall_seconds,
+        client_cpu_utilization=cpu_seconds / wall_seconds,
+        dropped=probe.dropped(),
+        latencies=dict(probe.latencies),
+        failed_calls=sum(isinstance(result, BaseException) for result in results),
+    )
+
+
+def _task_id(call: int) -> str:
+    # Any 24 hex digits make a valid ObjectId.
+    return f"{time.time_ns() % 16**16:016x}{call:08x}"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def serve(port: int):
+    """Serves the API without MongoDB or provider clients, for load tests."""
+    import uvicorn
+
+    from api import index
+    from api.utils.admission import CallAdmissionController
+
+    async def import_call_modules():
+        await asyncio.to_thread(importlib.import_module, "api.utils.twilio_phone_call")
+
+    index.mongodb_client = InMemoryTaskStore()
+    index.admission_controller = CallAdmissionController()
+    await index.admission_controller.start()
+    starting = asyncio.create_task(
+        index.readiness.run("providers", import_call_modules())
+    )
+    config = uvicorn.Config(
+        index.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"
+    )
+    try:
+        await uvicorn.Server(config).serve()
+    finally:
+        starting.cancel()
+        await index.admission_controller.close()
+
+
+async def _wait_until_ready(http: httpx.AsyncClient, server, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.returncode is not None:
+            raise RuntimeError("The API exited while starting")
+        try:
+            response = await http.get("/api/health")
+            if response.json()["components"].get("providers") == "ready":
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("The API did not start")
+
+
+async def load_test(
+    levels: list[int], duration: float, verbose: bool = False
+) -> list[LoadLevel]:
+    """Runs each level in turn, against one API subprocess."""
+    agent_port = _free_port()
+    api_port = _free_port()
+    env = {name: "load-test" for name in _REQUIRED_SETTINGS}
+    env.update(os.environ)
+    env.update(
+        {
+            "ELEVENLABS_CONVERSATION_URL": f"ws://127.0.0.1:{agent_port}",
+            "CALL_PROVIDER": "elevenlabs",
+            "CALL_TRACES_DIR": "",
+            "RECORDINGS_DIR": "",
+        }
+    )
+    agent = FakeElevenLabsAgent(duration)
+    await agent.start(agent_port)
+    server = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "api.audio_stream.load_test",
+        "--serve",
+        str(api_port),
+        *(["--verbose"] if verbose else []),
+        env=env,
+    )
+    results = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}") as http:
+            await _wait_until_ready(http, server)
+            for calls in levels:
+                result = await run_level(
+                    f"ws://127.0.0.1:{api_port}", http, agent, calls
+                )
+                print(result.format(), flush=True)
+                results.append(result)
+    finally:
+        server.terminate()
+        await server.wait()
+        await agent.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--calls",
+        default="1,5,10,20",
+        help="Comma-separated numbers of concurrent calls to run, one level each.",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=15, help="Seconds each call lasts."
+    )
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.serve is not None:
+        asyncio.run(serve(args.serve))
+        return
+    levels = [int(calls) for calls in args.calls.split(",")]
+    asyncio.run(load_test(levels, args.duration, args.verbose))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import asyncio
 import audioop
 import logging
 from dataclasses import dataclass
+from datetime import timedelta
 from typing import override
 
 import pyaudio
@@ -10,21 +11,91 @@ from google.genai.types import Blob
 from api.audio_stream.stream_data import StreamData
 from api.audio_stream.stream_operator import StreamOperator
 
+# Audio is 16-bit PCM locally, and mu-law on the wire.
+_SAMPLE_WIDTH = 2
+
 
 @dataclass
 class SpeakerMicConfig:
     mic_sample_rate: int = 8000
     speaker_sample_rate: int = 8000
-    mic_frames_per_buffer: int = 4000
-    speaker_frames_per_buffer: int = 1000
+    # 20ms, the frame size of phone calls, so that local calls see the same
+    # latency as calls over Twilio.
+    mic_frames_per_buffer: int = 160
+    speaker_frames_per_buffer: int = 160
     channels: int = 1
     audio_format: int = pyaudio.paInt16
+    # How much audio the buffers between the audio callbacks and the event loop
+    # hold. The speaker's is larger, since agents send audio ahead of time.
+    mic_buffer_duration: timedelta = timedelta(seconds=1)
+    speaker_buffer_duration: timedelta = timedelta(seconds=30)
+
+
+class ByteRing:
+    """
+    A fixed-size byte ring with one producer and one consumer, e.g. an audio
+    callback thread and the event loop. The producer only moves `_head` and the
+    consumer only moves `_tail`, so neither needs a lock or ever blocks.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._view = memoryview(bytearray(capacity))
+        # Total bytes ever written and read. Their difference is the fill.
+        self._head = 0
+        self._tail = 0
+
+    def available(self) -> int:
+        return self._head - self._tail
+
+    @property
+    def written(self) -> int:
+        """Total bytes ever written, i.e. the position of the next write."""
+        return self._head
+
+    def write(self, data: bytes) -> int:
+        """Copies in as much of `data` as fits. Returns how much that was."""
+        size = min(len(data), self._capacity - (self._head - self._tail))
+        start = self._head % self._capacity
+        first = min(size, self._capacity - start)
+        source = memoryview(data)
+        self._view[start : start + first] = source[:first]
+        if first < size:
+            self._view[: size - first] = source[first:size]
+        self._head += size
+        return size
+
+    def read_into(self, out: memoryview) -> int:
+        """Fills as much of `out` as there is data for. Returns how much that was."""
+        size = min(len(out), self._head - self._tail)
+        start = self._tail % self._capacity
+        first = min(size, self._capacity - start)
+        out[:first] = self._view[start : start + first]
+        if first < size:
+            out[first:size] = self._view[: size - first]
+        self._tail += size
+        return size
+
+    def discard_until(self, position: int):
+        """
+        Drops what was written before `position` (see `written`) and not read yet.
+        Only the consumer may call this.
+        """
+        self._tail = max(self._tail, min(position, self._head))
 
 
 class LocalSpeakerMicOperator(StreamOperator):
     """
     `Send` sends audio to the local speaker.
     `Receive` receives audio from the local microphone.
+
+    Both streams run in PyAudio's callback mode, and exchange audio with the event
+    loop through ring buffers, so neither direction hands off to a thread per
+    chunk. The mic callback wakes the event loop at most once per batch of
+    buffers.
+
+    `pya` defaults to a real PyAudio. Pass a `FakePyAudio` (see fake_pyaudio.py)
+    to run without audio devices.
     """
 
     speakermic_config: SpeakerMicConfig
@@ -36,12 +107,47 @@ class LocalSpeakerMicOperator(StreamOperator):
         self,
         config: SpeakerMicConfig = SpeakerMicConfig(),
         out_queue_max_size: int = 5,
+        pya: pyaudio.PyAudio | None = None,
     ):
         super().__init__("localspeakermic", out_queue_max_size)
         self.speakermic_config = config
-        self.pya = pyaudio.PyAudio()
+        self.pya = pya or pyaudio.PyAudio()
         self.loop = asyncio.get_running_loop()
 
+        mic_bytes_per_second = config.mic_sample_rate * config.channels * _SAMPLE_WIDTH
+        self._mic_ring = ByteRing(
+            int(config.mic_buffer_duration.total_seconds() * mic_bytes_per_second)
+        )
+        self._mic_chunk = memoryview(
+            bytearray(config.mic_frames_per_buffer * config.channels * _SAMPLE_WIDTH)
+        )
+        self._mic_ready = asyncio.Event()
+        # Set by the mic callback when it asks the event loop to drain the ring,
+        # and cleared by the event loop before it does.
+        self._mic_wakeup_pending = False
+        self.mic_dropped_bytes = 0
+
+        speaker_bytes_per_second = (
+            config.speaker_sample_rate * config.channels * _SAMPLE_WIDTH
+        )
+        self._speaker_ring = ByteRing(
+            int(
+                config.speaker_buffer_duration.total_seconds()
+                * speaker_bytes_per_second
+            )
+        )
+        self._speaker_out = memoryview(
+            bytearray(
+                config.speaker_frames_per_buffer * config.channels * _SAMPLE_WIDTH
+            )
+        )
+        self._speaker_silence = memoryview(bytes(len(self._speaker_out)))
+        # Set on interruptions to what was queued for the speaker by then, which
+        # the speaker callback then drops.
+        self._speaker_flush_until = 0
+        self.speaker_dropped_bytes = 0
+        self.speaker_underruns = 0
+
     @override
     async def initialize(self):
         assert self.input_stream is None, "Was this class initialized already?"
@@ -65,36 +171,80 @@ class LocalSpeakerMicOperator(StreamOperator):
             rate=self.speakermic_config.speaker_sample_rate,
             output=True,
             frames_per_buffer=self.speakermic_config.speaker_frames_per_buffer,
+            stream_callback=self._output_stream_callback,
         )
 
     @override
     async def send_task(self):
         while not self.stop_event.is_set():
             stream_data = await self.get_from_send_queue()
-            if stream_data is None or stream_data.blob is None:
+            if stream_data is None:
                 continue
-            await asyncio.to_thread(
-                self.output_stream.write,
-                audioop.ulaw2lin(stream_data.blob.data, 2),
-            )
+            if stream_data.interrupt:
+                self._speaker_flush_until = self._speaker_ring.written
+                continue
+            if stream_data.blob is None:
+                continue
+            pcm = audioop.ulaw2lin(stream_data.blob.data, _SAMPLE_WIDTH)
+            written = self._speaker_ring.write(pcm)
+            self.speaker_dropped_bytes += len(pcm) - written
 
     @override
     async def receive_task(self):
-        pass
+        while not self.stop_event.is_set():
+            await self.wait_respecting_shutdown(
+                asyncio.create_task(self._mic_ready.wait())
+            )
+            if not self._mic_ready.is_set():
+                continue
+            self._mic_ready.clear()
+            # Before draining, so that audio written after this wakes us again.
+            self._mic_wakeup_pending = False
+            while self._mic_ring.available() >= len(self._mic_chunk):
+                self._mic_ring.read_into(self._mic_chunk)
+                await self.receive_queue.put(
+                    StreamData(
+                        originator=self.name,
+                        blob=Blob(
+                            data=audioop.lin2ulaw(self._mic_chunk, _SAMPLE_WIDTH),
+                            mime_type="audio/pcm",
+                        ),
+                    )
+                )
 
     @override
     async def close(self):
-        logging.info("Closing local speakermic operator")
+        logging.info(
+            f"Closing local speakermic operator. Dropped {self.mic_dropped_bytes} "
+            f"bytes of mic and {self.speaker_dropped_bytes} bytes of speaker audio, "
+            f"{self.speaker_underruns} speaker underruns"
+        )
         self.input_stream.stop_stream()
         self.input_stream.close()
+        self.output_stream.stop_stream()
         self.output_stream.close()
 
     def _input_stream_callback(self, in_data, _frame_count, _time_info, _status):
         if self.stop_event.is_set():
             return (None, pyaudio.paComplete)
-        stream_data = StreamData(
-            originator=self.name,
-            blob=Blob(data=audioop.lin2ulaw(in_data, 2), mime_type="audio/pcm"),
-        )
-        self.loop.call_soon_threadsafe(self.receive_queue.put_nowait, stream_data)
+        written = self._mic_ring.write(in_data)
+        self.mic_dropped_bytes += len(in_data) - written
+        if not self._mic_wakeup_pending:
+            self._mic_wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._mic_ready.set)
         return (None, pyaudio.paContinue)
+
+    def _output_stream_callback(self, _in_data, frame_count, _time_info, _status):
+        self._speaker_ring.discard_until(self._speaker_flush_until)
+        size = frame_count * self.speakermic_config.channels * _SAMPLE_WIDTH
+        if size > len(self._speaker_out):
+            self._speaker_out = memoryview(bytearray(size))
+            self._speaker_silence = memoryview(bytes(size))
+        out = self._speaker_out[:size]
+        read = self._speaker_ring.read_into(out)
+        if read < size:
+            # Nothing (more) to play, so play silence.
+            out[read:] = self._speaker_silence[: size - read]
+            if read:
+                self.speaker_underruns += 1
+        return (bytes(out), pyaudio.paContinue)
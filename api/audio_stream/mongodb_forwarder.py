@@ -1,9 +1,29 @@
+import logging
+import time
+from datetime import timedelta
 from typing import override
 
+from bson import ObjectId
+
+from api.audio_stream.stream_data import StreamData
 from api.audio_stream.stream_operator import StreamOperator
+from api.audio_stream.transcript_segmenter import (
+    TranscriptSegment,
+    TranscriptSegmenter,
+)
+from api.utils.metrics import REGISTRY
 from api.utils.mongodb import MongoDB
 from api.utils.task import TaskStatus
 
+_fragments = REGISTRY.counter(
+    "transcript_fragments_total",
+    "Transcription fragments and corrections received from voice agents.",
+)
+_segment_writes = REGISTRY.counter(
+    "transcript_segment_writes_total",
+    "Transcript segments added to or updated in tasks.",
+)
+
 
 class MongoDBForwarder(StreamOperator):
     """
@@ -14,12 +34,29 @@ class MongoDBForwarder(StreamOperator):
     - output_transcription_correction
     - status
     `Receive` is a noop.
+
+    Transcriptions are merged into segments, one per speaker turn (see
+    TranscriptSegmenter), before they are stored. Each segment is one update,
+    tagged with a "segment" key, whose value is rewritten in place as the segment
+    grows or is corrected, at most every `flush_after`. Pass the voice agent's
+    `transcript_separator`, so that its fragments are joined the way it sends them.
     """
 
-    def __init__(self, task_id: str, mongodb_client: MongoDB):
+    def __init__(
+        self,
+        task_id: str,
+        mongodb_client: MongoDB,
+        flush_after: timedelta = timedelta(milliseconds=500),
+        transcript_separator: str = "",
+    ):
         super().__init__("mongodb_forwarder")
         self.task_id = task_id
         self.mongodb_client = mongodb_client
+        self.segmenter = TranscriptSegmenter(flush_after, transcript_separator)
+        # The "segment" key of each stored segment, by its index.
+        self._segment_keys: dict[int, str] = {}
+        self.fragments = 0
+        self.writes = 0
 
     @override
     async def initialize(self):
@@ -33,34 +70,60 @@ class MongoDBForwarder(StreamOperator):
     @override
     async def send_task(self):
         while not self.stop_event.is_set():
-            stream_data = await self.get_from_send_queue()
-            if stream_data is None:
-                continue
+            deadline = self.segmenter.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            stream_data = await self.get_from_send_queue(timeout)
+            if stream_data is not None:
+                await self._segment(stream_data)
+            await self._write(self.segmenter.due())
 
-            if stream_data.input_transcription:
+    async def _segment(self, stream_data: StreamData):
+        if stream_data.input_transcription:
+            self._count_fragment()
+            self.segmenter.add("input_transcript", stream_data.input_transcription)
+        if stream_data.output_transcription:
+            self._count_fragment()
+            self.segmenter.add("output_transcript", stream_data.output_transcription)
+        if correction := stream_data.output_transcription_correction:
+            self._count_fragment()
+            if not self.segmenter.correct(correction.original, correction.corrected):
+                # Stored as is, for lack of anything to correct.
                 await self.mongodb_client.update_task_progress(
                     task_id=self.task_id,
                     message={
-                        "type": "input_transcript",
-                        "value": stream_data.input_transcription,
+                        "type": "output_transcript_correction",
+                        "value": correction.corrected,
                     },
                 )
-            if stream_data.output_transcription:
+
+    def _count_fragment(self):
+        self.fragments += 1
+        _fragments.inc()
+
+    async def _write(self, segments: list[TranscriptSegment]):
+        for segment in segments:
+            if segment.text == segment.flushed_text:
+                # Changed back, e.g. by a correction.
+                self.segmenter.flushed(segment)
+                continue
+            if segment.index not in self._segment_keys:
+                key = str(ObjectId())
                 await self.mongodb_client.update_task_progress(
                     task_id=self.task_id,
                     message={
-                        "type": "output_transcript",
-                        "value": stream_data.output_transcription,
+                        "type": segment.kind,
+                        "value": segment.text,
+                        "segment": key,
                     },
                 )
-            if stream_data.output_transcription_correction:
-                await self.mongodb_client.update_task_progress(
-                    task_id=self.task_id,
-                    message={
-                        "type": "output_transcript_correction",
-                        "value": stream_data.output_transcription_correction,
-                    },
+                self._segment_keys[segment.index] = key
+            else:
+                await self.mongodb_client.update_transcript_segment(
+                    self.task_id, self._segment_keys[segment.index], segment.text
                 )
+            self.segmenter.flushed(segment)
+            self.writes += 1
+            _segment_writes.inc()
 
     @override
     async def receive_task(self):
@@ -68,6 +131,10 @@ class MongoDBForwarder(StreamOperator):
 
     @override
     async def close(self):
+        await self._write(self.segmenter.pending())
+        logging.info(
+            f"Stored {self.fragments} transcription fragments in {self.writes} writes"
+        )
         await self.mongodb_client.update_task_progress(
             task_id=self.task_id, task_status=TaskStatus.FINISHED
         )
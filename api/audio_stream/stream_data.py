@@ -23,3 +23,6 @@ class StreamData:
 
     # TODO: This needs to be wired.
     force_end_call: bool = False
+    # The originator was interrupted, so audio it sent earlier that has not been
+    # played yet should be dropped.
+    interrupt: bool = False
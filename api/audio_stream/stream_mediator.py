@@ -1,28 +1,81 @@
 import asyncio
 import logging
 import traceback
+import weakref
+from typing import Iterable
 
 import aiostream
 
 from api.audio_stream.stream_operator import StreamOperator
+from api.utils.metrics import REGISTRY, Sample
+
+_running: weakref.WeakSet["StreamMediator"] = weakref.WeakSet()
+
+_forwarded = REGISTRY.counter(
+    "stream_mediator_forwarded_total",
+    "Stream data forwarded between operators, by originating operator.",
+)
+
+
+def _collect_running() -> Iterable[Sample]:
+    yield Sample({}, len(_running))
+
+
+def _collect_queue_depths(aggregate) -> Iterable[Sample]:
+    depths: dict[tuple[str, str], list[int]] = {}
+    for mediator in list(_running):
+        for op in mediator.operators:
+            depths.setdefault((op.name, "send"), []).append(op.send_queue.qsize())
+            depths.setdefault((op.name, "receive"), []).append(op.receive_queue.qsize())
+    for (operator, queue), sizes in depths.items():
+        yield Sample({"operator": operator, "queue": queue}, aggregate(sizes))
+
+
+REGISTRY.collected(
+    "stream_mediators_running", "Stream mediators (calls) running.", _collect_running
+)
+REGISTRY.collected(
+    "stream_operator_queue_depth",
+    "Items waiting in operator queues, summed over running mediators.",
+    lambda: _collect_queue_depths(sum),
+)
+REGISTRY.collected(
+    "stream_operator_queue_depth_max",
+    "Deepest operator queue across running mediators.",
+    lambda: _collect_queue_depths(max),
+)
+
+
+def running_mediator(task_id: str) -> "StreamMediator | None":
+    """The running mediator of the call for `task_id`, if there is one."""
+    for mediator in list(_running):
+        if mediator.task_id == task_id:
+            return mediator
+    return None
 
 
 class StreamMediator:
     # Take in a list of "operator" classes, which implement a standard
     # send and receive interfaces.
     #
-    def __init__(self, operators: list[StreamOperator]):
+    def __init__(self, operators: list[StreamOperator], task_id: str | None = None):
         """Initialize with a list of stream operators that will send/receive data.
 
         Args:
             operators: List of StreamOperator instances to mediate between
+            task_id: The task whose call this is, if any
         """
         self.operators = operators
+        self.task_id = task_id
         self.tasks: list[asyncio.Task] = []
+        # The task that routes messages between operators, i.e. the one in `run`.
+        self.run_task: asyncio.Task | None = None
         self.stop_event = asyncio.Event()
 
     async def run(self):
         """Run all operator tasks and handle message routing between them."""
+        _running.add(self)
+        self.run_task = asyncio.current_task()
         # Start all send and receive tasks
         try:
             async with asyncio.TaskGroup() as tg:
@@ -53,6 +106,7 @@ class StreamMediator:
                                 logging.info("Setting stop_event for self")
                                 break
                             # Forward received data to all other operators
+                            _forwarded.inc(operator=stream_data.originator)
                             for op in self.operators:
                                 await op.send(stream_data)
 
@@ -66,6 +120,7 @@ class StreamMediator:
         except Exception as e:
             traceback.print_exception(e)
         finally:
+            _running.discard(self)
             logging.info("Into finally block")
             await asyncio.sleep(0.5)
             for op in self.operators:
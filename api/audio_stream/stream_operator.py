@@ -14,6 +14,11 @@ class StreamOperator:
     # Receive is an async generator (similar to session.receive()) that yields StreamData.
     # This represents the data/audio that the agent received and should
     # be forwarded to all other agents (via their send method).
+
+    # What goes between the transcription fragments this operator receives, see
+    # TranscriptSegmenter. Empty for fragments that may be cut within words.
+    transcript_separator = ""
+
     def __init__(self, name: str, out_queue_max_size: int = 5):
         self.name = name
         self.send_queue: asyncio.Queue[StreamData] = asyncio.Queue()
@@ -29,17 +34,23 @@ class StreamOperator:
     async def send_task(self):
         pass
 
-    async def wait_respecting_shutdown(self, t: asyncio.Task):
+    async def wait_respecting_shutdown(
+        self, t: asyncio.Task, timeout: float | None = None
+    ):
         _, pending = await asyncio.wait(
             [t, asyncio.create_task(self.stop_event.wait())],
+            timeout=timeout,
             return_when=asyncio.FIRST_COMPLETED,
         )
         for task in pending:
             task.cancel()
 
-    async def get_from_send_queue(self) -> StreamData | None:
+    async def get_from_send_queue(
+        self, timeout: float | None = None
+    ) -> StreamData | None:
+        """The next item to send, or None on shutdown or after `timeout` seconds."""
         t = asyncio.create_task(self.send_queue.get())
-        await self.wait_respecting_shutdown(t)
+        await self.wait_respecting_shutdown(t, timeout)
         if not t.done():
             return None
         return t.result()
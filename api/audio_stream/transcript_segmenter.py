@@ -0,0 +1,114 @@
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+# Closing punctuation that attaches to the text before it.
+_ATTACHED = ".,!?;:)'\""
+
+
+def _join(text: str, fragment: str, separator: str) -> str:
+    if not text:
+        return fragment.lstrip()
+    if text[-1].isspace() or fragment[:1].isspace() or fragment[:1] in _ATTACHED:
+        return text + fragment
+    return text + separator + fragment
+
+
+@dataclass
+class TranscriptSegment:
+    """One speaker's utterance, built up from transcription fragments."""
+
+    index: int
+    # "input_transcript" or "output_transcript", as stored in task updates.
+    kind: str
+    text: str = ""
+    # The text as last flushed, or None if it never was.
+    flushed_text: str | None = None
+    # When the text first changed after it was last flushed.
+    dirty_since: float | None = None
+
+    @property
+    def dirty(self) -> bool:
+        return self.dirty_since is not None
+
+
+class TranscriptSegmenter:
+    """
+    Merges transcription fragments into one segment per speaker turn, so that they
+    can be stored and displayed as utterances rather than one by one.
+
+    Fragments are joined with `separator`, unless there is whitespace between
+    them already. Agents that send fragments cut anywhere, even within words
+    (Gemini), need none, while ones that send whole utterances (ElevenLabs) need a
+    space, see StreamOperator.transcript_separator.
+
+    A segment is due to be flushed as soon as the other speaker starts a new one,
+    or at most `flush_after` after it changed, so that live displays still see it
+    grow. Corrections are applied to the segment they correct, which is then
+    flushed again.
+    """
+
+    def __init__(
+        self,
+        flush_after: timedelta = timedelta(milliseconds=500),
+        separator: str = "",
+    ):
+        self.flush_after = flush_after.total_seconds()
+        self.separator = separator
+        self.segments: list[TranscriptSegment] = []
+
+    def add(self, kind: str, fragment: str, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        if not self.segments or self.segments[-1].kind != kind:
+            self.segments.append(TranscriptSegment(len(self.segments), kind))
+        segment = self.segments[-1]
+        text = _join(segment.text, fragment, self.separator)
+        if text != segment.text:
+            segment.text = text
+            self._touch(segment, now)
+
+    def correct(self, original: str, corrected: str, now: float | None = None) -> bool:
+        """
+        Replaces the latest occurrence of `original` in the agent's segments.
+        Returns False if there is none.
+        """
+        now = time.monotonic() if now is None else now
+        for segment in reversed(self.segments):
+            if segment.kind != "output_transcript":
+                continue
+            start = segment.text.rfind(original)
+            if start == -1:
+                continue
+            segment.text = (
+                segment.text[:start] + corrected + segment.text[start + len(original) :]
+            )
+            self._touch(segment, now)
+            return True
+        return False
+
+    def _touch(self, segment: TranscriptSegment, now: float):
+        if segment.dirty_since is None:
+            segment.dirty_since = now
+
+    def pending(self) -> list[TranscriptSegment]:
+        """Segments that changed since they were last flushed."""
+        return [segment for segment in self.segments if segment.dirty]
+
+    def _deadline(self, segment: TranscriptSegment) -> float:
+        if segment.index < len(self.segments) - 1:
+            # The other speaker has moved on, so this segment won't grow anymore.
+            return segment.dirty_since
+        return segment.dirty_since + self.flush_after
+
+    def next_deadline(self) -> float | None:
+        """When the next segment is due to be flushed, if any has changed."""
+        return min(map(self._deadline, self.pending()), default=None)
+
+    def due(self, now: float | None = None) -> list[TranscriptSegment]:
+        """Changed segments whose deadline has passed."""
+        now = time.monotonic() if now is None else now
+        return [segment for segment in self.pending() if self._deadline(segment) <= now]
+
+    def flushed(self, segment: TranscriptSegment):
+        segment.flushed_text = segment.text
+        segment.dirty_since = None
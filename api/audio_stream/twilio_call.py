@@ -2,14 +2,66 @@ import asyncio
 import base64
 import json
 import logging
-from typing import override
+import time
+import weakref
+from contextlib import suppress
+from datetime import timedelta
+from typing import Iterable, override
 
 import websockets
 from fastapi import WebSocket
+from fastapi.websockets import WebSocketState
 from google.genai.types import Blob
 
+from api.audio_stream.call_trace import INBOUND, OUTBOUND, CallTrace
 from api.audio_stream.stream_data import StreamData
 from api.audio_stream.stream_operator import StreamOperator
+from api.utils.metrics import REGISTRY, Sample
+
+# Audio is mu-law at 8kHz, one byte per sample. Twilio plays it in 20ms frames.
+_AUDIO_BYTES_PER_SECOND = 8000
+FRAME_BYTES = 160
+FRAME_DURATION = timedelta(milliseconds=20)
+
+_live: weakref.WeakSet["TwilioCall"] = weakref.WeakSet()
+
+
+def _collect_playback_lag() -> Iterable[Sample]:
+    yield Sample({}, max((call.playback_lag for call in list(_live)), default=0))
+
+
+def _collect_max_drift() -> Iterable[Sample]:
+    yield Sample({}, max((call.max_drift for call in list(_live)), default=0))
+
+
+REGISTRY.collected(
+    "twilio_playback_lag_seconds",
+    "Audio sent to Twilio but not played yet, in the call that is furthest behind.",
+    _collect_playback_lag,
+)
+_clears = REGISTRY.counter(
+    "twilio_clears_total", "Twilio audio buffers cleared because of interruptions."
+)
+_cleared_audio = REGISTRY.counter(
+    "twilio_cleared_audio_seconds_total",
+    "Audio sent to Twilio that was never played because of interruptions.",
+)
+REGISTRY.collected(
+    "twilio_egress_max_drift_seconds",
+    "How late a paced audio frame was released, at worst, in the live calls.",
+    _collect_max_drift,
+)
+_frames_sent = REGISTRY.counter(
+    "twilio_egress_frames_total", "Audio frames sent to Twilio."
+)
+_drift = REGISTRY.counter(
+    "twilio_egress_drift_seconds_total",
+    "How late paced audio frames were released, summed.",
+)
+_underruns = REGISTRY.counter(
+    "twilio_egress_underruns_total",
+    "Audio frames released too late to play without a gap.",
+)
 
 
 class TwilioCall(StreamOperator):
@@ -17,7 +69,21 @@ class TwilioCall(StreamOperator):
     `Send` sends audio to Twilio.
     `Receive` receives audio from Twilio.
 
-    This class does not own `ws`, and therefore WILL NOT close it when it is done.
+    `ws` is closed when the call is done, since Twilio only ends the call once the
+    stream closes.
+    If `trace` is set, every message sent and received is recorded to it.
+
+    Audio is sent in 20ms frames, paced to the rate Twilio plays them, so that no
+    more than `lead` of it is buffered by Twilio. The rest waits here, where an
+    interruption can drop it. Every audio chunk sent is followed by a mark, which
+    Twilio echoes once the chunk has played, so that we know how far playback is
+    behind what was sent. When the other side is interrupted, Twilio is told to
+    clear the audio it has buffered.
+
+    When the call is ended (e.g. the agent called `task_complete` right after
+    saying goodbye), the audio still waiting here is sent on close, and the close
+    waits for Twilio to play it, for at most `max_play_out`.
+
     Overall specs:
       * https://www.twilio.com/docs/voice/media-streams/websocket-messages
       * https://www.twilio.com/docs/voice/media-streams
@@ -33,16 +99,51 @@ class TwilioCall(StreamOperator):
     def __init__(
         self,
         ws: WebSocket,
+        trace: CallTrace | None = None,
+        lead: timedelta = timedelta(milliseconds=100),
+        max_play_out: timedelta = timedelta(seconds=10),
     ):
         super().__init__(
             "twilio_call",
         )
         self.ws = ws
+        self.trace = trace
         self.stream_sid = None
+        self._sent_bytes = 0
+        self._played_bytes = 0
+        self._next_mark = 0
+        # Marks not echoed yet, with the bytes sent up to them, in the order sent.
+        self._marks: dict[str, int] = {}
+        self.max_playback_lag = 0.0
+        self.clears = 0
+        self.cleared_bytes = 0
+        self.lead = max(lead, FRAME_DURATION).total_seconds()
+        self.max_play_out = max_play_out.total_seconds()
+        # The rest of the chunk that was being sent when the call was ended.
+        self._unsent = b""
+        # Set on close, so that the remaining audio is sent despite `stop_event`.
+        self._playing_out = False
+        # When the audio sent so far will have played, if Twilio plays it as soon
+        # as it can.
+        self._playout_end = 0.0
+        # Bumped on every interruption, so that a chunk being sent stops.
+        self._interrupts = 0
+        self.frames_sent = 0
+        self.paced_frames = 0
+        self.total_drift = 0.0
+        self.max_drift = 0.0
+        self.underruns = 0
+
+    @property
+    def playback_lag(self) -> float:
+        """Seconds of audio sent to Twilio that have not been played yet."""
+        return (self._sent_bytes - self._played_bytes) / _AUDIO_BYTES_PER_SECOND
 
     @override
     async def initialize(self):
         async for raw_msg in self.ws.iter_text():
+            if self.trace:
+                self.trace.record(self.name, INBOUND, raw_msg)
             message = json.loads(raw_msg)
             # https://www.twilio.com/docs/voice/media-streams/websocket-messages#connected-message
             if message["event"] == "connected":
@@ -50,27 +151,39 @@ class TwilioCall(StreamOperator):
             # https://www.twilio.com/docs/voice/media-streams/websocket-messages#start-message
             elif message["event"] == "start":
                 self.stream_sid = message["start"]["streamSid"]
+                _live.add(self)
                 break
             else:
                 logging.error(f"Received unexpected message: {message}")
         assert self.stream_sid is not None
 
+    @override
+    async def send(self, stream_data: StreamData):
+        if stream_data.interrupt and stream_data.originator != self.name:
+            # Audio still queued here would only be cleared after it was sent.
+            self._interrupts += 1
+            while not self.send_queue.empty():
+                self.send_queue.get_nowait()
+        await super().send(stream_data)
+
+    async def _send_json(self, message: dict):
+        if self.trace:
+            self.trace.record(self.name, OUTBOUND, json.dumps(message))
+        await self.ws.send_json(message)
+
     @override
     async def send_task(self):
         try:
             while not self.stop_event.is_set():
                 stream_data = await self.get_from_send_queue()
-                if stream_data is None or stream_data.blob is None:
+                if stream_data is None:
                     continue
-                await self.ws.send_json(
-                    {
-                        "event": "media",
-                        "streamSid": self.stream_sid,
-                        "media": {
-                            "payload": base64.b64encode(stream_data.blob.data).decode()
-                        },
-                    }
-                )
+                if stream_data.interrupt:
+                    await self._clear()
+                    continue
+                if stream_data.blob is None:
+                    continue
+                await self._send_audio(stream_data.blob.data)
         except websockets.exceptions.ConnectionClosedOK:
             if not self.stop_event.is_set():
                 await self.receive_queue.put(
@@ -80,6 +193,82 @@ class TwilioCall(StreamOperator):
                     )
                 )
 
+    async def _send_audio(self, audio: bytes):
+        interrupts = self._interrupts
+        view = memoryview(audio)
+        for start in range(0, len(view), FRAME_BYTES):
+            if self._interrupts != interrupts:
+                return
+            if self.stop_event.is_set() and not self._playing_out:
+                self._unsent = bytes(view[start:])
+                return
+            await self._pace()
+            frame = view[start : start + FRAME_BYTES]
+            # https://www.twilio.com/docs/voice/media-streams/websocket-messages#send-a-media-message
+            await self._send_json(
+                {
+                    "event": "media",
+                    "streamSid": self.stream_sid,
+                    "media": {"payload": base64.b64encode(frame).decode()},
+                }
+            )
+            self._sent_bytes += len(frame)
+            self._playout_end = (
+                max(self._playout_end, time.monotonic())
+                + len(frame) / _AUDIO_BYTES_PER_SECOND
+            )
+            self.frames_sent += 1
+            _frames_sent.inc()
+
+        name = str(self._next_mark)
+        self._next_mark += 1
+        self._marks[name] = self._sent_bytes
+        # https://www.twilio.com/docs/voice/media-streams/websocket-messages#send-a-mark-message
+        await self._send_json(
+            {"event": "mark", "streamSid": self.stream_sid, "mark": {"name": name}}
+        )
+        self.max_playback_lag = max(self.max_playback_lag, self.playback_lag)
+
+    async def _pace(self):
+        """Waits until Twilio has less than `lead` of audio left to play."""
+        release_at = self._playout_end - self.lead
+        if release_at <= time.monotonic():
+            return
+        await asyncio.sleep(release_at - time.monotonic())
+        drift = time.monotonic() - release_at
+        self.paced_frames += 1
+        self.total_drift += drift
+        self.max_drift = max(self.max_drift, drift)
+        _drift.inc(drift)
+        if drift > self.lead:
+            # Twilio ran out of audio before this frame arrived.
+            self.underruns += 1
+            _underruns.inc()
+
+    async def _clear(self):
+        # https://www.twilio.com/docs/voice/media-streams/websocket-messages#send-a-clear-message
+        await self._send_json({"event": "clear", "streamSid": self.stream_sid})
+        cleared = self._sent_bytes - self._played_bytes
+        self.clears += 1
+        self.cleared_bytes += cleared
+        _clears.inc()
+        _cleared_audio.inc(cleared / _AUDIO_BYTES_PER_SECOND)
+        # Twilio echoes the pending marks right away, but their audio never plays.
+        self._marks.clear()
+        self._played_bytes = self._sent_bytes
+        self._playout_end = 0.0
+
+    def _on_mark(self, name: str):
+        if name not in self._marks:
+            # Echoed after a clear.
+            return
+        # Marks are echoed in order, so the ones before it have played too.
+        for mark, sent_bytes in list(self._marks.items()):
+            del self._marks[mark]
+            self._played_bytes = sent_bytes
+            if mark == name:
+                break
+
     @override
     async def receive_task(self):
         try:
@@ -89,6 +278,8 @@ class TwilioCall(StreamOperator):
                 if not t.done():
                     continue
                 raw_msg = t.result()
+                if self.trace:
+                    self.trace.record(self.name, INBOUND, raw_msg)
                 msg = json.loads(raw_msg)
                 # https://www.twilio.com/docs/voice/media-streams/websocket-messages#media-message
                 if msg["event"] == "media":
@@ -99,6 +290,10 @@ class TwilioCall(StreamOperator):
                         )
                     )
                     continue
+                # https://www.twilio.com/docs/voice/media-streams/websocket-messages#mark-message
+                if msg["event"] == "mark":
+                    self._on_mark(msg["mark"]["name"])
+                    continue
                 logging.error(f"Received unexpected message: {msg}")
         except websockets.exceptions.ConnectionClosedOK:
             if not self.stop_event.is_set():
@@ -109,6 +304,45 @@ class TwilioCall(StreamOperator):
                     )
                 )
 
+    async def _play_out(self):
+        """Sends the audio left when the call ended, and waits until it played."""
+        self._playing_out = True
+        audio = [self._unsent]
+        while not self.send_queue.empty():
+            stream_data = self.send_queue.get_nowait()
+            if stream_data.blob is not None:
+                audio.append(stream_data.blob.data)
+        async with asyncio.timeout(self.max_play_out):
+            for chunk in audio:
+                if chunk:
+                    await self._send_audio(chunk)
+            # Only once the last mark is echoed has everything played.
+            while self._marks:
+                msg = json.loads(await self.ws.receive_text())
+                if msg["event"] == "mark":
+                    self._on_mark(msg["mark"]["name"])
+
     @override
     async def close(self):
-        logging.info("Closing twilio connection")
+        if (
+            self.stream_sid is not None
+            and self.ws.client_state == WebSocketState.CONNECTED
+        ):
+            try:
+                await self._play_out()
+            except Exception as e:
+                # E.g. the caller hung up, or it took longer than `max_play_out`.
+                logging.info(f"Stopped playing out the call's audio: {e!r}")
+        mean_drift = self.total_drift / self.paced_frames if self.paced_frames else 0
+        logging.info(
+            f"Closing twilio connection. Playback lag was at most "
+            f"{self.max_playback_lag * 1000:.0f}ms; {self.clears} clears cut "
+            f"{self.cleared_bytes * 1000 / _AUDIO_BYTES_PER_SECOND:.0f}ms of audio; "
+            f"sent {self.frames_sent} frames with {mean_drift * 1000:.1f}ms mean and "
+            f"{self.max_drift * 1000:.1f}ms max drift, {self.underruns} underruns"
+        )
+        _live.discard(self)
+        # Twilio only moves past <Connect>, and so hangs up, once the stream closes.
+        if self.ws.client_state == WebSocketState.CONNECTED:
+            with suppress(Exception):
+                await self.ws.close()
@@ -1,47 +1,222 @@
+import asyncio
+import importlib
 import logging
-from contextlib import asynccontextmanager
-from typing import List
-
-from fastapi import FastAPI, Query, WebSocket
-from fastapi.responses import StreamingResponse
-from google import genai
-from mcp import ClientSessionGroup
-from pydantic import BaseModel
-from twilio.rest import Client as TwilioClient
-
-from api.utils.chat import do_stream, mock_gemini_do_stream
-from api.utils.mcp_util import google_maps
+import secrets
+import signal
+from contextlib import aclosing, asynccontextmanager, suppress
+from datetime import timedelta
+from typing import TYPE_CHECKING, List, Optional
+
+from fastapi import FastAPI, Query, WebSocket, status
+from fastapi import Request as HttpRequest
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from pydantic import BaseModel, Field, ValidationError
+
+from api.utils.admission import AdmissionLimits, CallAdmissionController
+from api.utils.conversation import ConversationStore
+from api.utils.data_stream import DataStreamWriter
+from api.utils.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from api.utils.metrics import REGISTRY as METRICS
 from api.utils.mongodb import MongoDB
-from api.utils.prompt import ClientMessage
-from api.utils.settings import get_setting
-from api.utils.twilio_phone_call import stream_call as stream_twilio_call
+from api.utils.prompt import ClientMessage, convert_to_gemini_messages
+from api.utils.readiness import Readiness
+from api.utils.settings import Settings, get_settings, reload_settings
+from api.utils.task import Task, TaskStatus
+from api.utils.task_dedup import TaskDeduplicator, task_dedup_key
+from api.utils.usage import summarize_usage
+
+# Provider SDKs (and the modules built on them) take seconds to import, so they
+# are imported in the background after startup, or on first use. Only what is
+# needed to start serving is imported here.
+if TYPE_CHECKING:
+    from google import genai
+    from twilio.rest import Client as TwilioClient
+
+    from api.utils.call_profiler import CallProfiler
+    from api.utils.dialer import DialScheduler
+    from api.utils.mcp_cache import McpToolCache
+    from api.utils.mcp_pool import McpSessionPool
+    from api.utils.prompt_cache import PromptCache
+    from api.utils.twilio_phone_call import CallControl
+
+# Imported one after the other in a single thread, since the SDKs have circular
+# imports that break when imported from several threads at once.
+_PROVIDER_MODULES = [
+    "google.genai",
+    "api.utils.mcp_cache",
+    "api.utils.mcp_pool",
+    "api.utils.chat",
+    "api.utils.dialer",
+    "api.utils.twilio_phone_call",
+]
 
-mcp_session_group: ClientSessionGroup | None = None
+# How long requests wait for the providers they need to finish starting.
+PROVIDER_START_WAIT = timedelta(seconds=30)
+MCP_START_RETRY_DELAY = timedelta(seconds=1)
+MCP_MAX_START_RETRY_DELAY = timedelta(minutes=1)
+
+mcp_session_pool: "McpSessionPool | None" = None
+mcp_tool_cache: "McpToolCache | None" = None
 mongodb_client: MongoDB | None = None
-twilio_client: TwilioClient | None = None
-gemini_client: genai.Client | None = None
+twilio_client: "TwilioClient | None" = None
+call_control: "CallControl | None" = None
+admission_controller: CallAdmissionController | None = None
+dial_scheduler: "DialScheduler | None" = None
+task_deduplicator: TaskDeduplicator | None = None
+call_profiler: "CallProfiler | None" = None
+gemini_client: "genai.Client | None" = None
+prompt_cache: "PromptCache | None" = None
+conversation_store = ConversationStore()
+readiness = Readiness()
+
+
+async def _import_providers():
+    # In a thread, so that the event loop keeps serving while this takes a while.
+    def import_all():
+        for module in _PROVIDER_MODULES:
+            importlib.import_module(module)
+
+    await asyncio.to_thread(import_all)
+
+
+async def _start_providers(settings: Settings, imports: asyncio.Task):
+    global twilio_client, call_control, gemini_client, prompt_cache, dial_scheduler
+    await imports
+    from google import genai
+
+    from api.utils.dialer import DialerLimits, DialScheduler
+    from api.utils.prompt_cache import PromptCache
+    from api.utils.twilio_phone_call import CallControl, create_twilio_client
+
+    twilio_client = create_twilio_client()
+    call_control = CallControl(twilio_client)
+    gemini_client = genai.Client(api_key=settings.gemini_api_key)
+    prompt_cache = PromptCache(gemini_client)
+    dial_scheduler = DialScheduler(
+        twilio_client,
+        mongodb_client,
+        admission_controller,
+        DialerLimits(
+            max_concurrent_calls=settings.dialer_concurrency,
+            max_calls_per_business=settings.dialer_calls_per_business,
+        ),
+    )
+    await dial_scheduler.start()
+
+
+async def _start_mcp(settings: Settings, imports: asyncio.Task):
+    global mcp_session_pool, mcp_tool_cache
+    await imports
+    from api.utils.mcp_cache import McpToolCache
+    from api.utils.mcp_pool import McpSessionPool
+    from api.utils.mcp_util import google_maps
+
+    # Starting the servers can fail transiently (e.g. `npx` failing to fetch the
+    # package), so keep trying rather than leaving /api/chat unavailable.
+    delay = MCP_START_RETRY_DELAY
+    while True:
+        pool = McpSessionPool([google_maps()], size=settings.mcp_pool_size)
+        try:
+            await pool.start()
+            break
+        except Exception as e:
+            await pool.close()
+            logging.error(
+                f"MCP servers failed to start, retrying in "
+                f"{delay.total_seconds():.0f}s: {e!r}"
+            )
+        except BaseException:
+            await pool.close()
+            raise
+        await asyncio.sleep(delay.total_seconds())
+        delay = min(delay * 2, MCP_MAX_START_RETRY_DELAY)
+    mcp_session_pool = pool
+    mcp_tool_cache = McpToolCache(pool, mongodb_client)
+
+
+async def _stop_providers():
+    global twilio_client, call_control, gemini_client, prompt_cache, dial_scheduler
+    global mcp_session_pool, mcp_tool_cache
+    if dial_scheduler is not None:
+        await dial_scheduler.close()
+        dial_scheduler = None
+    if prompt_cache is not None:
+        await prompt_cache.close()
+        prompt_cache = None
+    gemini_client = None
+    call_control = None
+    if twilio_client is not None:
+        from api.utils.twilio_phone_call import close_twilio_client
+
+        await close_twilio_client(twilio_client)
+        twilio_client = None
+    if mcp_session_pool is not None:
+        await mcp_session_pool.close()
+        mcp_session_pool = None
+        mcp_tool_cache = None
 
 
 # Based on https://fastapi.tiangolo.com/advanced/events/#lifespan.
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    global mcp_session_group, mongodb_client, twilio_client, gemini_client
-    assert mcp_session_group is None, "Sessions already initialized?"
-    params = [google_maps()]
-    async with ClientSessionGroup() as group:
-        for param in params:
-            await group.connect_to_server(param)
-        mcp_session_group = group
-        mongodb_client = MongoDB()
-        twilio_client = TwilioClient(
-            get_setting("TWILIO_ACCOUNT_SID"), get_setting("TWILIO_AUTH_TOKEN")
+    global mongodb_client, admission_controller, task_deduplicator, call_profiler
+    assert mcp_session_pool is None, "Sessions already initialized?"
+    # Fails startup if any setting is missing or invalid.
+    settings = get_settings()
+    loop = asyncio.get_running_loop()
+    # Signal handlers are not supported on Windows, nor off the main thread.
+    with suppress(NotImplementedError, RuntimeError):
+        loop.add_signal_handler(signal.SIGHUP, _reload_settings_on_signal)
+
+    mongodb_client = MongoDB()
+    task_deduplicator = TaskDeduplicator(
+        mongodb_client,
+        freshness=timedelta(minutes=settings.task_dedup_freshness_minutes),
+    )
+    admission_controller = CallAdmissionController(
+        AdmissionLimits(
+            max_active_calls=settings.max_active_calls,
+            max_queued_calls=settings.max_queued_calls,
+            max_event_loop_lag_ms=settings.max_event_loop_lag_ms,
+            max_cpu_percent=settings.max_cpu_percent,
         )
-        gemini_client = genai.Client(api_key=get_setting("GEMINI_API_KEY"))
+    )
+    await admission_controller.start()
+    # Starting the MCP servers (via npx) takes seconds, so requests that don't need
+    # them are served in the meantime.
+    imports = asyncio.create_task(_import_providers())
+    starting = [
+        imports,
+        asyncio.create_task(
+            readiness.run("providers", _start_providers(settings, imports))
+        ),
+        asyncio.create_task(readiness.run("mcp", _start_mcp(settings, imports))),
+    ]
 
-        yield
-        mcp_session_group = None
-        mongodb_client = None
-        twilio_client = None
+    yield
+    for task in starting:
+        task.cancel()
+    await asyncio.gather(*starting, return_exceptions=True)
+    if call_profiler is not None:
+        await call_profiler.close()
+        call_profiler = None
+    await _stop_providers()
+    await admission_controller.close()
+    admission_controller = None
+    task_deduplicator = None
+    mongodb_client = None
+    with suppress(NotImplementedError, RuntimeError):
+        loop.remove_signal_handler(signal.SIGHUP)
+
+
+def _reload_settings_on_signal():
+    with suppress(ValidationError):  # Logged by reload_settings.
+        reload_settings()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -53,7 +228,21 @@ logging.basicConfig(
 
 
 class Request(BaseModel):
+    # Without a conversation_id, `messages` is the full history and a new
+    # conversation is started. With one, `messages` only holds the messages that
+    # are new since the last turn.
     messages: List[ClientMessage]
+    conversation_id: Optional[str] = None
+    # If set, the response ends once the call is dialed, pointing the client to
+    # GET /api/tasks/{task_id}/stream for the call's updates.
+    detach: bool = False
+
+
+class BulkTaskRequest(BaseModel):
+    tasks: List[Task] = Field(max_length=1000)
+    # Higher priority batches are dialed first.
+    priority: int = Field(default=0, ge=-100, le=100)
+    max_attempts: int = Field(default=3, ge=1, le=10)
 
 
 @app.websocket("/task-stream/{task_id}")
@@ -64,21 +253,305 @@ async def task_stream(websocket: WebSocket, task_id: str):
 
     assert task is not None
 
-    await stream_twilio_call(mongodb_client, websocket, task, task_id)
+    # Only imported once started in the background, see _PROVIDER_MODULES.
+    if not await readiness.wait("providers", PROVIDER_START_WAIT):
+        logging.error(f"Providers not ready, dropping task stream {task_id}")
+        if readiness.has_failed("providers"):
+            await websocket.close(
+                code=status.WS_1011_INTERNAL_ERROR, reason="failed to start"
+            )
+        else:
+            await websocket.close(
+                code=status.WS_1013_TRY_AGAIN_LATER, reason="starting"
+            )
+        return
+    from api.utils.twilio_phone_call import stream_call as stream_twilio_call
+
+    await stream_twilio_call(
+        mongodb_client,
+        admission_controller,
+        websocket,
+        task,
+        task_id,
+        gemini_client=gemini_client,
+    )
+
+
+@app.post("/api/twilio/call-status/{task_id}")
+async def call_status_callback(task_id: str, http_request: HttpRequest):
+    if not await readiness.wait("providers", PROVIDER_START_WAIT):
+        return _not_ready("providers")
+    from api.utils.twilio_phone_call import (
+        handle_call_status,
+        is_valid_status_callback,
+    )
+
+    params = {k: str(v) for k, v in (await http_request.form()).items()}
+    signature = http_request.headers.get("X-Twilio-Signature", "")
+    if not is_valid_status_callback(task_id, params, signature):
+        logging.error(f"Rejected call status callback for task {task_id}")
+        return Response(status_code=403)
+
+    await handle_call_status(mongodb_client, admission_controller, task_id, params)
+    return Response(status_code=204)
+
+
+@app.post("/api/tasks/{task_id}/hangup")
+async def hangup_task_call(task_id: str, http_request: HttpRequest):
+    if not _is_admin(http_request):
+        return Response(status_code=403)
+
+    call_sid = await mongodb_client.get_call_sid(task_id)
+    if call_sid is None:
+        return JSONResponse(status_code=404, content={"error": "no_call"})
+    if not await readiness.wait("providers", PROVIDER_START_WAIT):
+        return _not_ready("providers")
+
+    call = await call_control.hangup(call_sid)
+    return {"call_sid": call.sid, "status": call.status}
+
+
+async def _task_events(task_id: str, after: int):
+    from sse_starlette.sse import ServerSentEvent
+
+    async with aclosing(mongodb_client.watch_task_updates(task_id, after)) as updates:
+        async for update in updates:
+            if update.status is None:
+                yield ServerSentEvent(
+                    data=update.model_dump_json(exclude={"status"}),
+                    event="update",
+                    id=str(update.seq),
+                )
+                continue
+            yield ServerSentEvent(
+                data=update.model_dump_json(include={"status", "timestamp"}),
+                event="status",
+            )
+            # Final, as tasks to be retried are requeued instead (see finish_task).
+            if update.status == TaskStatus.FINISHED:
+                return
+
+
+@app.get("/api/tasks/{task_id}/stream")
+async def stream_task_updates(
+    task_id: str, http_request: HttpRequest, after: Optional[int] = None
+):
+    """
+    The task's updates as server-sent events, with their sequence numbers as event
+    ids. Updates after `after` (or the Last-Event-ID header, which EventSource
+    sends when it reconnects) are sent, so clients can resume where they left off.
+    The stream ends when the task finishes for good. A task that will be dialed
+    again gets a "queued" status event instead, and its next attempt follows.
+    """
+    if after is None:
+        last_event_id = http_request.headers.get("Last-Event-ID") or "0"
+        if not last_event_id.isdigit():
+            return JSONResponse(
+                status_code=400, content={"error": "invalid_last_event_id"}
+            )
+        after = int(last_event_id)
+    if await mongodb_client.get_task(task_id) is None:
+        return JSONResponse(status_code=404, content={"error": "task_not_found"})
+
+    # Imported on first use, as it adds noticeably to the startup time.
+    from sse_starlette.sse import EventSourceResponse
+
+    return EventSourceResponse(_task_events(task_id, after))
+
+
+@app.get("/api/tasks/{task_id}/usage")
+async def get_task_usage(task_id: str):
+    records = await mongodb_client.get_usage(task_id)
+    if records is None:
+        return JSONResponse(status_code=404, content={"error": "task_not_found"})
+
+    return {"records": records, "summary": summarize_usage(records)}
+
+
+@app.get("/api/conversations/{conversation_id}/usage")
+async def get_conversation_usage(conversation_id: str):
+    records = await mongodb_client.get_conversation_usage(conversation_id)
+    if records is None:
+        return JSONResponse(
+            status_code=404, content={"error": "conversation_not_found"}
+        )
+
+    return {"records": records, "summary": summarize_usage(records)}
+
+
+@app.post("/api/tasks/bulk")
+async def submit_bulk_tasks(request: BulkTaskRequest, http_request: HttpRequest):
+    if not _is_admin(http_request):
+        return Response(status_code=403)
+    if not request.tasks:
+        return JSONResponse(status_code=400, content={"error": "no_tasks"})
+
+    batch_id, task_ids = await mongodb_client.store_batch(
+        request.tasks,
+        dedup_keys=[task_dedup_key(task) for task in request.tasks],
+        priority=request.priority,
+        max_attempts=request.max_attempts,
+    )
+    if dial_scheduler is not None:
+        # Otherwise the scheduler picks them up once it starts.
+        dial_scheduler.notify_submitted()
+    return {"batch_id": batch_id, "task_ids": task_ids}
+
+
+@app.get("/api/batches/{batch_id}")
+async def get_batch_progress(batch_id: str):
+    progress = await mongodb_client.get_batch_progress(batch_id)
+    if progress is None:
+        return JSONResponse(status_code=404, content={"error": "batch_not_found"})
+
+    return progress
+
+
+@app.get("/api/health")
+async def health():
+    """Readiness of the components that start in the background."""
+    components = readiness.status()
+    return JSONResponse(
+        status_code=200 if readiness.all_ready() else 503,
+        content={"ready": readiness.all_ready(), "components": components},
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Runtime metrics in the Prometheus text format."""
+    return PlainTextResponse(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+def _not_ready(component: str) -> JSONResponse:
+    if readiness.has_failed(component):
+        # Retrying won't help until the process is restarted.
+        return JSONResponse(
+            status_code=503,
+            content={"error": "failed_to_start", "components": readiness.status()},
+        )
+    return JSONResponse(
+        status_code=503,
+        content={"error": "starting", "components": readiness.status()},
+        headers={"Retry-After": "5"},
+    )
+
+
+def _is_admin(http_request: HttpRequest) -> bool:
+    admin_token = get_settings().admin_token
+    provided = http_request.headers.get("X-Admin-Token", "")
+    return bool(admin_token) and secrets.compare_digest(provided, admin_token)
+
+
+@app.post("/api/admin/reload-settings")
+async def reload_settings_endpoint(http_request: HttpRequest):
+    if not _is_admin(http_request):
+        return Response(status_code=403)
+
+    try:
+        reload_settings()
+    except ValidationError as e:
+        return JSONResponse(
+            status_code=422,
+            content={"error": "invalid_settings", "fields": _invalid_fields(e)},
+        )
+    return Response(status_code=204)
+
+
+def _invalid_fields(e: ValidationError) -> list[str]:
+    # Only the names, so that no secrets end up in the response.
+    return [".".join(str(loc) for loc in error["loc"]) for error in e.errors()]
+
+
+@app.post("/api/admin/tasks/{task_id}/profile")
+async def profile_task_call(
+    task_id: str,
+    http_request: HttpRequest,
+    seconds: float = Query(30, gt=0),
+    interval_ms: float = Query(5, gt=0),
+):
+    """
+    Samples the task's in-progress call for `seconds`. The per-operator breakdown
+    is then stored with the task, see GET /api/admin/tasks/{task_id}/profiles.
+    Sampling doesn't slow down other calls, but can't resolve bursts of work
+    shorter than the interpreter's switch interval (5ms).
+    """
+    global call_profiler
+    if not _is_admin(http_request):
+        return Response(status_code=403)
+    # Calls only run once the providers have started, so importing after that
+    # doesn't race their background import.
+    if not await readiness.wait("providers", PROVIDER_START_WAIT):
+        return _not_ready("providers")
+    from api.audio_stream.stream_mediator import running_mediator
+    from api.utils.call_profiler import CallProfiler
+
+    mediator = running_mediator(task_id)
+    if mediator is None:
+        return JSONResponse(status_code=404, content={"error": "no_call"})
+    if call_profiler is None:
+        call_profiler = CallProfiler(mongodb_client)
+    if not call_profiler.start(
+        mediator, timedelta(seconds=seconds), timedelta(milliseconds=interval_ms)
+    ):
+        return JSONResponse(
+            status_code=409,
+            content={"error": "busy", "task_id": call_profiler.profiling},
+        )
+    return JSONResponse(status_code=202, content={"task_id": task_id})
+
+
+@app.get("/api/admin/tasks/{task_id}/profiles")
+async def get_task_call_profiles(task_id: str, http_request: HttpRequest):
+    if not _is_admin(http_request):
+        return Response(status_code=403)
+    profiles = await mongodb_client.get_call_profiles(task_id)
+    if profiles is None:
+        return JSONResponse(status_code=404, content={"error": "task_not_found"})
+
+    return {"profiles": profiles}
 
 
 @app.post("/api/chat")
-async def handle_chat_data(request: Request, protocol: str = Query("data")):
+async def handle_chat_data(
+    request: Request, http_request: HttpRequest, protocol: str = Query("data")
+):
     assert protocol is not None
-    response = StreamingResponse(
+    for component in ("providers", "mcp"):
+        if not await readiness.wait(component, PROVIDER_START_WAIT):
+            return _not_ready(component)
+    from api.utils.chat import mock_gemini_do_stream
+
+    new_messages = convert_to_gemini_messages(request.messages)
+    if request.conversation_id is None:
+        conversation = conversation_store.create()
+    else:
+        conversation = conversation_store.get(request.conversation_id)
+        if conversation is None:
+            # Evicted or expired. The client should retry with the full history
+            # and no conversation_id.
+            return JSONResponse(
+                status_code=409, content={"error": "conversation_expired"}
+            )
+
+    writer = DataStreamWriter(
         mock_gemini_do_stream(
             gemini_client=gemini_client,
-            mcp_session_group=mcp_session_group,
+            mcp_session_group=mcp_tool_cache,
             twilio_client=twilio_client,
             mongodb_client=mongodb_client,
-            messages=request.messages,
-        )
+            admission=admission_controller,
+            deduplicator=task_deduplicator,
+            prompt_cache=prompt_cache,
+            conversation_store=conversation_store,
+            conversation=conversation,
+            new_messages=new_messages,
+            detach=request.detach,
+        ),
+        is_disconnected=http_request.is_disconnected,
     )
+    response = StreamingResponse(writer.stream())
 
     response.headers["x-vercel-ai-data-stream"] = "v1"
+    response.headers["x-conversation-id"] = conversation.conversation_id
     return response
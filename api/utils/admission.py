@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from api.utils.metrics import REGISTRY, Sample
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"Call rejected: {reason}")
+        self.reason = reason
+
+
+@dataclass
+class AdmissionLimits:
+    max_active_calls: int = 20
+    # Calls waiting for capacity beyond this are rejected right away.
+    max_queued_calls: int = 20
+    max_event_loop_lag_ms: float = 50
+    max_cpu_percent: float = 80
+    queue_timeout: timedelta = timedelta(seconds=30)
+    # Reserved calls that never connect (e.g. lost status callbacks) are released
+    # after this long.
+    reservation_timeout: timedelta = timedelta(minutes=3)
+
+
+@dataclass
+class _ActiveCall:
+    reserved_at: float = field(default_factory=time.monotonic)
+    connected: bool = False
+
+
+class CallAdmissionController:
+    """
+    Limits how many calls (stream mediators) this process handles, so that calls in
+    progress keep real-time audio quality.
+
+    A call reserves a slot when it is placed (`admit`) and holds it until it ends
+    (`release`). New calls are admitted while the number of active calls, the
+    event loop lag and the projected CPU usage (current usage plus one more call's
+    average share) are under `limits`. Otherwise they wait in a bounded queue, and
+    are rejected when the queue is full or they waited for too long.
+    """
+
+    def __init__(
+        self,
+        limits: AdmissionLimits | None = None,
+        sample_interval: timedelta = timedelta(milliseconds=250),
+    ):
+        self.limits = limits or AdmissionLimits()
+        self.sample_interval = sample_interval
+        self.event_loop_lag_ms = 0.0
+        self.cpu_percent = 0.0
+        self._calls: dict[str, _ActiveCall] = {}
+        self._queued = 0
+        self._capacity_changed = asyncio.Condition()
+        self._monitor: asyncio.Task | None = None
+        # Pending wakeups of waiting calls. The event loop only keeps weak
+        # references to tasks, so they could otherwise be dropped before running.
+        self._notifying: set[asyncio.Task] = set()
+
+    async def start(self):
+        self._monitor = asyncio.create_task(self._monitor_loop())
+        self._register_metrics()
+
+    def _register_metrics(self):
+        for name, help, value in [
+            (
+                "event_loop_lag_seconds",
+                "Smoothed delay of the event loop waking up timers.",
+                lambda: self.event_loop_lag_ms / 1000,
+            ),
+            (
+                "process_cpu_percent",
+                "CPU used by this process over the last sample interval.",
+                lambda: self.cpu_percent,
+            ),
+            (
+                "calls_active",
+                "Calls holding an admission slot.",
+                lambda: self.active_calls,
+            ),
+            (
+                "calls_queued",
+                "Calls waiting for an admission slot.",
+                lambda: self.queued_calls,
+            ),
+        ]:
+            REGISTRY.collected(name, help, lambda value=value: [Sample({}, value())])
+
+    async def close(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+
+    @property
+    def active_calls(self) -> int:
+        return len(self._calls)
+
+    @property
+    def queued_calls(self) -> int:
+        return self._queued
+
+    def cpu_percent_per_call(self) -> float:
+        return self.cpu_percent / max(self.active_calls, 1)
+
+    def stats(self) -> dict:
+        return {
+            "active_calls": self.active_calls,
+            "queued_calls": self.queued_calls,
+            "event_loop_lag_ms": self.event_loop_lag_ms,
+            "cpu_percent": self.cpu_percent,
+            "cpu_percent_per_call": self.cpu_percent_per_call(),
+        }
+
+    def has_capacity(self) -> bool:
+        if self.active_calls >= self.limits.max_active_calls:
+            return False
+        if self.event_loop_lag_ms > self.limits.max_event_loop_lag_ms:
+            return False
+        projected_cpu = self.cpu_percent
+        if self.active_calls > 0:
+            projected_cpu += self.cpu_percent_per_call()
+        return projected_cpu <= self.limits.max_cpu_percent
+
+    def try_admit(self, task_id: str) -> bool:
+        """Reserves a slot for the call of `task_id` if there is capacity now."""
+        if task_id in self._calls:
+            return True
+        if not self.has_capacity():
+            return False
+        self._calls[task_id] = _ActiveCall()
+        return True
+
+    async def admit(self, task_id: str):
+        """
+        Reserves a slot for the call of `task_id`, waiting for capacity if needed.
+        Raises AdmissionRejected if the call cannot be taken on.
+        """
+        if self.try_admit(task_id):
+            return
+        if self._queued >= self.limits.max_queued_calls:
+            raise AdmissionRejected("over capacity")
+
+        self._queued += 1
+        try:
+            async with self._capacity_changed:
+                await asyncio.wait_for(
+                    self._capacity_changed.wait_for(lambda: self.try_admit(task_id)),
+                    self.limits.queue_timeout.total_seconds(),
+                )
+        except asyncio.TimeoutError:
+            raise AdmissionRejected("timed out waiting for capacity")
+        finally:
+            self._queued -= 1
+
+    def connected(self, task_id: str):
+        """
+        Marks the call of `task_id` as connected (its stream mediator is running).
+        Calls that connect without a reservation are tracked too.
+        """
+        self._calls.setdefault(task_id, _ActiveCall()).connected = True
+
+    def release(self, task_id: str, *, only_if_unconnected: bool = False):
+        call = self._calls.get(task_id)
+        if call is None or (only_if_unconnected and call.connected):
+            return
+        del self._calls[task_id]
+        notifying = asyncio.create_task(self._notify())
+        self._notifying.add(notifying)
+        notifying.add_done_callback(self._notifying.discard)
+
+    async def _notify(self):
+        async with self._capacity_changed:
+            self._capacity_changed.notify_all()
+
+    def _expire_reservations(self):
+        deadline = time.monotonic() - self.limits.reservation_timeout.total_seconds()
+        for task_id, call in list(self._calls.items()):
+            if not call.connected and call.reserved_at < deadline:
+                logging.warning(f"Releasing stale call reservation for {task_id}")
+                self.release(task_id)
+
+    async def _monitor_loop(self):
+        interval = self.sample_interval.total_seconds()
+        last_wall, last_cpu = time.monotonic(), time.process_time()
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now, cpu = time.monotonic(), time.process_time()
+            # How late the loop woke us up. Smoothed, so one slow callback doesn't
+            # block admissions.
+            lag_ms = max(now - expected, 0) * 1000
+            self.event_loop_lag_ms = 0.8 * self.event_loop_lag_ms + 0.2 * lag_ms
+            self.cpu_percent = (cpu - last_cpu) / (now - last_wall) * 100
+            last_wall, last_cpu = now, cpu
+
+            self._expire_reservations()
+            if self._queued and self.has_capacity():
+                await self._notify()
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from types import FrameType
+
+from api.audio_stream.stream_mediator import StreamMediator
+from api.utils.mongodb import CallProfile, MongoDB, OperatorProfile
+
+MAX_PROFILE_DURATION = timedelta(minutes=5)
+MIN_PROFILE_INTERVAL = timedelta(milliseconds=1)
+
+# Routing between operators is attributed to this pseudo-operator.
+MEDIATOR = "mediator"
+_HOT_FUNCTIONS = 10
+
+
+def _thread_cpu_time(thread_id: int):
+    """A function returning the CPU time of a thread, where the OS supports it."""
+    if hasattr(time, "pthread_getcpuclockid"):
+        clock = time.pthread_getcpuclockid(thread_id)
+        return lambda: time.clock_gettime(clock)
+    # Otherwise the whole process, which overstates the event loop's share.
+    return time.process_time
+
+
+def _function(frame: FrameType) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_qualname} ({os.path.basename(code.co_filename)}"
+        f":{code.co_firstlineno})"
+    )
+
+
+class _Sampler(threading.Thread):
+    """
+    Periodically snapshots the event loop thread's stack, and attributes each
+    sample to the asyncio task of the mediator (or operator) that is running.
+    Work outside those tasks (e.g. websocket I/O callbacks, or other calls) is
+    counted as "other".
+    """
+
+    def __init__(
+        self,
+        mediator: StreamMediator,
+        loop_thread_id: int,
+        duration: timedelta,
+        interval: timedelta,
+    ):
+        super().__init__(name=f"profiler-{mediator.task_id}", daemon=True)
+        self.mediator = mediator
+        self.loop_thread_id = loop_thread_id
+        self.duration = duration
+        self.interval = interval
+        self.profile: CallProfile | None = None
+        self._stopping = threading.Event()
+        self._samples = 0
+        self._idle = 0
+        self._other = 0
+        # By (operator, task name).
+        self._task_samples: Counter[tuple[str, str]] = Counter()
+        self._functions: dict[str, Counter[str]] = defaultdict(Counter)
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        started_at = datetime.now()
+        start = time.monotonic()
+        deadline = start + self.duration.total_seconds()
+        loop_cpu_time = _thread_cpu_time(self.loop_thread_id)
+        cpu_start = loop_cpu_time()
+        # The switch interval is left alone, as it is process-wide and lowering it
+        # slows down every other call. So while the event loop is busy, the sampler
+        # only gets the GIL every 5ms (by default), and shorter bursts of work are
+        # undersampled.
+        while not self._stopping.is_set() and time.monotonic() < deadline:
+            run_task = self.mediator.run_task
+            if self.mediator.stop_event.is_set() or (
+                run_task is not None and run_task.done()
+            ):
+                break
+            self._sample()
+            self._stopping.wait(self.interval.total_seconds())
+        loop_cpu_seconds = loop_cpu_time() - cpu_start
+        self.profile = self._summarize(
+            started_at, time.monotonic() - start, loop_cpu_seconds
+        )
+
+    def _labels(self) -> dict[FrameType, tuple[str, str]]:
+        """The outermost frame of each of the mediator's tasks."""
+        labels = {}
+        tasks = [(MEDIATOR, MEDIATOR, self.mediator.run_task)]
+        for task in list(self.mediator.tasks):
+            # Tasks are named "{operator}-send" and "{operator}-receive".
+            name = task.get_name()
+            tasks.append((name.rsplit("-", 1)[0], name, task))
+        for operator, name, task in tasks:
+            if task is None:
+                continue
+            frame = task.get_coro().cr_frame
+            if frame is not None:
+                labels[frame] = (operator, name)
+        return labels
+
+    def _sample(self):
+        top = sys._current_frames().get(self.loop_thread_id)
+        if top is None:
+            return
+        self._samples += 1
+        labels = self._labels()
+        frame = top
+        while frame is not None and frame not in labels:
+            frame = frame.f_back
+        if frame is not None:
+            operator, task_name = labels[frame]
+            self._task_samples[operator, task_name] += 1
+            self._functions[operator][_function(top)] += 1
+        elif top.f_code.co_filename.endswith("selectors.py"):
+            self._idle += 1
+        else:
+            self._other += 1
+
+    def _summarize(
+        self, started_at: datetime, duration: float, loop_cpu_seconds: float
+    ) -> CallProfile:
+        seconds_per_sample = duration / self._samples if self._samples else 0.0
+        busy = self._samples - self._idle
+        cpu_per_sample = loop_cpu_seconds / busy if busy else 0.0
+        operators: dict[str, OperatorProfile] = {}
+        for (operator, task_name), samples in self._task_samples.items():
+            profile = operators.setdefault(operator, OperatorProfile())
+            profile.samples += samples
+            profile.wall_seconds += samples * seconds_per_sample
+            profile.cpu_seconds += samples * cpu_per_sample
+            profile.tasks[task_name] = samples * seconds_per_sample
+        for operator, profile in operators.items():
+            profile.hot_functions = [
+                (function, samples * seconds_per_sample)
+                for function, samples in self._functions[operator].most_common(
+                    _HOT_FUNCTIONS
+                )
+            ]
+        return CallProfile(
+            started_at=started_at,
+            duration_seconds=duration,
+            interval_ms=self.interval.total_seconds() * 1000,
+            samples=self._samples,
+            idle_seconds=self._idle * seconds_per_sample,
+            other_seconds=self._other * seconds_per_sample,
+            loop_cpu_seconds=loop_cpu_seconds,
+            operators=operators,
+        )
+
+
+class CallProfiler:
+    """
+    Profiles the call of one task at a time, for a bounded window, and stores the
+    per-operator breakdown with the task.
+
+    Nothing is instrumented ahead of time: a sampling thread only exists while a
+    call is being profiled, so calls that aren't profiled pay nothing.
+    """
+
+    def __init__(self, mongodb_client: MongoDB):
+        self.mongodb_client = mongodb_client
+        self._sampler: _Sampler | None = None
+        self._profiling: asyncio.Task | None = None
+
+    @property
+    def profiling(self) -> str | None:
+        """The task whose call is being profiled, if any."""
+        if self._sampler is None:
+            return None
+        return self._sampler.mediator.task_id
+
+    def start(
+        self, mediator: StreamMediator, duration: timedelta, interval: timedelta
+    ) -> bool:
+        """
+        Starts profiling the call `mediator` runs. Returns False if another call is
+        being profiled. Must be called on the event loop the call runs on.
+        """
+        if self._sampler is not None:
+            return False
+        self._sampler = _Sampler(
+            mediator,
+            threading.get_ident(),
+            min(duration, MAX_PROFILE_DURATION),
+            max(interval, MIN_PROFILE_INTERVAL),
+        )
+        self._sampler.start()
+        self._profiling = asyncio.create_task(self._store(self._sampler))
+        return True
+
+    async def _store(self, sampler: _Sampler):
+        try:
+            await asyncio.to_thread(sampler.join)
+            if sampler.profile is not None:
+                await self.mongodb_client.add_call_profile(
+                    sampler.mediator.task_id, sampler.profile
+                )
+                logging.info(f"Stored call profile of task {sampler.mediator.task_id}")
+        finally:
+            self._sampler = None
+            self._profiling = None
+
+    async def close(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._profiling is not None:
+            await self._profiling
@@ -1,26 +1,41 @@
 import asyncio
-import json
 import logging
-from typing import List
+import uuid
+from dataclasses import dataclass
+from typing import AsyncGenerator, Awaitable
 
+import aiostream
 from google import genai
 from google.genai.types import (
     Content,
     GenerateContentConfig,
-    GenerateContentResponseUsageMetadata,
     Modality,
     Part,
     ToolListUnion,
 )
-from mcp import ClientSessionGroup
 from twilio.rest import Client as TwilioClient
 
+from api.utils.admission import AdmissionRejected, CallAdmissionController
 from api.utils.chat_base import BASE_INSTRUCTIONS
+from api.utils.conversation import Conversation, ConversationStore
+from api.utils.data_stream import (
+    StreamPart,
+    data_part,
+    finish_message_part,
+    finish_step_part,
+    start_step_part,
+    text_part,
+    tool_call_part,
+    tool_result_part,
+)
 from api.utils.elevenlabs_phone_call import stream_call as stream_elevenlabs_call
+from api.utils.mcp_util import McpTools, call_tool, gemini_tools
 from api.utils.mongodb import MongoDB, TaskStatus
-from api.utils.prompt import ClientMessage, convert_to_gemini_messages
-from api.utils.task import Task, generate_task
+from api.utils.prompt_cache import PromptCache, tools_fingerprint
+from api.utils.task import Task, TaskOrNone, create_task_config, generate_task
+from api.utils.task_dedup import DuplicateTask, TaskDeduplicator, task_dedup_key
 from api.utils.twilio_phone_call import request_outbound_call
+from api.utils.usage import UsageTracker
 
 SYSTEM_INSTRUCTION = f"""
 {BASE_INSTRUCTIONS}
@@ -28,6 +43,21 @@ SYSTEM_INSTRUCTION = f"""
 If they accept, let the user know you're taking on the task and will let them know when you're done.
 """
 
+# Same default as the SDK's automatic function calling.
+MAX_TOOL_CALL_ROUNDS = 10
+
+# Gemini finish reasons to the AI SDK's.
+_FINISH_REASONS = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content-filter",
+    "RECITATION": "content-filter",
+    "BLOCKLIST": "content-filter",
+    "PROHIBITED_CONTENT": "content-filter",
+    "SPII": "content-filter",
+    "MALFORMED_FUNCTION_CALL": "error",
+}
+
 
 def create_config(tools: ToolListUnion):
     return GenerateContentConfig(
@@ -39,22 +69,15 @@ def create_config(tools: ToolListUnion):
     )
 
 
-def create_text_response(text: str):
-    return f"0:{json.dumps(text)}\n".encode("utf-8")
-
-
-def create_end_response(
-    finish_reason: str, usage_metadata: GenerateContentResponseUsageMetadata
-):
-    return_dict = {
-        "finishReason": finish_reason,
-        "usage": {
-            "promptTokens": usage_metadata.prompt_token_count,
-            "completionTokens": usage_metadata.candidates_token_count,
-        },
-        "isContinued": False,
-    }
-    return f"d:{json.dumps(return_dict)}\n".encode("utf-8")
+def _merge_text_parts(parts: list[Part]) -> list[Part]:
+    """Merges consecutive streamed text chunks into a single part."""
+    merged: list[Part] = []
+    for part in parts:
+        if part.text is not None and merged and merged[-1].text is not None:
+            merged[-1] = Part(text=merged[-1].text + part.text)
+        else:
+            merged.append(part)
+    return merged
 
 
 async def generate_update_stream(
@@ -66,15 +89,36 @@ async def generate_update_stream(
         "output_transcript_correction": "Bubba (correction)",
     }
     last_role: str | None = None
+    # The text shown so far of each transcript segment, which is updated in place
+    # as it grows, and the segment shown last.
+    shown: dict[str, str] = {}
+    last_segment: str | None = None
     async for update in mongodb_client.watch_task_updates(task_id):
         logging.error(f"Received update: {update}")
-        if update.message:
+        if update.message and update.message["type"] == "call_status":
+            last_role = None
+            last_segment = None
+            yield f"\n\n[Call {update.message['value']}]"
+        elif update.message:
             assert update.message["type"] in roles_lookup, "Unknown message type"
-            if last_role == update.message["type"]:
-                resp_str = update.message["value"]
+            value = update.message["value"]
+            segment = update.message.get("segment")
+            previous = shown.get(segment) if segment else None
+            if segment:
+                shown[segment] = value
+            if previous is not None:
+                if segment == last_segment and value.startswith(previous):
+                    # The segment grew, so only show what's new.
+                    resp_str = value[len(previous) :]
+                else:
+                    last_role = None
+                    resp_str = f"\n\n{roles_lookup[update.message['type']]} (correction): {value}"
+            elif last_role == update.message["type"]:
+                resp_str = value
             else:
                 last_role = update.message["type"]
-                resp_str = f"\n\n{roles_lookup[update.message['type']]}: {update.message['value']}"
+                resp_str = f"\n\n{roles_lookup[update.message['type']]}: {value}"
+            last_segment = segment
 
             yield resp_str
 
@@ -83,104 +127,368 @@ async def generate_update_stream(
             break
 
 
+def call_status_part(task_id: str, status: str) -> StreamPart:
+    return data_part([{"type": "call_status", "taskId": task_id, "status": status}])
+
+
+@dataclass
+class _TurnState:
+    """State the concurrent stages of a chat turn report back to the turn."""
+
+    finish_reason: str = "stop"
+    task: Task | None = None
+    task_id: str | None = None
+
+
+async def set_up_call(
+    task: Task,
+    state: _TurnState,
+    twilio_client: TwilioClient,
+    mongodb_client: MongoDB,
+    admission: CallAdmissionController,
+    deduplicator: TaskDeduplicator,
+    *,
+    fake_phone_call: bool = False,
+) -> AsyncGenerator[StreamPart, None]:
+    """
+    Stores `task` and places its call, yielding call status updates as soon as they
+    are known. Meant to run concurrently with the model's closing text.
+
+    If the same task is already in progress, or recently finished, no call is made
+    and `state` points to that task instead.
+    """
+    task_id = mongodb_client.new_task_id()
+    duplicate = await deduplicator.claim(task, task_id)
+    if duplicate is not None:
+        logging.info(f"Task {task_id} duplicates task {duplicate.task_id}")
+        state.task, state.task_id = task, duplicate.task_id
+        yield call_status_part(
+            duplicate.task_id, "reused" if duplicate.finished else "attached"
+        )
+        return
+
+    state.task, state.task_id = task, task_id
+    dedup_key = task_dedup_key(task)
+    # What concurrent duplicates should use once this task gives up its key.
+    stored: DuplicateTask | None = None
+    try:
+        if not admission.try_admit(task_id):
+            yield call_status_part(task_id, "waiting_for_capacity")
+            try:
+                await admission.admit(task_id)
+            except AdmissionRejected as e:
+                logging.warning(f"Not calling for task {task_id}: {e}")
+                await mongodb_client.store_task(task, task_id)
+                await mongodb_client.record_call_status(task_id, "rejected")
+                await mongodb_client.finish_task(
+                    task_id, outcome=f"rejected: {e.reason}"
+                )
+                yield call_status_part(task_id, "rejected")
+                return
+        yield call_status_part(task_id, "dialing")
+
+        if fake_phone_call:
+            await mongodb_client.store_task(task, task_id, dedup_key=dedup_key)
+            stored = DuplicateTask(task_id, TaskStatus.CREATED)
+            # Kicks off a "fake" phone call via your computer's speakermic.
+            asyncio.create_task(
+                stream_elevenlabs_call(mongodb_client, admission, task, task_id)
+            )
+            return
+
+        # Stored before dialing, since status callbacks and /task-stream look the
+        # task up, and a failed store must not leave a call ringing.
+        try:
+            await mongodb_client.store_task(task, task_id, dedup_key=dedup_key)
+        except Exception:
+            admission.release(task_id)
+            raise
+        try:
+            call = await request_outbound_call(task_id, twilio_client)
+        except Exception:
+            admission.release(task_id)
+            # So that duplicates don't attach to it.
+            await mongodb_client.finish_task(task_id, outcome="failed to dial")
+            raise
+        stored = DuplicateTask(task_id, TaskStatus.CREATED)
+        yield call_status_part(task_id, call.status)
+        await mongodb_client.set_call_sid(task_id, call.sid)
+        await mongodb_client.update_task_progress(
+            task_id, message={"type": "call_status", "value": call.status}
+        )
+    finally:
+        # If the task was not stored, concurrent duplicates have to look again.
+        deduplicator.release(task, stored)
+
+
+async def _set_up_confirmed_call(
+    task_or_none: Awaitable[TaskOrNone],
+    state: _TurnState,
+    twilio_client: TwilioClient,
+    mongodb_client: MongoDB,
+    admission: CallAdmissionController,
+    deduplicator: TaskDeduplicator,
+    *,
+    fake_phone_call: bool = False,
+) -> AsyncGenerator[StreamPart, None]:
+    task = (await task_or_none).task
+    if task is None:
+        return
+    async for part in set_up_call(
+        task,
+        state,
+        twilio_client,
+        mongodb_client,
+        admission,
+        deduplicator,
+        fake_phone_call=fake_phone_call,
+    ):
+        yield part
+
+
+async def _stream_task_updates(
+    state: _TurnState, mongodb_client: MongoDB, *, detach: bool = False
+) -> AsyncGenerator[StreamPart, None]:
+    """
+    The call's updates, as text, until the task finishes. If `detach` is set,
+    only where the client can follow them instead.
+    """
+    if state.task_id is None:
+        return
+    if detach:
+        yield data_part(
+            [
+                {
+                    "type": "task_stream",
+                    "taskId": state.task_id,
+                    "url": f"/api/tasks/{state.task_id}/stream",
+                }
+            ]
+        )
+        return
+    async for update_str in generate_update_stream(
+        mongodb_client, state.task.business_name, state.task_id
+    ):
+        yield text_part(update_str)
+
+
 async def mock_gemini_do_stream(
     gemini_client: genai.Client,  # pylint: disable=unused-argument
-    mcp_session_group: ClientSessionGroup,  # pylint: disable=unused-argument
+    mcp_session_group: McpTools,  # pylint: disable=unused-argument
     twilio_client: TwilioClient,
     mongodb_client: MongoDB,
-    messages: List[ClientMessage],  # pylint: disable=unused-argument
+    admission: CallAdmissionController,
+    deduplicator: TaskDeduplicator,
+    prompt_cache: PromptCache,  # pylint: disable=unused-argument
+    conversation_store: ConversationStore,
+    conversation: Conversation,
+    new_messages: list[Content],
     *,
     model: str = "gemini-2.0-flash",  # pylint: disable=unused-argument
     fake_phone_call: bool = False,
+    detach: bool = False,
 ):
-    yield create_text_response(
+    reply = (
         "Okay, I will look up Riverside Market. I am looking up the phone number for "
         "Riverside Market. I am looking up Riverside Market. I found a Riverside Market"
         " at 300 Albany St, New York, NY 10280. Their phone number is (212) 945-0500. "
         "You would like me to call them to ask if they sell Heinz Mayo. Is that "
         "correct?"
     )
-
     task = Task(
         business_name="Riverside Market",
         business_phone_number="(212) 945-0500",
         task="Ask if they sell Heinz Mayo",
     )
-    # Store the task in MongoDB
-    task_id = await mongodb_client.store_task(task)
-    if fake_phone_call:
-        # Kicks off a "fake" phone call via your computer's speakermic.
-        asyncio.create_task(stream_elevenlabs_call(mongodb_client, task, task_id))
-    else:
-        # Kicks off a Twilio phone call
-        await request_outbound_call(task_id, twilio_client)
+    state = _TurnState()
+    async with conversation.lock:
+        yield text_part(reply)
+        async for part in set_up_call(
+            task,
+            state,
+            twilio_client,
+            mongodb_client,
+            admission,
+            deduplicator,
+            fake_phone_call=fake_phone_call,
+        ):
+            yield part
+        conversation.extend(
+            [*new_messages, Content(role="model", parts=[Part(text=reply)])]
+        )
+        conversation_store.save(conversation)
 
     # Watch and yield task updates
-    async for update_str in generate_update_stream(
-        mongodb_client, task.business_name, task_id
-    ):
-        yield create_text_response(update_str)
+    async for part in _stream_task_updates(state, mongodb_client, detach=detach):
+        yield part
 
-    yield create_end_response(
-        finish_reason="stop",
-        usage_metadata=GenerateContentResponseUsageMetadata(
-            prompt_token_count=0,
-            candidates_token_count=0,
-        ),
-    )
+    yield finish_message_part(state.finish_reason)
+
+
+async def _model_turn(
+    gemini_client: genai.Client,
+    mcp_session_group: McpTools,
+    config: GenerateContentConfig,
+    conversation_store: ConversationStore,
+    conversation: Conversation,
+    new_messages: list[Content],
+    state: _TurnState,
+    usage: UsageTracker,
+    *,
+    model: str,
+) -> AsyncGenerator[StreamPart, None]:
+    contents = [*conversation.history, *new_messages]
+    # The new messages and everything the model and tools added this turn, kept
+    # in the conversation once the turn completes, so the client only has to send
+    # its new messages next turn.
+    turn: list[Content] = list(new_messages)
+    message_id = f"msg-{uuid.uuid4().hex}"
+    for _ in range(MAX_TOOL_CALL_ROUNDS):
+        yield start_step_part(message_id)
+        model_parts: list[Part] = []
+        function_calls = []
+        timer = usage.gemini_call("chat", model)
+        async for response in await gemini_client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=config,
+        ):
+            timer.on_response(response)
+            assert len(response.candidates) <= 1, "Expected at most 1 candidate"
+            if response.text is not None:
+                yield text_part(response.text)
+            if response.function_calls:
+                function_calls.extend(response.function_calls)
+
+            assert len(response.candidates) == 1
+            if response.candidates[0].content and response.candidates[0].content.parts:
+                model_parts.extend(response.candidates[0].content.parts)
+            if response.candidates[0].finish_reason is not None:
+                state.finish_reason = _FINISH_REASONS.get(
+                    response.candidates[0].finish_reason.value, "other"
+                )
+        record = timer.finish()
+
+        if model_parts:
+            turn.append(Content(role="model", parts=_merge_text_parts(model_parts)))
+
+        response_parts: list[Part] = []
+        for function_call in function_calls:
+            tool_call_id = function_call.id or f"call-{uuid.uuid4().hex}"
+            yield tool_call_part(
+                tool_call_id, function_call.name, function_call.args or {}
+            )
+            response_part = await call_tool(mcp_session_group, function_call)
+            yield tool_result_part(
+                tool_call_id, response_part.function_response.response
+            )
+            response_parts.append(response_part)
+
+        yield finish_step_part(
+            "tool-calls" if function_calls else state.finish_reason,
+            prompt_tokens=record.prompt_tokens,
+            completion_tokens=record.completion_tokens,
+        )
+        if not function_calls:
+            break
+        turn.append(Content(role="user", parts=response_parts))
+        contents.extend(turn[-2:])
+
+    conversation.extend(turn)
+    conversation_store.save(conversation)
 
 
 async def do_stream(
     gemini_client: genai.Client,
-    mcp_session_group: ClientSessionGroup,
+    mcp_session_group: McpTools,
     twilio_client: TwilioClient,
     mongodb_client: MongoDB,
-    messages: List[ClientMessage],
+    admission: CallAdmissionController,
+    deduplicator: TaskDeduplicator,
+    prompt_cache: PromptCache,
+    conversation_store: ConversationStore,
+    conversation: Conversation,
+    new_messages: list[Content],
     *,
     model: str = "gemini-2.0-flash",
     fake_phone_call: bool = False,
+    detach: bool = False,
 ):
-    all_messages = convert_to_gemini_messages(messages)
-
-    async for response in await gemini_client.aio.models.generate_content_stream(
+    # Tools are passed as declarations (rather than the MCP sessions themselves) so
+    # that they can be part of the cached prompt prefix. As a consequence, function
+    # calls are executed here instead of by the SDK.
+    tools = gemini_tools(mcp_session_group)
+    config = await prompt_cache.get_config(
+        name="chat",
         model=model,
-        contents=all_messages,
-        config=create_config(mcp_session_group.sessions),
-    ):
-        assert len(response.candidates) <= 1, "Expected at most 1 candidate"
-        if response.text is not None:
-            yield create_text_response(response.text)
-
-        assert len(response.candidates) == 1
-        if response.candidates[0].finish_reason is not None:
-            yield create_end_response(
-                finish_reason=response.candidates[0].finish_reason.value,
-                usage_metadata=response.usage_metadata,
+        build_config=lambda: create_config(tools),
+        fingerprint=tools_fingerprint(tools),
+    )
+    task_config = await prompt_cache.get_config(
+        name="task", model=model, build_config=create_task_config
+    )
+    usage = UsageTracker()
+    state = _TurnState()
+    # Turns of the same conversation would otherwise interleave their history.
+    async with conversation.lock:
+        # Whether the user confirmed a task only depends on their messages, so it
+        # is decided while the model writes its reply. If they did, the call is
+        # placed concurrently with the rest of the reply.
+        task_or_none = asyncio.create_task(
+            generate_task(
+                client=gemini_client,
+                messages=[*conversation.history, *new_messages],
+                model=model,
+                config=task_config,
+                usage=usage,
             )
-
-    task_or_none = await generate_task(client=gemini_client, messages=all_messages)
-    if task_or_none.task is not None:
-        # Store the task in MongoDB
-        task_id = await mongodb_client.store_task(task_or_none.task)
-        if fake_phone_call:
-            # Kicks off a "fake" phone call via your computer's speakermic.
-            asyncio.create_task(
-                stream_elevenlabs_call(mongodb_client, task_or_none.task, task_id)
+        )
+        try:
+            turn_and_call_setup = aiostream.stream.merge(
+                _model_turn(
+                    gemini_client,
+                    mcp_session_group,
+                    config,
+                    conversation_store,
+                    conversation,
+                    new_messages,
+                    state,
+                    usage,
+                    model=model,
+                ),
+                _set_up_confirmed_call(
+                    task_or_none,
+                    state,
+                    twilio_client,
+                    mongodb_client,
+                    admission,
+                    deduplicator,
+                    fake_phone_call=fake_phone_call,
+                ),
             )
-        else:
-            # Kicks off a Twilio phone call
-            await request_outbound_call(task_id, twilio_client)
+            async with turn_and_call_setup.stream() as parts:
+                async for part in parts:
+                    yield part
+        finally:
+            task_or_none.cancel()
 
-        # Watch and yield task updates
-        async for update_str in generate_update_stream(
-            mongodb_client, task_or_none.task.business_name, task_id
-        ):
-            yield create_text_response(update_str)
-
-        yield create_end_response(
-            finish_reason="stop",
-            usage_metadata=GenerateContentResponseUsageMetadata(
-                prompt_token_count=0,
-                candidates_token_count=0,
-            ),
-        )
+    prompt_tokens, completion_tokens = usage.total_tokens()
+    logging.info(
+        f"Chat turn used {prompt_tokens} prompt and {completion_tokens} completion "
+        f"tokens over {len(usage.records)} Gemini calls"
+    )
+    await mongodb_client.add_conversation_usage(
+        conversation.conversation_id, usage.records
+    )
+    if state.task_id is not None:
+        await mongodb_client.add_usage(state.task_id, usage.records)
+
+    # Watch and yield task updates
+    async for part in _stream_task_updates(state, mongodb_client, detach=detach):
+        yield part
+
+    yield finish_message_part(
+        state.finish_reason,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+    )
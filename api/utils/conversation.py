@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from cachetools import TTLCache
+
+from api.utils.metrics import REGISTRY, Sample
+
+if TYPE_CHECKING:
+    from google.genai.types import Content
+
+# Rough per-message overhead (object headers, role, part wrappers) used when
+# estimating how much memory a conversation takes.
+_CONTENT_OVERHEAD_BYTES = 256
+
+
+def _estimate_size(content: "Content") -> int:
+    size = _CONTENT_OVERHEAD_BYTES
+    for part in content.parts or []:
+        if part.text is not None:
+            size += len(part.text)
+        else:
+            size += len(part.model_dump_json(exclude_none=True))
+    return size
+
+
+@dataclass
+class Conversation:
+    conversation_id: str
+    # The conversation converted to Gemini contents, including tool calls.
+    history: list["Content"] = field(default_factory=list)
+    size_bytes: int = 0
+    # Held for a turn, from reading the history until the turn is added to it.
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    def extend(self, contents: list["Content"]):
+        self.history.extend(contents)
+        self.size_bytes += sum(_estimate_size(c) for c in contents)
+
+
+class ConversationStore:
+    """
+    Keeps the converted Gemini history of recent conversations in memory, so that
+    /api/chat clients only need to send the messages that are new since the last
+    turn. A turn's messages are only added to the history once it completes, and
+    the turns of a conversation run one at a time (see `Conversation.lock`).
+
+    Memory is bounded by `max_bytes` (least recently used conversations are evicted
+    first) and conversations idle for longer than `ttl` expire. Clients whose
+    conversation was evicted have to start over by sending the full history.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: timedelta = timedelta(hours=1),
+    ):
+        self._conversations: TTLCache[str, Conversation] = TTLCache(
+            maxsize=max_bytes,
+            ttl=ttl.total_seconds(),
+            getsizeof=lambda conversation: max(conversation.size_bytes, 1),
+        )
+        REGISTRY.collected(
+            "conversations_stored",
+            "Conversations kept in memory.",
+            lambda: [Sample({}, len(self._conversations))],
+        )
+        REGISTRY.collected(
+            "conversation_store_bytes",
+            "Estimated memory used by stored conversations.",
+            lambda: [Sample({}, self._conversations.currsize)],
+        )
+
+    def create(self) -> Conversation:
+        conversation = Conversation(conversation_id=uuid.uuid4().hex)
+        self.save(conversation)
+        return conversation
+
+    def get(self, conversation_id: str) -> Conversation | None:
+        return self._conversations.get(conversation_id)
+
+    def save(self, conversation: Conversation):
+        """
+        (Re-)inserts `conversation`. Must be called after it grows so that its
+        size is accounted for, which also refreshes its TTL.
+        """
+        try:
+            self._conversations[conversation.conversation_id] = conversation
+        except ValueError:
+            # Larger than the whole store. The client will have to resend it.
+            logging.warning(
+                f"Conversation {conversation.conversation_id} is too large to keep"
+            )
+            self._conversations.pop(conversation.conversation_id, None)
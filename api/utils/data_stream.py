@@ -0,0 +1,240 @@
+import asyncio
+import json
+import logging
+from contextlib import aclosing
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any, AsyncGenerator, Awaitable, Callable
+
+from api.utils.metrics import REGISTRY
+
+# Implements the Vercel AI SDK data stream protocol (v1):
+# https://sdk.vercel.ai/docs/ai-sdk-ui/stream-protocol#data-stream-protocol
+
+
+@dataclass
+class StreamPart:
+    # The part type, e.g. "0" for text or "d" for finish message.
+    code: str
+    value: Any
+
+    def encode(self) -> bytes:
+        return f"{self.code}:{json.dumps(self.value)}\n".encode("utf-8")
+
+
+def _usage(prompt_tokens: int | None, completion_tokens: int | None) -> dict:
+    return {
+        "promptTokens": prompt_tokens or 0,
+        "completionTokens": completion_tokens or 0,
+    }
+
+
+def text_part(text: str) -> StreamPart:
+    return StreamPart("0", text)
+
+
+def data_part(values: list[Any]) -> StreamPart:
+    return StreamPart("2", values)
+
+
+def error_part(message: str) -> StreamPart:
+    return StreamPart("3", message)
+
+
+def message_annotation_part(annotations: list[Any]) -> StreamPart:
+    return StreamPart("8", annotations)
+
+
+def tool_call_part(tool_call_id: str, tool_name: str, args: dict) -> StreamPart:
+    return StreamPart(
+        "9", {"toolCallId": tool_call_id, "toolName": tool_name, "args": args}
+    )
+
+
+def tool_result_part(tool_call_id: str, result: Any) -> StreamPart:
+    return StreamPart("a", {"toolCallId": tool_call_id, "result": result})
+
+
+def tool_call_streaming_start_part(tool_call_id: str, tool_name: str) -> StreamPart:
+    return StreamPart("b", {"toolCallId": tool_call_id, "toolName": tool_name})
+
+
+def tool_call_delta_part(tool_call_id: str, args_text_delta: str) -> StreamPart:
+    return StreamPart(
+        "c", {"toolCallId": tool_call_id, "argsTextDelta": args_text_delta}
+    )
+
+
+def start_step_part(message_id: str) -> StreamPart:
+    return StreamPart("f", {"messageId": message_id})
+
+
+def finish_step_part(
+    finish_reason: str,
+    *,
+    prompt_tokens: int | None = 0,
+    completion_tokens: int | None = 0,
+    is_continued: bool = False,
+) -> StreamPart:
+    return StreamPart(
+        "e",
+        {
+            "finishReason": finish_reason,
+            "usage": _usage(prompt_tokens, completion_tokens),
+            "isContinued": is_continued,
+        },
+    )
+
+
+def finish_message_part(
+    finish_reason: str,
+    *,
+    prompt_tokens: int | None = 0,
+    completion_tokens: int | None = 0,
+) -> StreamPart:
+    return StreamPart(
+        "d",
+        {
+            "finishReason": finish_reason,
+            "usage": _usage(prompt_tokens, completion_tokens),
+        },
+    )
+
+
+def _coalesce(parts: list[StreamPart]) -> bytes:
+    """Encodes `parts`, merging runs of text parts into a single text part."""
+    merged: list[StreamPart] = []
+    for part in parts:
+        if part.code == "0" and merged and merged[-1].code == "0":
+            merged[-1] = text_part(merged[-1].value + part.value)
+        else:
+            merged.append(part)
+    return b"".join(part.encode() for part in merged)
+
+
+_END = object()
+
+_streams_active = REGISTRY.gauge(
+    "chat_streams_active", "Data streams currently sending to clients."
+)
+_chunks_sent = REGISTRY.counter(
+    "chat_stream_chunks_total", "HTTP chunks sent on data streams."
+)
+_stream_endings = REGISTRY.counter(
+    "chat_streams_ended_total",
+    "Data streams that ended, by reason (done or disconnect).",
+)
+_producer_errors = REGISTRY.counter(
+    "chat_stream_errors_total", "Data streams whose producer raised."
+)
+
+
+class DataStreamWriter:
+    """
+    Turns an async generator of `StreamPart`s into HTTP chunks.
+
+    The first part is sent right away (to keep time-to-first-token low). After
+    that, parts that arrive within `flush_interval` of each other are sent as a
+    single chunk, with adjacent text parts merged, up to `max_chunk_bytes`.
+
+    If `parts` raises, an error part is sent and the stream ends. If the client
+    disconnects, `parts` is closed, so whatever it holds (the model stream, Mongo
+    change streams) is released promptly instead of when the next chunk fails to
+    send.
+    """
+
+    def __init__(
+        self,
+        parts: AsyncGenerator[StreamPart, None],
+        *,
+        is_disconnected: Callable[[], Awaitable[bool]] | None = None,
+        flush_interval: timedelta = timedelta(milliseconds=50),
+        disconnect_poll_interval: timedelta = timedelta(seconds=1),
+        max_chunk_bytes: int = 16 * 1024,
+        max_pending_parts: int = 256,
+    ):
+        self.parts = parts
+        self.is_disconnected = is_disconnected
+        self.flush_interval = flush_interval
+        self.disconnect_poll_interval = disconnect_poll_interval
+        self.max_chunk_bytes = max_chunk_bytes
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending_parts)
+
+    async def _pump(self):
+        try:
+            async with aclosing(self.parts) as parts:
+                async for part in parts:
+                    await self._queue.put(part)
+        except Exception:
+            logging.exception("Data stream producer failed")
+            _producer_errors.inc()
+            # The details may include provider errors and ids, so they are only
+            # logged.
+            await self._queue.put(error_part("An error occurred."))
+        finally:
+            # The consumer drains the queue until it sees _END. If it is gone, this
+            # task is being cancelled anyway.
+            await self._queue.put(_END)
+
+    async def _next(self, timeout: float | None):
+        """Returns the next part, _END, or None on timeout."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _client_gone(self) -> bool:
+        return self.is_disconnected is not None and await self.is_disconnected()
+
+    async def stream(self) -> AsyncGenerator[bytes, None]:
+        loop = asyncio.get_running_loop()
+        pump = asyncio.create_task(self._pump())
+        first_chunk = True
+        _streams_active.inc()
+        try:
+            ended = False
+            while not ended:
+                part = await self._next(self.disconnect_poll_interval.total_seconds())
+                if part is None:
+                    if await self._client_gone():
+                        logging.info("Client disconnected, closing data stream")
+                        _stream_endings.inc(reason="disconnect")
+                        return
+                    continue
+                if part is _END:
+                    _stream_endings.inc(reason="done")
+                    return
+
+                buffer = [part]
+                size = len(part.encode())
+                deadline = loop.time() + (
+                    0 if first_chunk else self.flush_interval.total_seconds()
+                )
+                first_chunk = False
+                while size < self.max_chunk_bytes:
+                    # Take whatever is already queued, then wait until the deadline.
+                    if self._queue.empty():
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        part = await self._next(remaining)
+                        if part is None:
+                            break
+                    else:
+                        part = self._queue.get_nowait()
+                    if part is _END:
+                        ended = True
+                        break
+                    buffer.append(part)
+                    size += len(part.encode())
+
+                _chunks_sent.inc()
+                yield _coalesce(buffer)
+            _stream_endings.inc(reason="done")
+        finally:
+            _streams_active.dec()
+            pump.cancel()
+            try:
+                await pump
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import random
+from collections import Counter
+from contextlib import aclosing
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from twilio.base.exceptions import TwilioRestException
+from twilio.rest import Client as TwilioClient
+
+from api.utils.admission import AdmissionRejected, CallAdmissionController
+from api.utils.mongodb import MongoDB, QueuedTask
+from api.utils.task import TaskStatus
+from api.utils.twilio_phone_call import CallControl, request_outbound_call
+
+
+@dataclass
+class DialerLimits:
+    # Calls this process dials at the same time, across all batches.
+    max_concurrent_calls: int = 5
+    # Calls to the same business (phone number) at the same time.
+    max_calls_per_business: int = 1
+    retry_backoff: timedelta = timedelta(minutes=2)
+    max_retry_backoff: timedelta = timedelta(minutes=30)
+    # Calls still going after this long are hung up.
+    max_call_duration: timedelta = timedelta(minutes=20)
+
+
+class DialScheduler:
+    """
+    Dials tasks submitted in bulk (see `MongoDB.store_batch`).
+
+    A pool of `max_concurrent_calls` workers claims queued tasks from MongoDB in
+    priority order, places their calls and waits for them to finish. Busy or
+    unanswered calls are requeued with exponential backoff until they run out of
+    attempts, without passing through FINISHED. Tasks for businesses that already
+    have `max_calls_per_business` calls in progress are skipped until one of those
+    ends, and nothing is dialed while the admission controller is out of capacity.
+
+    Claims are atomic, so several processes can share the queue. The per-business
+    cap is only enforced within a process.
+    """
+
+    def __init__(
+        self,
+        twilio_client: TwilioClient,
+        mongodb_client: MongoDB,
+        admission: CallAdmissionController,
+        limits: DialerLimits | None = None,
+        poll_interval: timedelta = timedelta(seconds=2),
+    ):
+        self.twilio_client = twilio_client
+        self.mongodb_client = mongodb_client
+        self.admission = admission
+        self.limits = limits or DialerLimits()
+        self.poll_interval = poll_interval
+        self._calls_per_business: Counter[str] = Counter()
+        self._claim_lock = asyncio.Lock()
+        self._submitted = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+
+    async def start(self):
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"dialer-{i}")
+            for i in range(self.limits.max_concurrent_calls)
+        ]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def notify_submitted(self):
+        """Wakes up idle workers, so new tasks are dialed without waiting a poll."""
+        self._submitted.set()
+
+    async def _wait_for_work(self):
+        try:
+            await asyncio.wait_for(
+                self._submitted.wait(), self.poll_interval.total_seconds()
+            )
+        except asyncio.TimeoutError:
+            pass
+        self._submitted.clear()
+
+    async def _claim(self) -> QueuedTask | None:
+        async with self._claim_lock:
+            busy = [
+                key
+                for key, count in self._calls_per_business.items()
+                if count >= self.limits.max_calls_per_business
+            ]
+            queued = await self.mongodb_client.claim_queued_task(
+                exclude_phone_keys=busy
+            )
+            if queued is not None:
+                self._calls_per_business[queued.business_phone_key] += 1
+            return queued
+
+    def _release_business(self, queued: QueuedTask):
+        self._calls_per_business[queued.business_phone_key] -= 1
+        if self._calls_per_business[queued.business_phone_key] <= 0:
+            del self._calls_per_business[queued.business_phone_key]
+
+    async def _worker(self):
+        while True:
+            if not self.admission.has_capacity():
+                await self._wait_for_work()
+                continue
+            try:
+                queued = await self._claim()
+            except Exception:
+                logging.exception("Failed to claim a queued task")
+                queued = None
+            if queued is None:
+                await self._wait_for_work()
+                continue
+
+            try:
+                await self._dial(queued)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"Dialing task {queued.task_id} failed")
+            finally:
+                self._release_business(queued)
+
+    async def _dial(self, queued: QueuedTask):
+        task_id = queued.task_id
+        try:
+            await self.admission.admit(task_id)
+        except AdmissionRejected:
+            # Capacity went away since the check; this attempt doesn't count.
+            await self.mongodb_client.requeue_task(
+                task_id, next_attempt_at=datetime.now(), refund_attempt=True
+            )
+            return
+
+        if queued.attempts < queued.max_attempts:
+            backoff = min(
+                self.limits.retry_backoff * 2 ** (queued.attempts - 1),
+                self.limits.max_retry_backoff,
+            )
+            # Jittered, so tasks that failed together don't all retry together.
+            backoff *= random.uniform(0.8, 1.2)
+            # Applied by finish_task if the attempt fails with a retryable outcome,
+            # so that the task is never seen as finished in between.
+            await self.mongodb_client.set_retry_backoff(task_id, backoff)
+
+        logging.info(
+            f"Dialing task {task_id} (attempt {queued.attempts}/{queued.max_attempts})"
+        )
+        try:
+            call = await request_outbound_call(task_id, self.twilio_client)
+        except Exception as e:
+            logging.error(f"Could not place call for task {task_id}: {e}")
+            self.admission.release(task_id)
+            await self.mongodb_client.finish_task(task_id, outcome="failed to dial")
+        else:
+            await self.mongodb_client.set_call_sid(task_id, call.sid)
+            await self._wait_until_finished(task_id, call.sid)
+
+    async def _wait_until_finished(self, task_id: str, call_sid: str):
+        try:
+            async with asyncio.timeout(self.limits.max_call_duration.total_seconds()):
+                async with aclosing(
+                    self.mongodb_client.watch_task_updates(task_id)
+                ) as updates:
+                    async for update in updates:
+                        # Queued again if the attempt is to be retried.
+                        if update.status in (TaskStatus.FINISHED, TaskStatus.QUEUED):
+                            return
+        except TimeoutError:
+            logging.warning(f"Call for task {task_id} ran too long, hanging up")
+            try:
+                await CallControl(self.twilio_client).hangup(call_sid)
+            except TwilioRestException as e:
+                logging.error(f"Could not hang up call for task {task_id}: {e}")
+            await self.mongodb_client.finish_task(task_id, outcome="timed out")
@@ -4,10 +4,10 @@ from elevenlabs.client import ElevenLabs
 from elevenlabs.conversational_ai.conversation import Conversation
 from elevenlabs.conversational_ai.default_audio_interface import DefaultAudioInterface
 
-from api.utils.settings import get_setting
+from api.utils.settings import get_settings
 
-agent_id = get_setting("ELEVENLABS_AGENT_ID")
-api_key = get_setting("ELEVENLABS_API_KEY")
+agent_id = get_settings().elevenlabs_agent_id
+api_key = get_settings().elevenlabs_api_key
 
 elevenlabs_client = ElevenLabs(api_key=api_key)
 
@@ -6,26 +6,44 @@ from api.audio_stream.elevenlabs_conversation import ElevenLabsConversation
 from api.audio_stream.local_speakermic_operator import LocalSpeakerMicOperator
 from api.audio_stream.mongodb_forwarder import MongoDBForwarder
 from api.audio_stream.stream_mediator import StreamMediator
+from api.utils.admission import CallAdmissionController
 from api.utils.mongodb import MongoDB
 from api.utils.task import Task
 
 
-async def stream_call(mongodb_client: MongoDB, task: Task, task_id: str):
+async def stream_call(
+    mongodb_client: MongoDB,
+    admission: CallAdmissionController,
+    task: Task,
+    task_id: str,
+):
+    admission.connected(task_id)
     try:
+        elevenlabs_conversation = ElevenLabsConversation(
+            conversation_config=ConversationInitiationData(
+                dynamic_variables={
+                    "task": task.task,
+                    "business_name": task.business_name,
+                },
+            )
+        )
         new_stream_mediator = StreamMediator(
             [
                 LocalSpeakerMicOperator(out_queue_max_size=100),
-                ElevenLabsConversation(
-                    conversation_config=ConversationInitiationData(
-                        dynamic_variables={
-                            "task": task.task,
-                            "business_name": task.business_name,
-                        },
-                    )
+                elevenlabs_conversation,
+                MongoDBForwarder(
+                    task_id,
+                    mongodb_client,
+                    transcript_separator=elevenlabs_conversation.transcript_separator,
                 ),
-                MongoDBForwarder(task_id, mongodb_client),
-            ]
+            ],
+            task_id=task_id,
         )
         await new_stream_mediator.run()
+        await mongodb_client.add_usage(
+            task_id, [elevenlabs_conversation.usage_record()]
+        )
     except asyncio.CancelledError:
         pass
+    finally:
+        admission.release(task_id)
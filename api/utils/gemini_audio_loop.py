@@ -6,10 +6,10 @@ from google.genai import types
 from api.audio_stream.gemini_stream_operator import GeminiStreamOperator
 from api.audio_stream.local_speakermic_operator import LocalSpeakerMicOperator
 from api.audio_stream.stream_mediator import StreamMediator
-from api.utils.settings import get_setting
+from api.utils.settings import get_settings
 
 client = genai.Client(
-    api_key=get_setting("GEMINI_API_KEY"), http_options={"api_version": "v1alpha"}
+    api_key=get_settings().gemini_api_key, http_options={"api_version": "v1alpha"}
 )
 
 # The thinking one: gemini-2.5-flash-exp-native-audio-thinking-dialog
@@ -31,7 +31,7 @@ async def run_new_stream_mediator():
         new_stream_mediator = StreamMediator(
             [
                 LocalSpeakerMicOperator(),
-                GeminiStreamOperator(session=session),
+                GeminiStreamOperator(session=session, model=MODEL),
             ]
         )
         await new_stream_mediator.run()
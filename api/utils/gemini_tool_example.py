@@ -4,9 +4,9 @@ from google import genai
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
-from api.utils.settings import get_setting
+from api.utils.settings import get_settings
 
-client = genai.Client(api_key=get_setting("GEMINI_API_KEY"))
+client = genai.Client(api_key=get_settings().gemini_api_key)
 
 # Inspired by https://ai.google.dev/gemini-api/docs/function-calling?example=meeting#model_context_protocol_mcp
 # Create server parameters for stdio connection
@@ -16,7 +16,7 @@ server_params = StdioServerParameters(
     # https://github.com/modelcontextprotocol/servers-archived
     args=["-y", "@modelcontextprotocol/server-google-maps"],  # MCP Server
     env={
-        "GOOGLE_MAPS_API_KEY": get_setting("GOOGLE_MAPS_API_KEY"),
+        "GOOGLE_MAPS_API_KEY": get_settings().google_maps_api_key,
     },
 )
 
@@ -0,0 +1,86 @@
+"""
+Measures how long importing the API entry point takes in a fresh interpreter,
+which is what a cold start pays before serving anything. Fails if the median
+import time is over budget, or if a provider SDK is imported eagerly again.
+
+    python -m api.utils.import_benchmark --budget-ms 800
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Loaded in the background after startup (see api/index.py), so importing the
+# entry point must not pull them in.
+LAZY_MODULES = [
+    "google.genai",
+    "twilio.rest",
+    "mcp",
+    "elevenlabs",
+    "motor",
+    "aiostream",
+]
+
+_PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import api.index
+elapsed_ms = (time.perf_counter() - start) * 1000
+eager = [m for m in {LAZY_MODULES!r} if m in sys.modules]
+print(json.dumps({{"elapsed_ms": elapsed_ms, "eager": eager}}))
+"""
+
+
+def _run_probe(importtime: bool = False) -> tuple[dict, str]:
+    args = [sys.executable, *(["-X", "importtime"] if importtime else []), "-c"]
+    result = subprocess.run([*args, _PROBE], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def _slowest_imports(importtime_log: str, count: int) -> list[tuple[str, int]]:
+    """The slowest modules imported by api.index, with their cumulative time (µs)."""
+    modules = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        # Nesting is shown by two spaces per level. Keep api.index (one space)
+        # and what it imports directly.
+        if len(name) - len(name.lstrip()) <= 3:
+            modules.append((name.strip(), int(cumulative)))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=800)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    # The first run warms the bytecode cache.
+    _run_probe()
+    results = [_run_probe()[0] for _ in range(args.runs)]
+    median_ms = statistics.median(r["elapsed_ms"] for r in results)
+    print(f"import api.index: median {median_ms:.0f}ms over {args.runs} runs")
+
+    _, importtime_log = _run_probe(importtime=True)
+    print("Slowest imports:")
+    for name, cumulative_us in _slowest_imports(importtime_log, args.top):
+        print(f"  {cumulative_us / 1000:8.1f}ms  {name}")
+
+    failed = False
+    eager = results[-1]["eager"]
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print(f"FAIL: over the {args.budget_ms:.0f}ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
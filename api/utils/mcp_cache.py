@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any
+
+from cachetools import TTLCache
+from mcp.types import CallToolResult
+from mcp.types import Tool as McpTool
+from pymongo.errors import PyMongoError
+
+from api.utils.mcp_util import McpTools
+from api.utils.mongodb import MongoDB
+
+# Arguments that are free text, e.g. of the Google Maps server's tools, and can be
+# matched regardless of case and whitespace. Others, e.g. place_id, may be case
+# sensitive, so they are kept as they are.
+_FREE_TEXT_ARGS = {
+    "query",
+    "address",
+    "origin",
+    "destination",
+    "origins",
+    "destinations",
+}
+
+
+def _normalize(value: Any, free_text: bool = False) -> Any:
+    if isinstance(value, str):
+        return " ".join(value.casefold().split()) if free_text else value
+    if isinstance(value, float):
+        # ~10cm for coordinates, which is well below what changes a lookup.
+        return round(value, 6)
+    if isinstance(value, dict):
+        return {
+            str(k): _normalize(v, free_text or k in _FREE_TEXT_ARGS)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v, free_text) for v in value]
+    return value
+
+
+def tool_cache_key(name: str, args: dict[str, Any]) -> str:
+    """
+    Returns the cache key for a tool call. Tool names and free-text arguments are
+    case- and whitespace-normalized so that e.g. "Riverside  Market" and
+    "riverside market" share an entry.
+    """
+    normalized = json.dumps(
+        [name.strip().casefold(), _normalize(args)],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class McpToolCache:
+    """
+    Caching proxy in front of MCP tool calls. Implements `McpTools`, so it can be
+    used wherever the session group is.
+
+    Lookups go through:
+      1. An in-process LRU cache with TTL eviction.
+      2. The `tool_cache` collection in MongoDB, shared across processes.
+      3. The wrapped tools. Concurrent identical calls are collapsed into one.
+
+    Only successful results are cached. The MongoDB tier is best-effort: if it is
+    unavailable the call falls through to the wrapped tools.
+
+    This class does not own the lifetime of `tools` or `mongodb_client`.
+    """
+
+    def __init__(
+        self,
+        tools: McpTools,
+        mongodb_client: MongoDB,
+        *,
+        ttl: timedelta = timedelta(hours=6),
+        max_entries: int = 1024,
+    ):
+        self._wrapped = tools
+        self.mongodb_client = mongodb_client
+        self.ttl = ttl
+        self._memory: TTLCache[str, CallToolResult] = TTLCache(
+            maxsize=max_entries, ttl=ttl.total_seconds()
+        )
+        self._in_flight: dict[str, asyncio.Task[CallToolResult]] = {}
+
+    @property
+    def tools(self) -> dict[str, McpTool]:
+        return self._wrapped.tools
+
+    async def call_tool(self, name: str, args: dict[str, Any]) -> CallToolResult:
+        key = tool_cache_key(name, args)
+        if (result := self._memory.get(key)) is not None:
+            return result
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._lookup(key, name, args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shielded so that a cancelled caller does not cancel the lookup for
+        # everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key: str, name: str, args: dict[str, Any]):
+        try:
+            stored = await self.mongodb_client.get_tool_result(key)
+        except PyMongoError as e:
+            logging.warning(f"Tool cache lookup failed for {name}: {e}")
+            stored = None
+        if stored is not None:
+            result = CallToolResult.model_validate(stored)
+            self._memory[key] = result
+            return result
+
+        result = await self._wrapped.call_tool(name, args)
+        if result.isError:
+            return result
+
+        self._memory[key] = result
+        try:
+            await self.mongodb_client.store_tool_result(
+                key,
+                tool_name=name,
+                result=result.model_dump(mode="json", exclude_none=True),
+                expires_at=datetime.now() + self.ttl,
+            )
+        except PyMongoError as e:
+            logging.warning(f"Failed to store tool result for {name}: {e}")
+        return result
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import timedelta
+from typing import Any
+
+from mcp import ClientSession, StdioServerParameters, stdio_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CallToolResult, TextContent
+from mcp.types import Tool as McpTool
+
+
+class _PooledSession:
+    """
+    One MCP server process and its client session.
+
+    The stdio transport and session are entered and exited by a dedicated runner
+    task, since their (anyio) contexts must be exited by the task that entered them.
+    """
+
+    def __init__(self, name: str, params: StdioServerParameters):
+        self.name = name
+        self.params = params
+        self.session: ClientSession | None = None
+        self.in_flight = 0
+        self.healthy = False
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+
+    async def start(self, timeout: timedelta):
+        assert self._runner is None, "Session already started?"
+        self._runner = asyncio.create_task(self._run(), name=f"mcp-{self.name}")
+        ready = asyncio.create_task(self._ready.wait())
+        done, _ = await asyncio.wait(
+            [self._runner, ready],
+            timeout=timeout.total_seconds(),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if ready not in done:
+            ready.cancel()
+            await self.stop()
+            raise RuntimeError(f"MCP session {self.name} failed to start")
+        self.healthy = True
+
+    async def _run(self):
+        try:
+            async with stdio_client(self.params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            logging.error(f"MCP session {self.name} exited: {e}")
+        finally:
+            self.healthy = False
+            self.session = None
+
+    def is_running(self) -> bool:
+        return self._runner is not None and not self._runner.done()
+
+    async def stop(self):
+        self.healthy = False
+        self._stop.set()
+        if self._runner is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._runner), timeout=5)
+        except asyncio.TimeoutError:
+            # Exiting the stdio transport terminates the server process, so the
+            # runner has to be cancelled rather than abandoned.
+            logging.warning(f"MCP session {self.name} did not stop, cancelling it")
+            self._runner.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._runner
+
+
+class McpSessionPool:
+    """
+    A pool of prewarmed MCP server processes. Implements `McpTools`, so it can be
+    used wherever the session group is.
+
+    Each server gets `size` sessions, each with its own stdio process, so that
+    concurrent tool calls are not serialized on a single pipe. Tool calls are
+    dispatched to the healthy session with the fewest calls in flight. Sessions
+    are pinged periodically and restarted when they fail.
+    """
+
+    def __init__(
+        self,
+        servers: list[StdioServerParameters],
+        *,
+        size: int = 2,
+        health_check_interval: timedelta = timedelta(seconds=30),
+        ping_timeout: timedelta = timedelta(seconds=5),
+        start_timeout: timedelta = timedelta(seconds=60),
+    ):
+        assert size > 0, "Pool size must be positive"
+        self.servers = servers
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.ping_timeout = ping_timeout
+        self.start_timeout = start_timeout
+        self._sessions: list[list[_PooledSession]] = [[] for _ in servers]
+        self._tools: dict[str, McpTool] = {}
+        self._tool_to_server: dict[str, int] = {}
+        self._health_task: asyncio.Task | None = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    @property
+    def tools(self) -> dict[str, McpTool]:
+        return self._tools
+
+    async def start(self):
+        await asyncio.gather(*[self._warm_server(i) for i in range(len(self.servers))])
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _warm_server(self, server: int):
+        # Start one session first so that `npx` resolves and caches the package
+        # once, then start the rest of the pool concurrently.
+        first = await self._start_session(server, 0)
+        rest = await asyncio.gather(
+            *[self._start_session(server, i) for i in range(1, self.size)],
+            return_exceptions=True,
+        )
+        self._sessions[server] = [first]
+        for index, pooled in enumerate(rest, start=1):
+            if isinstance(pooled, BaseException):
+                # Run with fewer sessions; the health check retries this one.
+                logging.error(f"Failed to warm up MCP session: {pooled}")
+                pooled = self._new_session(server, index)
+            self._sessions[server].append(pooled)
+
+        result = await first.session.list_tools()
+        for tool in result.tools:
+            if tool.name in self._tool_to_server:
+                raise ValueError(f"Tool {tool.name} is exposed by multiple servers")
+            self._tools[tool.name] = tool
+            self._tool_to_server[tool.name] = server
+
+    def _new_session(self, server: int, index: int) -> _PooledSession:
+        return _PooledSession(
+            f"{self.servers[server].args[-1]}#{index}", self.servers[server]
+        )
+
+    async def _start_session(self, server: int, index: int) -> _PooledSession:
+        pooled = self._new_session(server, index)
+        await pooled.start(self.start_timeout)
+        return pooled
+
+    async def _restart_session(self, server: int, index: int):
+        old = self._sessions[server][index]
+        logging.warning(f"Restarting MCP session {old.name}")
+        await old.stop()
+        try:
+            self._sessions[server][index] = await self._start_session(server, index)
+        except RuntimeError as e:
+            # Left unhealthy; the next health check retries.
+            logging.error(str(e))
+
+    async def _is_alive(self, pooled: _PooledSession) -> bool:
+        if not pooled.healthy or not pooled.is_running():
+            return False
+        try:
+            await asyncio.wait_for(
+                pooled.session.send_ping(), self.ping_timeout.total_seconds()
+            )
+            return True
+        except Exception as e:
+            logging.warning(f"MCP session {pooled.name} failed health check: {e}")
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval.total_seconds())
+            for server, sessions in enumerate(self._sessions):
+                for index, pooled in enumerate(sessions):
+                    if not await self._is_alive(pooled):
+                        await self._restart_session(server, index)
+
+    def _least_loaded(self, server: int) -> _PooledSession:
+        healthy = [s for s in self._sessions[server] if s.healthy]
+        if not healthy:
+            raise RuntimeError(
+                f"No healthy MCP session for {self.servers[server].args[-1]}"
+            )
+        return min(healthy, key=lambda s: s.in_flight)
+
+    async def call_tool(self, name: str, args: dict[str, Any]) -> CallToolResult:
+        if name not in self._tool_to_server:
+            # E.g. the model made up a tool. Tell it, like a server would.
+            return CallToolResult(
+                content=[TextContent(type="text", text=f"Unknown tool: {name}")],
+                isError=True,
+            )
+        pooled = self._least_loaded(self._tool_to_server[name])
+        pooled.in_flight += 1
+        try:
+            return await pooled.session.call_tool(name, args)
+        except McpError:
+            # The server responded with an error, so the session itself is fine.
+            raise
+        except Exception:
+            # Most likely the process died. Take it out of rotation until the
+            # health check restarts it.
+            pooled.healthy = False
+            raise
+        finally:
+            pooled.in_flight -= 1
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        await asyncio.gather(
+            *[pooled.stop() for sessions in self._sessions for pooled in sessions]
+        )
+        self._sessions = [[] for _ in self.servers]
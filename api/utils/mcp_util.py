@@ -1,6 +1,19 @@
+import logging
+from typing import Any, Protocol
+
+from google.genai.types import (
+    FunctionCall,
+    FunctionDeclaration,
+    JSONSchema,
+    Part,
+    Schema,
+    Tool,
+)
 from mcp import StdioServerParameters
+from mcp.types import CallToolResult
+from mcp.types import Tool as McpTool
 
-from api.utils.settings import get_setting
+from api.utils.settings import get_settings
 
 
 def google_maps():
@@ -12,6 +25,83 @@ def google_maps():
         # https://github.com/modelcontextprotocol/servers-archived
         args=["-y", "@modelcontextprotocol/server-google-maps"],  # MCP Server
         env={
-            "GOOGLE_MAPS_API_KEY": get_setting("GOOGLE_MAPS_API_KEY"),
+            "GOOGLE_MAPS_API_KEY": get_settings().google_maps_api_key,
         },
     )
+
+
+def _supported_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    """`schema` without the fields Gemini's JSONSchema doesn't support."""
+    supported = {}
+    for key, value in schema.items():
+        if key not in JSONSchema.model_fields:
+            continue
+        if key == "items":
+            value = _supported_schema(value)
+        elif key == "any_of":
+            value = [_supported_schema(item) for item in value]
+        elif key == "properties":
+            value = {name: _supported_schema(item) for name, item in value.items()}
+        supported[key] = value
+    return supported
+
+
+def _gemini_tool(tool: McpTool) -> Tool:
+    # Like the SDK's own (private) conversion of MCP tools.
+    return Tool(
+        function_declarations=[
+            FunctionDeclaration(
+                name=tool.name,
+                description=tool.description,
+                parameters=Schema.from_json_schema(
+                    json_schema=JSONSchema(**_supported_schema(tool.inputSchema))
+                ),
+            )
+        ]
+    )
+
+
+class McpTools(Protocol):
+    """
+    The subset of `mcp.ClientSessionGroup` used to expose MCP tools to the model.
+    Lets wrappers (e.g. caches) stand in for the session group.
+    """
+
+    @property
+    def tools(self) -> dict[str, McpTool]: ...
+
+    async def call_tool(self, name: str, args: dict[str, Any]) -> CallToolResult: ...
+
+
+def gemini_tools(session_group: McpTools) -> list[Tool]:
+    """
+    Translates the tools exposed by the session group to Gemini tool declarations.
+
+    Unlike passing the sessions themselves as tools, declarations can be cached
+    provider-side, but the caller is responsible for executing the function calls
+    (see `call_tool`).
+    """
+    return [_gemini_tool(tool) for tool in session_group.tools.values()]
+
+
+async def call_tool(session_group: McpTools, function_call: FunctionCall) -> Part:
+    """
+    Executes `function_call` via MCP and returns the function response part. Like
+    the SDK's automatic function calling, a failed call is reported to the model
+    as an error response, so that it can recover, instead of failing the turn.
+    """
+    try:
+        result = await session_group.call_tool(
+            function_call.name, function_call.args or {}
+        )
+    except Exception as e:
+        logging.exception(f"MCP tool call {function_call.name} failed")
+        return Part.from_function_response(
+            name=function_call.name, response={"error": str(e)}
+        )
+    # Same response shape as the SDK's automatic function calling for MCP tools.
+    key = "error" if result.isError else "result"
+    return Part.from_function_response(
+        name=function_call.name,
+        response={key: result.model_dump(mode="json", exclude_none=True)},
+    )
@@ -0,0 +1,137 @@
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+# A minimal metrics registry that renders the Prometheus text format:
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+#
+# Hot paths only bump numbers in a dict. Values that can be read off live objects
+# (e.g. queue depths) are not tracked at all; collectors compute them when the
+# metrics are scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class Sample:
+    labels: dict[str, str]
+    value: float
+
+
+def _labels_key(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+@dataclass
+class _Metric:
+    name: str
+    help: str
+    type: str
+    values: dict[Labels, float] = field(default_factory=dict)
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in list(self.values.items()):
+            yield Sample(dict(labels), value)
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, "counter")
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, "gauge")
+        # So that unlabeled gauges are reported before they first change.
+        self.values[()] = 0
+
+    def set(self, value: float, **labels: str):
+        self.values[_labels_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+
+@dataclass
+class _Collected:
+    name: str
+    help: str
+    type: str
+    collect: Callable[[], Iterable[Sample]]
+
+    def samples(self) -> Iterable[Sample]:
+        return self.collect()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric | _Collected] = {}
+
+    def _register(self, metric):
+        # Modules may be reloaded (e.g. uvicorn --reload), so re-registering under
+        # the same name replaces the old metric.
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._register(Gauge(name, help))
+
+    def collected(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Iterable[Sample]],
+        *,
+        type: str = "gauge",
+    ):
+        """Registers a metric whose samples are computed by `collect` on scrape."""
+        self._register(_Collected(name, help, type, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for sample in metric.samples():
+                labels = ",".join(
+                    f'{k}="{_escape(v)}"' for k, v in sorted(sample.labels.items())
+                )
+                series = f"{metric.name}{{{labels}}}" if labels else metric.name
+                lines.append(f"{series} {_format_value(sample.value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REGISTRY.collected(
+    "process_cpu_seconds_total",
+    "CPU time used by this process.",
+    lambda: [Sample({}, time.process_time())],
+    type="counter",
+)
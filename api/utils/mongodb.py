@@ -1,18 +1,101 @@
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta
 from typing import AsyncGenerator, Optional
 
 from bson import ObjectId
-from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel
 
-from api.utils.settings import get_setting
-from api.utils.task import Task, TaskStatus
+from api.utils.metrics import REGISTRY
+from api.utils.settings import get_settings
+from api.utils.task import (
+    RETRYABLE_OUTCOMES,
+    Task,
+    TaskStatus,
+    normalize_phone_number,
+)
+from api.utils.usage import UsageRecord
 
 
 class TaskUpdate(BaseModel):
     timestamp: datetime
     message: dict[str, str] = {}
     status: TaskStatus | None = None
+    # Increases with every update added or changed, per task. Status updates
+    # don't have one.
+    seq: int | None = None
+
+
+def _seq(index: int, entry: dict) -> int:
+    # Updates stored before sequence numbers existed are numbered by position.
+    return entry.get("seq", index + 1)
+
+
+def _task_update(index: int, entry: dict) -> TaskUpdate:
+    return TaskUpdate(
+        message=entry["message"], timestamp=entry["timestamp"], seq=_seq(index, entry)
+    )
+
+
+def _updates_after(updates: list[dict], after: int) -> list[TaskUpdate]:
+    """The updates with a sequence number above `after`, in sequence order."""
+    return sorted(
+        (
+            _task_update(index, entry)
+            for index, entry in enumerate(updates)
+            if _seq(index, entry) > after
+        ),
+        key=lambda update: update.seq,
+    )
+
+
+def _apply_updated_field(updates: list[dict], path: str, value):
+    """
+    Applies a change stream field of the updates array, e.g. "3" (a pushed update)
+    or "3.message.value" (a field changed in place), to `updates`.
+    """
+    index, *keys = path.split(".")
+    index = int(index)
+    if not keys:
+        if index == len(updates):
+            updates.append(value)
+        elif index < len(updates):
+            updates[index] = value
+        return
+    if index >= len(updates):
+        logging.error(f"Missed task update {index}, can't apply {path}")
+        return
+    target = updates[index]
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    target[keys[-1]] = value
+
+
+# The task's update sequence number. Tasks with updates stored before sequence
+# numbers existed start from their count, see _seq.
+_CURRENT_SEQ = {"$ifNull": ["$update_seq", {"$size": {"$ifNull": ["$updates", []]}}]}
+
+
+def _next_seq() -> dict:
+    """Pipeline stage that bumps the task's update sequence number."""
+    return {"$set": {"update_seq": {"$add": [_CURRENT_SEQ, 1]}}}
+
+
+def _push_update(message: dict[str, str], timestamp: datetime) -> list[dict]:
+    """Pipeline stages that append an update, numbered with the next sequence."""
+    update = {"message": {"$literal": message}, "timestamp": timestamp}
+    return [
+        _next_seq(),
+        {
+            "$set": {
+                "updates": {
+                    "$concatArrays": [
+                        {"$ifNull": ["$updates", []]},
+                        [{**update, "seq": "$update_seq"}],
+                    ]
+                }
+            }
+        },
+    ]
 
 
 class StoredTask(BaseModel):
@@ -21,10 +104,71 @@ class StoredTask(BaseModel):
     task: Optional[dict] = None
 
 
+_change_streams_open = REGISTRY.gauge(
+    "mongodb_change_streams_open", "MongoDB change streams currently open."
+)
+
+
+class QueuedTask(BaseModel):
+    task_id: str
+    task: Task
+    # Including the one about to be made.
+    attempts: int
+    max_attempts: int
+    business_phone_key: str
+
+
+class RecordingSegment(BaseModel):
+    # The operator whose audio this is, e.g. "twilio_call".
+    track: str
+    path: str
+    # Where the segment starts in the call.
+    offset_seconds: float
+    duration_seconds: float
+
+
+class OperatorProfile(BaseModel):
+    samples: int = 0
+    # Time the operator's tasks were running on the event loop, from samples.
+    wall_seconds: float = 0
+    # The event loop thread's CPU time, split by share of (non-idle) samples.
+    cpu_seconds: float = 0
+    # Sampled time by asyncio task, e.g. {"twilio_call-send": 0.12}.
+    tasks: dict[str, float] = {}
+    # The functions most often running, as "function (file:line)", with seconds.
+    hot_functions: list[tuple[str, float]] = []
+
+
+class CallProfile(BaseModel):
+    started_at: datetime
+    duration_seconds: float
+    interval_ms: float
+    samples: int
+    # Time the event loop was waiting for I/O.
+    idle_seconds: float
+    # Time the event loop was running something else, e.g. other calls.
+    other_seconds: float
+    loop_cpu_seconds: float
+    # By operator name. Routing between operators is under "mediator".
+    operators: dict[str, OperatorProfile]
+
+
+class BatchProgress(BaseModel):
+    batch_id: str
+    total: int
+    # Number of tasks per status, and per outcome for finished tasks.
+    statuses: dict[str, int] = {}
+    outcomes: dict[str, int] = {}
+    done: bool = False
+
+
 class MongoDB:
     _instance = None
     _client = None
     _db = None
+    _tool_cache_indexed = False
+    _queue_indexed = False
+    _dedup_indexed = False
 
     def __new__(cls):
         if cls._instance is None:
@@ -33,16 +177,33 @@ class MongoDB:
 
     async def connect(self):
         if not self._client:
-            mongodb_uri = get_setting("MONGODB_URI")
-            self._client = AsyncIOMotorClient(mongodb_uri)
+            # Imported on first use, since motor (and pymongo) are slow to import.
+            from motor.motor_asyncio import AsyncIOMotorClient
+
+            self._client = AsyncIOMotorClient(get_settings().mongodb_uri)
             self._db = self._client.bubbacall
 
-    async def store_task(self, task: Task) -> str:
+    @staticmethod
+    def new_task_id() -> str:
+        """
+        Generate a task id client-side, so that work depending on the id (e.g.
+        placing the call) can start before the task is stored
+        """
+        return str(ObjectId())
+
+    async def store_task(
+        self,
+        task: Task,
+        task_id: str | None = None,
+        *,
+        dedup_key: str | None = None,
+    ) -> str:
         """Store a task in MongoDB and return the ObjectId as string"""
         await self.connect()
 
         now = datetime.now()
         task_data = {
+            "_id": ObjectId(task_id),
             "business_name": task.business_name,
             "business_phone_number": task.business_phone_number,
             "task": task.task,
@@ -50,10 +211,187 @@ class MongoDB:
             "created_at": now,
             "modified_at": now,
         }
+        if dedup_key is not None:
+            task_data["dedup_key"] = dedup_key
 
         result = await self._db.tasks.insert_one(task_data)
         return str(result.inserted_id)
 
+    async def find_task_by_dedup_key(
+        self, dedup_key: str, *, finished_after: datetime
+    ) -> Optional[tuple[str, TaskStatus]]:
+        """
+        Find a task with the given dedup key that is either not finished yet, or
+        finished successfully after `finished_after`. Returns its id and status
+        """
+        await self.connect()
+
+        if not self._dedup_indexed:
+            await self._db.tasks.create_index("dedup_key", sparse=True)
+            self._dedup_indexed = True
+
+        task_data = await self._db.tasks.find_one(
+            {
+                "dedup_key": dedup_key,
+                "$or": [
+                    {"status": {"$ne": TaskStatus.FINISHED}},
+                    {
+                        "status": TaskStatus.FINISHED,
+                        "modified_at": {"$gte": finished_after},
+                        # Calls that reached the media stream finish without an
+                        # outcome. Failed, rejected or unconnected calls have one.
+                        "outcome": None,
+                    },
+                ],
+            },
+            {"status": 1},
+            sort=[("modified_at", -1)],
+        )
+        if task_data is None:
+            return None
+        return str(task_data["_id"]), TaskStatus(task_data["status"])
+
+    async def store_batch(
+        self,
+        tasks: list[Task],
+        *,
+        dedup_keys: list[str],
+        priority: int = 0,
+        max_attempts: int = 3,
+    ) -> tuple[str, list[str]]:
+        """Store tasks queued for dialing as a batch. Returns the batch and task ids"""
+        await self.connect()
+
+        if not self._queue_indexed:
+            await self._db.tasks.create_index(
+                [("status", 1), ("priority", -1), ("next_attempt_at", 1)]
+            )
+            await self._db.tasks.create_index("batch_id")
+            self._queue_indexed = True
+
+        now = datetime.now()
+        batch_id = ObjectId()
+        await self._db.batches.insert_one(
+            {"_id": batch_id, "size": len(tasks), "created_at": now}
+        )
+        result = await self._db.tasks.insert_many(
+            [
+                {
+                    "business_name": task.business_name,
+                    "business_phone_number": task.business_phone_number,
+                    "business_phone_key": normalize_phone_number(
+                        task.business_phone_number
+                    ),
+                    "task": task.task,
+                    "dedup_key": dedup_key,
+                    "status": TaskStatus.QUEUED,
+                    "batch_id": batch_id,
+                    "priority": priority,
+                    "attempts": 0,
+                    "max_attempts": max_attempts,
+                    "next_attempt_at": now,
+                    "created_at": now,
+                    "modified_at": now,
+                }
+                for task, dedup_key in zip(tasks, dedup_keys, strict=True)
+            ]
+        )
+        return str(batch_id), [str(i) for i in result.inserted_ids]
+
+    async def claim_queued_task(
+        self, *, exclude_phone_keys: list[str] = []
+    ) -> Optional[QueuedTask]:
+        """
+        Atomically take the highest priority queued task that is due (and not for
+        one of `exclude_phone_keys`), moving it to CREATED
+        """
+        await self.connect()
+        from pymongo import ReturnDocument
+
+        now = datetime.now()
+        query = {"status": TaskStatus.QUEUED, "next_attempt_at": {"$lte": now}}
+        if exclude_phone_keys:
+            query["business_phone_key"] = {"$nin": exclude_phone_keys}
+        task_data = await self._db.tasks.find_one_and_update(
+            query,
+            {
+                "$set": {"status": TaskStatus.CREATED, "modified_at": now},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", -1), ("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if task_data is None:
+            return None
+        return QueuedTask(
+            task_id=str(task_data["_id"]),
+            task=Task(
+                business_name=task_data["business_name"],
+                business_phone_number=task_data["business_phone_number"],
+                task=task_data["task"],
+            ),
+            attempts=task_data["attempts"],
+            max_attempts=task_data["max_attempts"],
+            business_phone_key=task_data["business_phone_key"],
+        )
+
+    async def requeue_task(
+        self, task_id: str, *, next_attempt_at: datetime, refund_attempt: bool = False
+    ):
+        """
+        Put a claimed or finished task back in the queue. With `refund_attempt`, the
+        attempt it was claimed for does not count
+        """
+        await self.connect()
+
+        update = {
+            "$set": {
+                "status": TaskStatus.QUEUED,
+                "next_attempt_at": next_attempt_at,
+                "modified_at": datetime.now(),
+            },
+            "$unset": {"outcome": "", "call_sid": "", "call_status": ""},
+        }
+        if refund_attempt:
+            update["$inc"] = {"attempts": -1}
+        await self._db.tasks.update_one({"_id": ObjectId(task_id)}, update)
+
+    async def get_task_outcome(self, task_id: str) -> Optional[str]:
+        """Retrieve the outcome of a finished task"""
+        await self.connect()
+
+        task_data = await self._db.tasks.find_one(
+            {"_id": ObjectId(task_id)}, {"outcome": 1}
+        )
+        return task_data.get("outcome") if task_data else None
+
+    async def get_batch_progress(self, batch_id: str) -> Optional[BatchProgress]:
+        """Count the tasks of a batch by status and outcome"""
+        await self.connect()
+
+        batch = await self._db.batches.find_one({"_id": ObjectId(batch_id)})
+        if batch is None:
+            return None
+
+        progress = BatchProgress(batch_id=batch_id, total=batch["size"])
+        pipeline = [
+            {"$match": {"batch_id": ObjectId(batch_id)}},
+            {
+                "$group": {
+                    "_id": {"status": "$status", "outcome": "$outcome"},
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
+        async for group in self._db.tasks.aggregate(pipeline):
+            status, count = group["_id"]["status"], group["count"]
+            progress.statuses[status] = progress.statuses.get(status, 0) + count
+            if status == TaskStatus.FINISHED:
+                outcome = group["_id"].get("outcome") or "unknown"
+                progress.outcomes[outcome] = progress.outcomes.get(outcome, 0) + count
+        progress.done = progress.statuses.get(TaskStatus.FINISHED, 0) == progress.total
+        return progress
+
     async def update_task_progress(
         self,
         task_id: str,
@@ -65,39 +403,160 @@ class MongoDB:
         await self.connect()
         assert message or task_status, "Must provide either message or task_status"
 
-        update_payload = {}
         now = datetime.now()
+        # A pipeline, so that updates are numbered atomically (see TaskUpdate.seq).
+        pipeline = []
         if message:
-            update = {"message": message, "timestamp": now}
-            update_payload["$push"] = {"updates": update}
+            pipeline.extend(_push_update(message, now))
         if task_status:
-            update_payload["$set"] = {
-                "status": task_status,
-                "modified_at": now,
-            }
+            pipeline.append({"$set": {"status": task_status, "modified_at": now}})
+
+        await self._db.tasks.update_one({"_id": ObjectId(task_id)}, pipeline)
+
+    async def update_transcript_segment(self, task_id: str, segment: str, text: str):
+        """
+        Replace the text of a transcript update added with a "segment" key (see
+        MongoDBForwarder)
+        """
+        await self.connect()
+
+        # Only the segment's fields are set, so that watchers aren't sent the whole
+        # updates array. That can't bump the sequence number in the same update, so
+        # it is compared and set instead, and retried if another update took it.
+        while True:
+            task = await self._db.tasks.find_one(
+                {"_id": ObjectId(task_id)}, {"update_seq": 1, "seq": _CURRENT_SEQ}
+            )
+            if task is None:
+                return
+            seq = task["seq"] + 1
+            result = await self._db.tasks.update_one(
+                {"_id": ObjectId(task_id), "update_seq": task.get("update_seq")},
+                {
+                    "$set": {
+                        "update_seq": seq,
+                        "updates.$[update].message.value": text,
+                        "updates.$[update].seq": seq,
+                    }
+                },
+                array_filters=[{"update.message.segment": segment}],
+            )
+            if result.matched_count:
+                return
+
+    async def set_call_sid(self, task_id: str, call_sid: str):
+        """Record the Twilio call placed for a task"""
+        await self.connect()
 
         await self._db.tasks.update_one(
             {"_id": ObjectId(task_id)},
-            update_payload,
+            {"$set": {"call_sid": call_sid, "modified_at": datetime.now()}},
+        )
+
+    async def get_call_sid(self, task_id: str) -> Optional[str]:
+        """Retrieve the SID of the Twilio call placed for a task, if any"""
+        await self.connect()
+
+        task_data = await self._db.tasks.find_one(
+            {"_id": ObjectId(task_id)}, {"call_sid": 1}
+        )
+        return task_data.get("call_sid") if task_data else None
+
+    async def record_call_status(
+        self,
+        task_id: str,
+        call_status: str,
+        *,
+        call_duration_seconds: int | None = None,
+    ):
+        """Record a Twilio call lifecycle event as a task update"""
+        await self.connect()
+
+        now = datetime.now()
+        fields = {"call_status": call_status, "modified_at": now}
+        if call_duration_seconds is not None:
+            fields["call_duration_seconds"] = call_duration_seconds
+        await self._db.tasks.update_one(
+            {"_id": ObjectId(task_id)},
+            [
+                {"$set": fields},
+                *_push_update({"type": "call_status", "value": call_status}, now),
+            ],
+        )
+
+    async def finish_task(
+        self, task_id: str, *, outcome: str, only_if: TaskStatus | None = None
+    ) -> bool:
+        """
+        Mark a task as finished with the given outcome, unless it already is (or, if
+        `only_if` is set, unless it is in that status). Returns whether it was updated.
+        Tasks with a retry backoff (see set_retry_backoff) and a retryable outcome
+        go back to the queue instead, so that watchers don't take them for finished
+        """
+        await self.connect()
+
+        query = {"_id": ObjectId(task_id), "status": {"$ne": TaskStatus.FINISHED}}
+        if only_if is not None:
+            query["status"] = only_if
+        now = datetime.now()
+        if outcome in RETRYABLE_OUTCOMES:
+            result = await self._db.tasks.update_one(
+                {**query, "retry_backoff_ms": {"$exists": True}},
+                [
+                    {
+                        "$set": {
+                            "status": TaskStatus.QUEUED,
+                            "next_attempt_at": {"$add": [now, "$retry_backoff_ms"]},
+                            "modified_at": now,
+                        }
+                    },
+                    {
+                        "$unset": [
+                            "outcome",
+                            "call_sid",
+                            "call_status",
+                            "retry_backoff_ms",
+                        ]
+                    },
+                ],
+            )
+            if result.modified_count > 0:
+                logging.info(f"Requeued task {task_id} after {outcome}")
+                return True
+        result = await self._db.tasks.update_one(
+            query,
+            {
+                "$set": {
+                    "status": TaskStatus.FINISHED,
+                    "outcome": outcome,
+                    "modified_at": now,
+                },
+                "$unset": {"retry_backoff_ms": ""},
+            },
+        )
+        return result.modified_count > 0
+
+    async def set_retry_backoff(self, task_id: str, backoff: timedelta):
+        """
+        Have finish_task put the task back in the queue for another attempt after
+        `backoff`, if this one fails with a retryable outcome
+        """
+        await self.connect()
+
+        await self._db.tasks.update_one(
+            {"_id": ObjectId(task_id)},
+            {"$set": {"retry_backoff_ms": int(backoff.total_seconds() * 1000)}},
         )
 
     async def watch_task_updates(
-        self, task_id: str
+        self, task_id: str, after: int = 0
     ) -> AsyncGenerator[TaskUpdate, None]:
-        """Watch for updates to a specific task"""
+        """
+        Watch for updates to a specific task, starting with the ones numbered above
+        `after` (see TaskUpdate.seq). Updates changed in place are sent again whole
+        """
         await self.connect()
 
-        # Get initial task state
-        task = await self._db.tasks.find_one({"_id": ObjectId(task_id)})
-        assert task is not None, "Task not found"
-        if task.get("updates"):
-            for update in task["updates"]:
-                yield TaskUpdate(
-                    message=update["message"],
-                    timestamp=update["timestamp"],
-                )
-
-        # Watch for new updates
         pipeline = [
             {
                 "$match": {
@@ -107,30 +566,49 @@ class MongoDB:
             }
         ]
 
-        async with self._db.tasks.watch(pipeline) as change_stream:
-            async for change in change_stream:
-                # The updates look like updates.0, updates.1, etc, so this handles that.
-                for k, v in change["updateDescription"]["updatedFields"].items():
-                    if k.startswith("updates."):
-                        yield TaskUpdate(
-                            message=v["message"],
-                            timestamp=v["timestamp"],
-                        )
-                    elif k.startswith("updates"):
-                        # When the first update is pushed, the change stream is the
-                        # entire array. For later updates, it's just the element
-                        # that was pushed.
-                        yield TaskUpdate(
-                            message=v[0]["message"],
-                            timestamp=v[0]["timestamp"],
-                        )
-                    if k == "status":
+        _change_streams_open.inc()
+        try:
+            # Opened before the task is read, so that no update falls in between.
+            # Those that are seen twice are skipped by their sequence number.
+            async with self._db.tasks.watch(pipeline) as change_stream:
+                task = await self._db.tasks.find_one({"_id": ObjectId(task_id)})
+                assert task is not None, "Task not found"
+                updates: list[dict] = task.get("updates", [])
+                for update in _updates_after(updates, after):
+                    after = update.seq
+                    yield update
+                if task["status"] == TaskStatus.FINISHED:
+                    # Nothing more will happen.
+                    yield TaskUpdate(
+                        status=task["status"], timestamp=task["modified_at"]
+                    )
+                    return
+                if task["status"] == TaskStatus.QUEUED:
+                    # Possibly requeued after a failed attempt.
+                    yield TaskUpdate(
+                        status=task["status"], timestamp=task["modified_at"]
+                    )
+
+                async for change in change_stream:
+                    fields = change["updateDescription"]["updatedFields"]
+                    for k, v in fields.items():
+                        # When the first update is pushed, the change stream has
+                        # the entire array. Later, it has the elements that were
+                        # pushed, or the fields that changed, e.g. updates.1 or
+                        # updates.3.message.value.
+                        if k == "updates":
+                            updates = list(v)
+                        elif k.startswith("updates."):
+                            _apply_updated_field(updates, k.removeprefix("updates."), v)
+                    for update in _updates_after(updates, after):
+                        after = update.seq
+                        yield update
+                    if "status" in fields:
                         yield TaskUpdate(
-                            status=v,
-                            timestamp=change["updateDescription"]["updatedFields"][
-                                "modified_at"
-                            ],
+                            status=fields["status"], timestamp=fields["modified_at"]
                         )
+        finally:
+            _change_streams_open.dec()
 
     async def get_task(self, task_id: str) -> Optional[Task]:
         """Retrieve a task by its ObjectId"""
@@ -145,6 +623,131 @@ class MongoDB:
             )
         return None
 
+    async def get_tool_result(self, key: str) -> Optional[dict]:
+        """Retrieve an unexpired cached MCP tool result by its cache key"""
+        await self.connect()
+
+        # The TTL monitor only runs periodically, so filter on expiry as well.
+        entry = await self._db.tool_cache.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.now()}}
+        )
+        return entry["result"] if entry else None
+
+    async def store_tool_result(
+        self, key: str, *, tool_name: str, result: dict, expires_at: datetime
+    ):
+        """Store an MCP tool result under its cache key until `expires_at`"""
+        await self.connect()
+
+        if not self._tool_cache_indexed:
+            await self._db.tool_cache.create_index("expires_at", expireAfterSeconds=0)
+            self._tool_cache_indexed = True
+
+        await self._db.tool_cache.replace_one(
+            {"_id": key},
+            {
+                "tool_name": tool_name,
+                "result": result,
+                "created_at": datetime.now(),
+                "expires_at": expires_at,
+            },
+            upsert=True,
+        )
+
+    async def add_usage(self, task_id: str, records: list[UsageRecord]):
+        """Append provider usage records to a task"""
+        if not records:
+            return
+        await self.connect()
+
+        await self._db.tasks.update_one(
+            {"_id": ObjectId(task_id)},
+            {"$push": {"usage": {"$each": [r.model_dump() for r in records]}}},
+        )
+
+    async def add_conversation_usage(
+        self, conversation_id: str, records: list[UsageRecord]
+    ):
+        """
+        Append provider usage records to a chat conversation, which also covers
+        turns that did not lead to a task
+        """
+        if not records:
+            return
+        await self.connect()
+
+        await self._db.conversations.update_one(
+            {"_id": conversation_id},
+            {
+                "$push": {"usage": {"$each": [r.model_dump() for r in records]}},
+                "$set": {"updated_at": datetime.now()},
+            },
+            upsert=True,
+        )
+
+    async def get_conversation_usage(
+        self, conversation_id: str
+    ) -> Optional[list[UsageRecord]]:
+        """Retrieve the provider usage records of a chat conversation"""
+        await self.connect()
+
+        conversation_data = await self._db.conversations.find_one(
+            {"_id": conversation_id}, {"usage": 1}
+        )
+        if conversation_data is None:
+            return None
+        return [
+            UsageRecord.model_validate(r) for r in conversation_data.get("usage", [])
+        ]
+
+    async def add_recordings(
+        self,
+        task_id: str,
+        segments: list[RecordingSegment],
+        *,
+        dropped_frames: int = 0,
+    ):
+        """Link the recorded audio segments of a call from its task"""
+        await self.connect()
+
+        await self._db.tasks.update_one(
+            {"_id": ObjectId(task_id)},
+            {
+                "$push": {"recordings": {"$each": [s.model_dump() for s in segments]}},
+                "$inc": {"recording_dropped_frames": dropped_frames},
+            },
+        )
+
+    async def add_call_profile(self, task_id: str, profile: CallProfile):
+        """Store a profile of (part of) a task's call with the task"""
+        await self.connect()
+
+        await self._db.tasks.update_one(
+            {"_id": ObjectId(task_id)}, {"$push": {"profiles": profile.model_dump()}}
+        )
+
+    async def get_call_profiles(self, task_id: str) -> Optional[list[CallProfile]]:
+        """Retrieve the call profiles of a task"""
+        await self.connect()
+
+        task_data = await self._db.tasks.find_one(
+            {"_id": ObjectId(task_id)}, {"profiles": 1}
+        )
+        if task_data is None:
+            return None
+        return [CallProfile.model_validate(p) for p in task_data.get("profiles", [])]
+
+    async def get_usage(self, task_id: str) -> Optional[list[UsageRecord]]:
+        """Retrieve the provider usage records of a task"""
+        await self.connect()
+
+        task_data = await self._db.tasks.find_one(
+            {"_id": ObjectId(task_id)}, {"usage": 1}
+        )
+        if task_data is None:
+            return None
+        return [UsageRecord.model_validate(r) for r in task_data.get("usage", [])]
+
     async def close(self):
         """Close the MongoDB connection"""
         if self._client:
@@ -1,11 +1,13 @@
 from enum import Enum
-from typing import Any, List, Optional
+from typing import TYPE_CHECKING, Any, List, Optional
 
-from google.genai.types import Content, Part
 from pydantic import BaseModel
 
 from .attachment import ClientAttachment
 
+if TYPE_CHECKING:
+    from google.genai.types import Content
+
 
 class ToolInvocationState(str, Enum):
     CALL = "call"
@@ -28,7 +30,9 @@ class ClientMessage(BaseModel):
     toolInvocations: Optional[List[ToolInvocation]] = None
 
 
-def convert_to_gemini_messages(messages: List[ClientMessage]) -> list[Content]:
+def convert_to_gemini_messages(messages: List[ClientMessage]) -> list["Content"]:
+    from google.genai.types import Content, Part
+
     gemini_messages: list[Content] = []
 
     for message in messages:
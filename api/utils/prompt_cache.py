@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Callable
+
+from google import genai
+from google.genai.errors import APIError
+from google.genai.types import (
+    CreateCachedContentConfig,
+    GenerateContentConfig,
+    Tool,
+)
+
+# Refresh a cache entry this far (as a fraction of the TTL) into its lifetime, so
+# that requests never reference cached content that is about to expire.
+_REFRESH_FRACTION = 0.9
+
+
+def tools_fingerprint(tools: list[Tool]) -> str:
+    """Returns a stable fingerprint of a list of tool declarations."""
+    digest = hashlib.sha256()
+    for tool in tools:
+        digest.update(tool.model_dump_json(exclude_none=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+@dataclass
+class _CacheEntry:
+    fingerprint: str
+    # The config with the static prefix inlined. Always usable.
+    config: GenerateContentConfig
+    # The config referencing the provider-side cached prefix, if caching succeeded.
+    cached_config: GenerateContentConfig | None = None
+    cache_name: str | None = None
+    # time.monotonic() deadline after which the entry is re-registered.
+    refresh_at: float = 0.0
+    # time.monotonic() deadline after which the cached prefix no longer exists.
+    expires_at: float = 0.0
+    # The task re-registering the entry, while it runs.
+    refreshing: asyncio.Task | None = field(default=None, repr=False)
+
+    def current_config(self) -> GenerateContentConfig:
+        if self.cached_config is not None and time.monotonic() < self.expires_at:
+            return self.cached_config
+        return self.config
+
+
+class PromptCache:
+    """
+    Builds `GenerateContentConfig`s once and registers their static prefix (system
+    instruction and tool declarations) with Gemini's context caching, so the model
+    does not re-ingest them on every request.
+
+    An entry is re-registered in the background when its TTL is about to expire,
+    while requests keep using the current cache, and rebuilt when its fingerprint
+    (e.g. the tool set) changes. If the prefix can't be cached (e.g. it is below the
+    minimum cacheable size, the model does not support caching, or the request
+    fails), the inline config is used and caching is retried after the TTL.
+
+    This class does not own the lifetime of the `client`.
+    """
+
+    def __init__(self, client: genai.Client, ttl: timedelta = timedelta(hours=1)):
+        self.client = client
+        self.ttl = ttl
+        self._entries: dict[tuple[str, str], _CacheEntry] = {}
+        # Held while building an entry, so that concurrent requests build it once.
+        self._locks: defaultdict[tuple[str, str], asyncio.Lock] = defaultdict(
+            asyncio.Lock
+        )
+
+    async def get_config(
+        self,
+        *,
+        name: str,
+        model: str,
+        build_config: Callable[[], GenerateContentConfig],
+        fingerprint: str = "",
+    ) -> GenerateContentConfig:
+        """
+        Returns the config for `name`, building it with `build_config` only when
+        there is no entry yet or `fingerprint` changed.
+        """
+        key = (name, model)
+        entry = self._entries.get(key)
+        if entry is None or entry.fingerprint != fingerprint:
+            async with self._locks[key]:
+                entry = self._entries.get(key)
+                if entry is None or entry.fingerprint != fingerprint:
+                    if entry is not None:
+                        # The old cache is left to expire, like on refreshes,
+                        # since in-flight requests may still reference it.
+                        logging.info(f"Prompt prefix for {name} changed, rebuilding")
+                    entry = _CacheEntry(fingerprint=fingerprint, config=build_config())
+                    await self._register(name=name, model=model, entry=entry)
+                    self._entries[key] = entry
+        elif time.monotonic() >= entry.refresh_at and entry.refreshing is None:
+            entry.refreshing = asyncio.create_task(
+                self._refresh(name=name, model=model, entry=entry)
+            )
+        return entry.current_config()
+
+    async def _refresh(self, *, name: str, model: str, entry: _CacheEntry):
+        try:
+            await self._register(name=name, model=model, entry=entry)
+        finally:
+            entry.refreshing = None
+
+    async def _register(self, *, name: str, model: str, entry: _CacheEntry):
+        ttl_seconds = int(self.ttl.total_seconds())
+        started_at = time.monotonic()
+        try:
+            cached_content = await self.client.aio.caches.create(
+                model=model,
+                config=CreateCachedContentConfig(
+                    display_name=f"bubbacall-{name}",
+                    system_instruction=entry.config.system_instruction,
+                    tools=entry.config.tools,
+                    tool_config=entry.config.tool_config,
+                    ttl=f"{ttl_seconds}s",
+                ),
+            )
+        except Exception as e:
+            # Caching is an optimization. Fall back to sending the prefix inline
+            # once the current cache (if any) expires. Besides API errors, this
+            # covers transport errors and timeouts.
+            logging.warning(f"Context caching unavailable for {name}: {e!r}")
+            entry.refresh_at = time.monotonic() + ttl_seconds
+            return
+
+        # The previous cache (if any) is left to expire on its own, since
+        # in-flight requests may still reference it.
+        logging.info(f"Cached prompt prefix for {name}: {cached_content.name}")
+        entry.cache_name = cached_content.name
+        entry.cached_config = entry.config.model_copy(
+            update={
+                "system_instruction": None,
+                "tools": None,
+                "tool_config": None,
+                "cached_content": cached_content.name,
+            }
+        )
+        entry.expires_at = started_at + ttl_seconds
+        entry.refresh_at = started_at + ttl_seconds * _REFRESH_FRACTION
+
+    async def _delete(self, entry: _CacheEntry):
+        if entry.cache_name is None:
+            return
+        try:
+            await self.client.aio.caches.delete(name=entry.cache_name)
+        except APIError as e:
+            logging.warning(f"Failed to delete cached content {entry.cache_name}: {e}")
+
+    async def close(self):
+        """Deletes all provider-side caches created by this instance."""
+        for entry in self._entries.values():
+            if entry.refreshing is not None:
+                entry.refreshing.cancel()
+            await self._delete(entry)
+        self._entries.clear()
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Awaitable, TypeVar
+
+T = TypeVar("T")
+
+
+class Readiness:
+    """
+    Tracks components that start in the background (e.g. provider clients, MCP
+    servers), so that the app can serve requests before they are up. Requests wait
+    for the components they need, and health checks report on all of them.
+    """
+
+    def __init__(self):
+        self._done: dict[str, asyncio.Event] = {}
+        self._errors: dict[str, str] = {}
+
+    def _event(self, name: str) -> asyncio.Event:
+        return self._done.setdefault(name, asyncio.Event())
+
+    async def run(self, name: str, start: Awaitable[T]) -> T:
+        """Awaits `start`, marking `name` ready or failed once it is done."""
+        self._event(name)
+        try:
+            result = await start
+        except Exception as e:
+            logging.exception(f"{name} failed to start")
+            self._errors[name] = str(e) or type(e).__name__
+            self._event(name).set()
+            raise
+        logging.info(f"{name} is ready")
+        self._event(name).set()
+        return result
+
+    def has_failed(self, name: str) -> bool:
+        return name in self._errors
+
+    def is_ready(self, name: str) -> bool:
+        return self._event(name).is_set() and name not in self._errors
+
+    async def wait(self, name: str, timeout: timedelta) -> bool:
+        """Waits for `name` to start. Returns False if it failed or took too long."""
+        try:
+            await asyncio.wait_for(self._event(name).wait(), timeout.total_seconds())
+        except asyncio.TimeoutError:
+            return False
+        return name not in self._errors
+
+    def status(self) -> dict[str, str]:
+        return {
+            name: (
+                f"failed: {self._errors[name]}"
+                if name in self._errors
+                else "ready" if done.is_set() else "starting"
+            )
+            for name, done in self._done.items()
+        }
+
+    def all_ready(self) -> bool:
+        return all(self.is_ready(name) for name in self._done)
@@ -1,7 +1,16 @@
-import os
+import logging
 from enum import Enum
+from pathlib import Path
+from typing import Annotated
 
-from dotenv import load_dotenv
+from pydantic import StringConstraints, ValidationError
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+# The repo root, where `.env` lives. Environment variables take precedence.
+_ENV_FILE = Path(__file__).resolve().parents[2] / ".env"
+
+# Empty values (e.g. copied over from .env.example) count as missing.
+RequiredStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
 
 
 class Env(Enum):
@@ -9,6 +18,81 @@ class Env(Enum):
     PROD = "PROD"
 
 
-def get_setting(key: str):
-    load_dotenv()
-    return os.getenv(key)
+class CallProvider(Enum):
+    ELEVENLABS = "elevenlabs"
+    GEMINI = "gemini"
+
+
+class Settings(BaseSettings):
+    """
+    All configuration, read from the environment and `.env`. Field names match the
+    (case-insensitive) variable names in `.env.example`.
+    """
+
+    model_config = SettingsConfigDict(env_file=_ENV_FILE, extra="ignore")
+
+    gemini_api_key: RequiredStr
+    google_maps_api_key: RequiredStr
+    elevenlabs_api_key: RequiredStr
+    elevenlabs_agent_id: RequiredStr
+    twilio_account_sid: RequiredStr
+    twilio_auth_token: RequiredStr
+    mongodb_uri: RequiredStr
+    fastapi_raw_domain: RequiredStr
+    fastapi_port: int = 8000
+
+    mcp_pool_size: int = 2
+    max_active_calls: int = 20
+    max_queued_calls: int = 20
+    max_event_loop_lag_ms: float = 50
+    max_cpu_percent: float = 80
+    dialer_concurrency: int = 5
+    dialer_calls_per_business: int = 1
+    task_dedup_freshness_minutes: int = 60
+    twilio_egress_lead_ms: int = 100
+    # The voice agent that talks on phone calls.
+    call_provider: CallProvider = CallProvider.ELEVENLABS
+    gemini_live_model: str = "gemini-2.5-flash-preview-native-audio-dialog"
+    # Where call recordings are written. Calls are not recorded if unset.
+    recordings_dir: str | None = None
+    # Where raw websocket traces of calls are written, for offline replay (see
+    # api/audio_stream/call_replay.py). Calls are not traced if unset.
+    call_traces_dir: str | None = None
+    # Connects calls to this ElevenLabs conversation websocket instead of the agent's
+    # signed URL, e.g. a local stand-in (see api/audio_stream/load_test.py).
+    elevenlabs_conversation_url: str | None = None
+
+    # Required by admin endpoints. They are disabled when it is not set.
+    admin_token: str | None = None
+
+
+_settings: Settings | None = None
+
+
+def get_settings() -> Settings:
+    """
+    Returns the settings snapshot, loading it on first use. Raises a
+    ValidationError listing every missing or invalid setting.
+    """
+    global _settings
+    if _settings is None:
+        _settings = Settings()
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """
+    Re-reads the environment and `.env`. If the new settings are invalid, the
+    current ones are kept and the error is raised.
+
+    Only settings read when they are used (e.g. API keys for new calls) pick up
+    the change. Those used at startup (e.g. pool sizes) need a restart.
+    """
+    global _settings
+    try:
+        _settings = Settings()
+    except ValidationError:
+        logging.exception("Invalid settings, keeping the current ones")
+        raise
+    logging.info("Reloaded settings")
+    return _settings
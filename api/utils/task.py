@@ -1,11 +1,14 @@
 from enum import StrEnum, auto
-from typing import List
+from typing import TYPE_CHECKING, List
 
-from google import genai
-from google.genai.types import Content, GenerateContentConfig, Modality, Part
 from pydantic import BaseModel
 
 from api.utils.chat_base import BASE_INSTRUCTIONS
+from api.utils.usage import UsageTracker
+
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai.types import Content, GenerateContentConfig
 
 TASK_SYSTEM_INSTRUCTION = f"""
 {BASE_INSTRUCTIONS}
@@ -17,23 +20,37 @@ Your response should have .task set to 'None' UNTIL the user confirms the task
 
 
 class TaskStatus(StrEnum):
+    # Submitted in bulk and waiting to be dialed.
+    QUEUED = auto()
     CREATED = auto()
     IN_PROGRESS = auto()
-    # Completed or failed.
+    # Completed or failed, and not going to be tried again.
     FINISHED = auto()
 
 
+# Call outcomes worth trying again later, for tasks dialed from the queue.
+RETRYABLE_OUTCOMES = {"busy", "no-answer", "failed to dial"}
+
+
 class Task(BaseModel):
     business_name: str
     business_phone_number: str
     task: str
 
 
+def normalize_phone_number(phone_number: str) -> str:
+    """Strips formatting, so that e.g. "(607) 229-0494" and "607-229-0494" match."""
+    digits = "".join(c for c in phone_number if c.isdigit())
+    return f"+{digits}" if phone_number.strip().startswith("+") else digits
+
+
 class TaskOrNone(BaseModel):
     task: Task | None = None
 
 
-def create_task_config():
+def create_task_config() -> "GenerateContentConfig":
+    from google.genai.types import Content, GenerateContentConfig, Modality, Part
+
     return GenerateContentConfig(
         system_instruction=Content(
             role="system", parts=[Part(text=TASK_SYSTEM_INSTRUCTION)]
@@ -45,9 +62,17 @@ def create_task_config():
 
 
 async def generate_task(
-    client: genai.Client, messages: List[Content], model: str = "gemini-2.0-flash"
+    client: "genai.Client",
+    messages: List["Content"],
+    model: str = "gemini-2.0-flash",
+    config: "GenerateContentConfig | None" = None,
+    usage: UsageTracker | None = None,
 ) -> TaskOrNone:
+    timer = usage.gemini_call("task", model) if usage else None
     resp = await client.aio.models.generate_content(
-        model=model, contents=messages, config=create_task_config()
+        model=model, contents=messages, config=config or create_task_config()
     )
+    if timer:
+        timer.on_response(resp)
+        timer.finish()
     return resp.parsed
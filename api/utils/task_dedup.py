@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from api.utils.mongodb import MongoDB
+from api.utils.task import Task, TaskStatus, normalize_phone_number
+
+
+def task_dedup_key(task: Task) -> str:
+    """
+    Identifies tasks that would make the same call: the same business phone number
+    and the same request, ignoring case, punctuation and spacing.
+    """
+    text = re.sub(r"[^\w\s]", "", task.task.lower())
+    text = " ".join(text.split())
+    phone = normalize_phone_number(task.business_phone_number)
+    return hashlib.sha256(f"{phone}\n{text}".encode("utf-8")).hexdigest()
+
+
+@dataclass
+class DuplicateTask:
+    task_id: str
+    status: TaskStatus
+
+    @property
+    def finished(self) -> bool:
+        return self.status == TaskStatus.FINISHED
+
+
+class TaskDeduplicator:
+    """
+    Finds an existing task to use instead of calling a business again about the
+    same thing: one whose call is still in progress (to attach to its updates), or
+    one that finished successfully within `freshness` (to reuse its outcome).
+
+    Concurrent `claim`s of the same task in this process are collapsed: the first
+    one owns the key until it calls `release` (once its task is stored), and the
+    others get its task as the duplicate. Across processes, duplicates are only
+    found once the task is stored.
+    """
+
+    def __init__(
+        self, mongodb_client: MongoDB, *, freshness: timedelta = timedelta(hours=1)
+    ):
+        self.mongodb_client = mongodb_client
+        self.freshness = freshness
+        self._pending: dict[str, asyncio.Future[DuplicateTask | None]] = {}
+
+    async def claim(self, task: Task, task_id: str) -> DuplicateTask | None:
+        """
+        Returns the task `task` duplicates, if any. Otherwise `task_id` owns the
+        task's key, and the caller must store it with that key and then `release`.
+        """
+        key = task_dedup_key(task)
+        while (pending := self._pending.get(key)) is not None:
+            duplicate = await asyncio.shield(pending)
+            if duplicate is not None:
+                return duplicate
+            # The owner gave up before storing its task, so look again.
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            found = await self.mongodb_client.find_task_by_dedup_key(
+                key, finished_after=datetime.now() - self.freshness
+            )
+        except BaseException:
+            self.release(task, None)
+            raise
+        if found is not None:
+            duplicate = DuplicateTask(*found)
+            self.release(task, duplicate)
+            return duplicate
+        return None
+
+    def release(self, task: Task, duplicate: DuplicateTask | None):
+        """
+        Gives up ownership of the task's key, pointing concurrent claims to
+        `duplicate` (or None if they should look again).
+        """
+        future = self._pending.pop(task_dedup_key(task), None)
+        if future is not None and not future.done():
+            future.set_result(duplicate)
@@ -1,45 +1,181 @@
 import asyncio
 import logging
+import math
+import os
+import time
+from contextlib import AsyncExitStack
+from datetime import timedelta
+from typing import TYPE_CHECKING
 
 from elevenlabs.conversational_ai.conversation import ConversationInitiationData
 from fastapi import WebSocket
+from google.genai import types
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from twilio.request_validator import RequestValidator
 from twilio.rest import Client as TwilioClient
+from twilio.rest.api.v2010.account.call import CallInstance
 from twilio.twiml.voice_response import Connect, VoiceResponse
 
+from api.audio_stream.call_recorder import CallRecorder
+from api.audio_stream.call_trace import CallTrace
 from api.audio_stream.elevenlabs_conversation import ElevenLabsConversation
+from api.audio_stream.gemini_stream_operator import TASK_COMPLETE, GeminiStreamOperator
 from api.audio_stream.mongodb_forwarder import MongoDBForwarder
 from api.audio_stream.stream_mediator import StreamMediator
 from api.audio_stream.twilio_call import TwilioCall
+from api.utils.admission import CallAdmissionController
+from api.utils.metrics import REGISTRY
 from api.utils.mongodb import MongoDB
-from api.utils.settings import get_setting
-from api.utils.task import Task
+from api.utils.settings import CallProvider, get_settings
+from api.utils.task import Task, TaskStatus
+from api.utils.usage import UsageKind, UsageRecord
+
+if TYPE_CHECKING:
+    from google import genai
+
+# https://www.twilio.com/docs/voice/api/call-resource#call-status-values
+FAILED_CALL_STATUSES = {"busy", "no-answer", "failed", "canceled"}
+
+_first_audio_seconds = REGISTRY.counter(
+    "call_first_audio_seconds_total",
+    "Time from the call's media stream starting to the agent's first audio, "
+    "summed, by provider.",
+)
+_first_audio_calls = REGISTRY.counter(
+    "call_first_audio_total",
+    "Calls in which the agent sent audio, by provider.",
+)
+
+GEMINI_CALL_INSTRUCTION = """
+You are on a phone call with {business_name}, on behalf of a user.
+The user's task is: {task}
+
+Talk like a person on the phone: briefly, one thing at a time, and wait for
+answers. Don't make up details the task doesn't give. Once the task is done, or
+it is clear that it can't be done, say goodbye and call `task_complete`.
+"""
+
+
+def gemini_live_config(task: Task) -> types.LiveConnectConfig:
+    """The Gemini Live session for calling about `task`."""
+    return types.LiveConnectConfig(
+        response_modalities=[types.Modality.AUDIO],
+        system_instruction=types.Content(
+            role="system",
+            parts=[
+                types.Part(
+                    text=GEMINI_CALL_INSTRUCTION.format(
+                        business_name=task.business_name, task=task.task
+                    )
+                )
+            ],
+        ),
+        tools=[types.Tool(function_declarations=[TASK_COMPLETE])],
+        input_audio_transcription=types.AudioTranscriptionConfig(),
+        output_audio_transcription=types.AudioTranscriptionConfig(),
+    )
 
 
 async def stream_call(
-    mongodb_client: MongoDB, websocket: WebSocket, task: Task, task_id: str
+    mongodb_client: MongoDB,
+    admission: CallAdmissionController,
+    websocket: WebSocket,
+    task: Task,
+    task_id: str,
+    gemini_client: "genai.Client | None" = None,
 ):
+    """
+    Bridges the call's media stream to the voice agent of `CALL_PROVIDER`.
+    `gemini_client` is required for Gemini calls.
+    """
     logging.info(f"Starting stream for twilio call for task {task_id}")
+    admission.connected(task_id)
+    started_at = time.monotonic()
+    trace = None
     try:
-        new_stream_mediator = StreamMediator(
-            [
-                TwilioCall(websocket),
-                ElevenLabsConversation(
+        settings = get_settings()
+        provider = settings.call_provider
+        traces_dir = settings.call_traces_dir
+        if traces_dir:
+            await asyncio.to_thread(os.makedirs, traces_dir, exist_ok=True)
+            trace = CallTrace(os.path.join(traces_dir, f"{task_id}.jsonl.gz"), task_id)
+        async with AsyncExitStack() as stack:
+            if provider == CallProvider.GEMINI:
+                assert gemini_client is not None, "Gemini calls need a client"
+                session = await stack.enter_async_context(
+                    gemini_client.aio.live.connect(
+                        model=settings.gemini_live_model,
+                        config=gemini_live_config(task),
+                    )
+                )
+                agent = GeminiStreamOperator(session, model=settings.gemini_live_model)
+            else:
+                agent = ElevenLabsConversation(
                     conversation_config=ConversationInitiationData(
                         dynamic_variables={
                             "task": task.task,
                             "business_name": task.business_name,
                         },
-                    )
+                    ),
+                    trace=trace,
+                )
+            operators = [
+                TwilioCall(
+                    websocket,
+                    trace=trace,
+                    lead=timedelta(milliseconds=settings.twilio_egress_lead_ms),
+                ),
+                agent,
+                MongoDBForwarder(
+                    task_id,
+                    mongodb_client,
+                    transcript_separator=agent.transcript_separator,
                 ),
-                MongoDBForwarder(task_id, mongodb_client),
             ]
-        )
-        await new_stream_mediator.run()
+            recordings_dir = settings.recordings_dir
+            if recordings_dir:
+                operators.append(CallRecorder(task_id, mongodb_client, recordings_dir))
+            new_stream_mediator = StreamMediator(operators, task_id=task_id)
+            await new_stream_mediator.run()
+
+        usage = agent.usage_record()
+        if agent.first_audio_at is not None:
+            time_to_first_audio = agent.first_audio_at - started_at
+            usage.time_to_first_token_ms = time_to_first_audio * 1000
+            _first_audio_seconds.inc(time_to_first_audio, provider=provider.value)
+            _first_audio_calls.inc(provider=provider.value)
+            logging.info(
+                f"First {provider.value} audio of task {task_id} after "
+                f"{time_to_first_audio * 1000:.0f}ms"
+            )
+        await mongodb_client.add_usage(task_id, [usage])
     except asyncio.CancelledError:
         pass
+    finally:
+        admission.release(task_id)
+        if trace:
+            await asyncio.to_thread(trace.close)
+
+
+def create_twilio_client() -> TwilioClient:
+    """
+    Creates a Twilio REST client whose `*_async` methods make non-blocking requests
+    over a pooled aiohttp session. Close it with `close_twilio_client`.
+    """
+    return TwilioClient(
+        get_settings().twilio_account_sid,
+        get_settings().twilio_auth_token,
+        http_client=AsyncTwilioHttpClient(),
+    )
+
+
+async def close_twilio_client(twilio_client: TwilioClient):
+    await twilio_client.http_client.close()
 
 
-async def request_outbound_call(task_id: str, twilio_client: TwilioClient):
+async def request_outbound_call(
+    task_id: str, twilio_client: TwilioClient
+) -> CallInstance:
     """
     Makes an HTTP request to start an outbound call. Loosely based on the example
     in https://github.com/twilio/media-streams.
@@ -48,7 +184,7 @@ async def request_outbound_call(task_id: str, twilio_client: TwilioClient):
        1. https://www.twilio.com/docs/voice/twiml/stream.
        2. Call resource: https://www.twilio.com/docs/voice/api/call-resource#create-a-call-resource
     """
-    raw_domain = get_setting("FASTAPI_RAW_DOMAIN")
+    raw_domain = get_settings().fastapi_raw_domain
     response = VoiceResponse()
     connect = Connect()
     # At some point, task_id may need to be passed as a custom parameter.
@@ -60,7 +196,94 @@ async def request_outbound_call(task_id: str, twilio_client: TwilioClient):
     # TODO(ege): Replace the "To" with the business's phone number.
     # TODO(ege): Check if you can replace "from" with the user's phone number.
     logging.info(f"Twiml stuff: {response}")
-    call = twilio_client.calls.create(
-        from_="+18556282791", to="+16072290494", twiml=response
+    call = await twilio_client.calls.create_async(
+        from_="+18556282791",
+        to="+16072290494",
+        twiml=response,
+        status_callback=status_callback_url(task_id),
+        status_callback_event=["initiated", "ringing", "answered", "completed"],
+        status_callback_method="POST",
     )
-    logging.info(f"Call created: {call.sid}")
+    logging.info(f"Call created: {call.sid} ({call.status})")
+    return call
+
+
+def status_callback_url(task_id: str) -> str:
+    raw_domain = get_settings().fastapi_raw_domain
+    return f"https://{raw_domain}/api/twilio/call-status/{task_id}"
+
+
+def is_valid_status_callback(task_id: str, params: dict[str, str], signature: str):
+    """
+    Checks that a status callback was sent by Twilio.
+    https://www.twilio.com/docs/usage/webhooks/webhooks-security
+    """
+    validator = RequestValidator(get_settings().twilio_auth_token)
+    # Validate against the URL we registered rather than the one the request
+    # arrived at, which differs behind proxies (e.g. ngrok).
+    return validator.validate(status_callback_url(task_id), params, signature)
+
+
+async def handle_call_status(
+    mongodb_client: MongoDB,
+    admission: CallAdmissionController,
+    task_id: str,
+    params: dict[str, str],
+):
+    """
+    Records a call status callback on the task, and finishes the task if the call
+    will never reach the media stream (so that watchers are released).
+    https://www.twilio.com/docs/voice/api/call-resource#statuscallback
+    """
+    call_status = params["CallStatus"]
+    logging.info(f"Call status for task {task_id}: {call_status}")
+    duration = int(params["CallDuration"]) if params.get("CallDuration") else None
+    await mongodb_client.record_call_status(
+        task_id, call_status, call_duration_seconds=duration
+    )
+    if duration is not None:
+        # Twilio bills per started minute.
+        await mongodb_client.add_usage(
+            task_id,
+            [
+                UsageRecord(
+                    kind=UsageKind.TWILIO,
+                    name="call",
+                    duration_ms=duration * 1000,
+                    billable_units=math.ceil(duration / 60),
+                    unit="minutes",
+                )
+            ],
+        )
+    if call_status in FAILED_CALL_STATUSES:
+        admission.release(task_id)
+        await mongodb_client.finish_task(task_id, outcome=call_status)
+    elif call_status == "completed":
+        admission.release(task_id, only_if_unconnected=True)
+        # If the media stream connected, the stream mediator finishes the task when
+        # it shuts down. Otherwise nothing else will.
+        await mongodb_client.finish_task(
+            task_id, outcome=call_status, only_if=TaskStatus.CREATED
+        )
+
+
+class CallControl:
+    """
+    Controls in-progress calls via the Twilio REST API, without blocking the event
+    loop. This class does not own the lifetime of `twilio_client`, which should be
+    created with `create_twilio_client`.
+    """
+
+    def __init__(self, twilio_client: TwilioClient):
+        self.twilio_client = twilio_client
+
+    async def hangup(self, call_sid: str) -> CallInstance:
+        return await self.twilio_client.calls(call_sid).update_async(status="completed")
+
+    async def cancel(self, call_sid: str) -> CallInstance:
+        """Cancels a call that has not been answered yet."""
+        return await self.twilio_client.calls(call_sid).update_async(status="canceled")
+
+    async def redirect(self, call_sid: str, twiml: VoiceResponse) -> CallInstance:
+        """Replaces the TwiML the call is executing."""
+        return await self.twilio_client.calls(call_sid).update_async(twiml=twiml)
@@ -0,0 +1,119 @@
+import time
+from datetime import datetime
+from enum import StrEnum, auto
+from typing import TYPE_CHECKING, Optional
+
+from pydantic import BaseModel, Field
+
+if TYPE_CHECKING:
+    from google.genai.types import (
+        GenerateContentResponse,
+        GenerateContentResponseUsageMetadata,
+    )
+
+
+class UsageKind(StrEnum):
+    GEMINI = auto()
+    ELEVENLABS = auto()
+    TWILIO = auto()
+
+
+class UsageRecord(BaseModel):
+    kind: UsageKind
+    # What the usage was for, e.g. "chat", "task" or "call".
+    name: str
+    model: Optional[str] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    time_to_first_token_ms: Optional[float] = None
+    duration_ms: float = 0
+    # Provider billing units (e.g. Twilio minutes), when they differ from the above.
+    billable_units: Optional[float] = None
+    unit: Optional[str] = None
+    timestamp: datetime = Field(default_factory=datetime.now)
+
+
+class UsageSummary(BaseModel):
+    count: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    duration_ms: float = 0
+    billable_units: float = 0
+    max_time_to_first_token_ms: Optional[float] = None
+
+
+def summarize_usage(records: list[UsageRecord]) -> dict[str, UsageSummary]:
+    """Aggregates records per "<kind>/<name>"."""
+    summaries: dict[str, UsageSummary] = {}
+    for record in records:
+        summary = summaries.setdefault(f"{record.kind}/{record.name}", UsageSummary())
+        summary.count += 1
+        summary.prompt_tokens += record.prompt_tokens
+        summary.completion_tokens += record.completion_tokens
+        summary.duration_ms += record.duration_ms
+        summary.billable_units += record.billable_units or 0
+        if record.time_to_first_token_ms is not None:
+            summary.max_time_to_first_token_ms = max(
+                summary.max_time_to_first_token_ms or 0, record.time_to_first_token_ms
+            )
+    return summaries
+
+
+class GeminiCallTimer:
+    """
+    Measures one (streaming or not) Gemini call. Call `on_response` for every
+    response (chunk) and `finish` once the call is done.
+    """
+
+    def __init__(self, tracker: "UsageTracker", name: str, model: str):
+        self.tracker = tracker
+        self.name = name
+        self.model = model
+        self.usage_metadata: "GenerateContentResponseUsageMetadata | None" = None
+        self._start = time.perf_counter()
+        self._first_response: float | None = None
+
+    def on_response(self, response: "GenerateContentResponse"):
+        if self._first_response is None:
+            self._first_response = time.perf_counter()
+        # For streams, the usage reported on the last chunk covers the whole call.
+        if response.usage_metadata is not None:
+            self.usage_metadata = response.usage_metadata
+
+    def finish(self) -> UsageRecord:
+        end = time.perf_counter()
+        first_response = self._first_response or end
+        record = UsageRecord(
+            kind=UsageKind.GEMINI,
+            name=self.name,
+            model=self.model,
+            prompt_tokens=(
+                self.usage_metadata and self.usage_metadata.prompt_token_count
+            )
+            or 0,
+            completion_tokens=(
+                self.usage_metadata and self.usage_metadata.candidates_token_count
+            )
+            or 0,
+            time_to_first_token_ms=(first_response - self._start) * 1000,
+            duration_ms=(end - self._start) * 1000,
+        )
+        self.tracker.records.append(record)
+        return record
+
+
+class UsageTracker:
+    """Collects the usage records of one chat request."""
+
+    def __init__(self):
+        self.records: list[UsageRecord] = []
+
+    def gemini_call(self, name: str, model: str) -> GeminiCallTimer:
+        return GeminiCallTimer(self, name, model)
+
+    def total_tokens(self) -> tuple[int, int]:
+        """Returns the (prompt, completion) tokens used across all calls."""
+        return (
+            sum(r.prompt_tokens for r in self.records),
+            sum(r.completion_tokens for r in self.records),
+        )
@@ -6,10 +6,44 @@ import { Overview } from "@/components/overview";
 import { useScrollToBottom } from "@/hooks/use-scroll-to-bottom";
 import { ToolInvocation } from "ai";
 import { useChat } from "ai/react";
+import { useRef } from "react";
 import { toast } from "sonner";
 
+// The conversation the server keeps the history of, and how many of our messages
+// it has, so that only the new ones are sent.
+type ServerConversation = { id: string; known: number };
+
 export function Chat() {
   const chatId = "001";
+  const conversation = useRef<ServerConversation | null>(null);
+  // The conversation of the request in flight, and how many messages it had,
+  // which the server only keeps once the turn completes.
+  const pending = useRef<ServerConversation | null>(null);
+
+  const sendMessages: typeof fetch = async (input, init) => {
+    const body = JSON.parse(init?.body as string);
+    const current = conversation.current;
+    let response: Response | null = null;
+    if (current) {
+      response = await fetch(input, {
+        ...init,
+        body: JSON.stringify({
+          ...body,
+          messages: body.messages.slice(current.known),
+          conversation_id: current.id,
+        }),
+      });
+      if (response.status === 409) {
+        // Expired on the server, so start over with the full history.
+        conversation.current = null;
+        response = null;
+      }
+    }
+    response ??= await fetch(input, init);
+    const id = response.headers.get("x-conversation-id");
+    pending.current = id ? { id, known: body.messages.length } : null;
+    return response;
+  };
 
   const {
     messages,
@@ -22,6 +56,16 @@ export function Chat() {
     stop,
   } = useChat({
     maxSteps: 4,
+    fetch: sendMessages,
+    onFinish: () => {
+      if (pending.current) {
+        // The server has the reply too.
+        conversation.current = {
+          id: pending.current.id,
+          known: pending.current.known + 1,
+        };
+      }
+    },
     onError: (error) => {
       if (error.message.includes("Too many requests")) {
         toast.error(